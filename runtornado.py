@@ -1,8 +1,295 @@
+"""
+    Production server based on Tornado.
+
+    Requests are handled by a pool of config.SERVER_THREADS threads per process, so a slow
+    Wargaming API call or replay upload only blocks its own thread instead of the IOLoop.
+
+    With config.SERVER_PROCESSES other than 1 (0: one per CPU core) or config.SERVER_MAX_REQUESTS
+    set, a master process imports the application and loads the templates, then forks the
+    processes, which share the listening socket and the loaded modules (copy-on-write).
+    The master replaces processes that exit, stop reporting back within config.SERVER_HEALTH_TIMEOUT
+    or have handled config.SERVER_MAX_REQUESTS requests.
+
+    SIGTERM and SIGINT stop accepting connections and let the running requests finish for up to
+    config.SERVER_SHUTDOWN_TIMEOUT seconds. SIGHUP makes the master stop all processes gracefully and
+    then execute itself again, so it loads the changed code and local_config.py. The listening sockets
+    are passed on to the new master, connections arriving in the meantime wait in their backlog.
+"""
+
+import os
+import sys
+import time
+import errno
+import random
+import itertools
+import signal
+import logging
+import argparse
+import importlib
+import tempfile
+import socket
+import fcntl
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado import escape, httputil
 from tornado.wsgi import WSGIContainer
 from tornado.httpserver import HTTPServer
-from tornado.ioloop import IOLoop
-from whyattend.webapp import app
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.netutil import bind_sockets
+from tornado.process import cpu_count
+import tornado
+
+from whyattend import config, model
+from whyattend.webapp import create_app
+
+logger = logging.getLogger('runtornado')
+
+# Listening sockets passed on to the re-executed master, as comma separated fd:family pairs
+SOCKETS_ENV = 'WHYATTEND_SOCKETS'
+
+
+class ThreadPoolWSGIContainer(WSGIContainer):
+    """ WSGIContainer running the WSGI application on the threads of an executor """
+
+    def __init__(self, wsgi_application, executor, max_requests=0, on_max_requests=None):
+        super(ThreadPoolWSGIContainer, self).__init__(wsgi_application)
+        self.executor = executor
+        self.pending = 0
+        self.handled = 0
+        self.max_requests = max_requests
+        self.on_max_requests = on_max_requests
+
+    def __call__(self, request):
+        self.pending += 1
+        future = self.executor.submit(self._run, WSGIContainer.environ(request))
+        IOLoop.current().add_future(future, lambda f: self._respond(request, f))
+
+    def _run(self, environ):
+        data = {}
+        response = []
+
+        def start_response(status, response_headers, exc_info=None):
+            data['status'] = status
+            data['headers'] = response_headers
+            return response.append
+
+        app_response = self.wsgi_application(environ, start_response)
+        try:
+            response.extend(app_response)
+            body = b''.join(response)
+        finally:
+            if hasattr(app_response, 'close'):
+                app_response.close()
+        if not data:
+            raise Exception('WSGI app did not call start_response')
+        return data['status'], data['headers'], body
+
+    def _respond(self, request, future):
+        """ Write the response of a finished request, on the IOLoop thread """
+        self.pending -= 1
+        try:
+            status, headers, body = future.result()
+        except Exception:
+            logger.exception('Error in WSGI application')
+            status, headers, body = '500 Internal Server Error', [], b''
+
+        status_code, reason = status.split(' ', 1)
+        status_code = int(status_code)
+        header_set = set(k.lower() for (k, v) in headers)
+        body = escape.utf8(body)
+        if status_code != 304:
+            if 'content-length' not in header_set:
+                headers.append(('Content-Length', str(len(body))))
+            if 'content-type' not in header_set:
+                headers.append(('Content-Type', 'text/html; charset=UTF-8'))
+        if 'server' not in header_set:
+            headers.append(('Server', 'TornadoServer/%s' % tornado.version))
+
+        header_obj = httputil.HTTPHeaders()
+        for key, value in headers:
+            header_obj.add(key, value)
+        request.connection.write_headers(httputil.ResponseStartLine('HTTP/1.1', status_code, reason), header_obj,
+                                         chunk=body)
+        request.connection.finish()
+        self._log(status_code, request)
+
+        self.handled += 1
+        if self.handled == self.max_requests and self.on_max_requests:
+            self.on_max_requests()
+
+
+def shutdown(server, container, executor):
+    """ Stop accepting connections, wait for the running requests and stop the IOLoop """
+    server.stop()
+    deadline = time.time() + config.SERVER_SHUTDOWN_TIMEOUT
+    io_loop = IOLoop.current()
+
+    def stop_when_done():
+        if container.pending and time.time() < deadline:
+            io_loop.call_later(0.1, stop_when_done)
+        else:
+            executor.shutdown(wait=False)
+            io_loop.stop()
+
+    stop_when_done()
+
+
+def run_worker(app, sockets, heartbeat=None, max_requests=0):
+    """ Serve requests on sockets until SIGTERM/SIGINT or max_requests requests were handled """
+    # don't share pooled database connections with the master or other processes
+    model.dispose_engines()
+
+    io_loop = IOLoop.current()
+    executor = ThreadPoolExecutor(config.SERVER_THREADS)
+    container = ThreadPoolWSGIContainer(app, executor, max_requests,
+                                        lambda: io_loop.add_callback(shutdown, server, container, executor))
+    server = HTTPServer(container, xheaders=config.SERVER_XHEADERS)
+    server.add_sockets(sockets)
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: io_loop.add_callback_from_signal(shutdown, server, container,
+                                                                                     executor))
+    if heartbeat is not None:
+        # a changing ctime of the heartbeat file tells the master the IOLoop is running
+        modes = itertools.cycle((0o400, 0o600))
+        PeriodicCallback(lambda: os.fchmod(heartbeat.fileno(), next(modes)), 1000).start()
+    io_loop.start()
+
+
+class Master(object):
+    """ Forks the worker processes and replaces them when they exit or don't report back """
+
+    def __init__(self, app, sockets, processes, max_requests):
+        self.app = app
+        self.sockets = sockets
+        self.processes = processes
+        self.max_requests = max_requests
+        self.workers = {}  # pid -> heartbeat file
+        self.stopping = False
+        self.reloading = False
+
+    def spawn(self):
+        heartbeat = tempfile.TemporaryFile()
+        # spread the restarts of the processes
+        max_requests = self.max_requests + random.randint(0, self.max_requests // 10) if self.max_requests else 0
+        pid = os.fork()
+        if pid == 0:
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                signal.signal(signum, signal.SIG_DFL)
+            try:
+                run_worker(self.app, self.sockets, heartbeat, max_requests)
+            except Exception:
+                logger.exception('Worker failed')
+                os._exit(1)
+            os._exit(0)
+        self.workers[pid] = heartbeat
+        logger.info('Started worker %d', pid)
+
+    def signal_workers(self, signum):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        self.reloading = False
+        self.signal_workers(signal.SIGTERM)
+
+    def reload(self, signum, frame):
+        """ Gracefully stop all workers and execute the master again, e.g. after changing local_config.py.
+            The forked workers would otherwise run the configuration and code loaded by this process. """
+        if self.stopping:
+            return
+        self.stopping = True
+        self.reloading = True
+        self.signal_workers(signal.SIGTERM)
+
+    def reexec(self):
+        for sock in self.sockets:
+            fd = sock.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) & ~fcntl.FD_CLOEXEC)
+        os.environ[SOCKETS_ENV] = ','.join('%d:%d' % (sock.fileno(), sock.family) for sock in self.sockets)
+        logger.info('Workers stopped, executing the master again')
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not pid:
+                break
+            heartbeat = self.workers.pop(pid, None)
+            if heartbeat is not None:
+                heartbeat.close()
+                logger.info('Worker %d exited with status %d', pid, status)
+
+    def check_health(self):
+        for pid, heartbeat in self.workers.items():
+            if time.time() - os.fstat(heartbeat.fileno()).st_ctime > config.SERVER_HEALTH_TIMEOUT:
+                logger.warning('Worker %d did not report back for %d seconds, killing it', pid,
+                               config.SERVER_HEALTH_TIMEOUT)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        while not self.stopping or self.workers:
+            self.reap()
+            while not self.stopping and len(self.workers) < self.processes:
+                self.spawn()
+            self.check_health()
+            time.sleep(0.5)
+        if self.reloading:
+            self.reexec()
+
+
+def inherited_sockets():
+    """ Returns the listening sockets passed on by the previous master (see Master.reexec) or None """
+    if SOCKETS_ENV not in os.environ:
+        return None
+    sockets = []
+    for item in os.environ.pop(SOCKETS_ENV).split(','):
+        fd, family = map(int, item.split(':'))
+        sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        os.close(fd)
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.fcntl(sock.fileno(), fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        sock.setblocking(0)
+        sockets.append(sock)
+    return sockets
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the clan war attendance tracker with Tornado')
+    parser.add_argument('--port', type=int, default=config.SERVER_PORT)
+    parser.add_argument('--processes', type=int, default=config.SERVER_PROCESSES)
+    parser.add_argument('--max-requests', type=int, default=config.SERVER_MAX_REQUESTS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    app = create_app()
+    sockets = inherited_sockets() or bind_sockets(args.port, config.SERVER_ADDRESS)
+    if args.processes == 1 and not args.max_requests:
+        run_worker(app, sockets)
+        return
+
+    # load the templates and the modules the views import on demand before forking, so the
+    # processes share them instead of each importing them on its first requests
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    for module in ('whyattend.tasks', 'whyattend.wotapi', 'whyattend.analysis', 'pytz'):
+        importlib.import_module(module)
+    Master(app, sockets, args.processes or cpu_count(), args.max_requests).run()
+
 
-http_server = HTTPServer(WSGIContainer(app))
-http_server.listen(5000)
-IOLoop.instance().start()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+"""
+    Replay parsing benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Micro-benchmark for the replay parsing and analysis code paths
+    (replays.parse_replay, replays.player_performance, replays.is_cw and
+    analysis.player_performance).
+
+    The benchmark runs over a corpus of synthetic .wotreplay files that follow
+    the three-block binary layout of real replays (magic number, block count,
+    length-prefixed JSON blocks and the pickled battle result) in both the
+    legacy and the 8.11+ `clientVersionFromExe` formats, for different
+    player counts per team.
+
+    Throughput is reported in replays/s and bytes/s together with the peak
+    memory usage of the process running each benchmark. Results can be stored
+    as baseline and later runs fail with a non-zero exit code when they regress
+    beyond a given threshold:
+
+      python scripts/benchmark_replays.py --save-baseline
+      python scripts/benchmark_replays.py --threshold 0.15
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import random
+import struct
+import shutil
+import resource
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path += ['.', '..']
+
+from whyattend import replays, analysis
+from whyattend.constants import WOT_TANKS
+
+REPLAY_MAGIC = 0x12323411
+
+# clientVersionFromExe values of the supported replay formats
+VERSION_FORMATS = {
+    'legacy': '0, 8, 10, 0',
+    '8.11': '0, 9, 3, 0',
+}
+
+BENCHMARKS = ('parse_replay', 'is_cw', 'replays.player_performance', 'analysis.player_performance')
+
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+
+
+def make_replay(version_format, players_per_team, seed=0):
+    """ Build the binary contents of a synthetic replay file of a clan war
+        between two clans with `players_per_team` players on each side. """
+    rnd = random.Random(seed)
+    tank_ids = sorted(WOT_TANKS.keys())
+    clans = ('OWN', 'ENEMY')
+
+    first_vehicles = {}
+    second_vehicles = {}
+    vehicle_results = {}
+    players = {}
+    for team in (1, 2):
+        for i in xrange(players_per_team):
+            vehicle_id = str(1000 * team + i)
+            account_id = 500000000 + 1000 * team + i
+            name = 'player_%d_%d' % (team, i)
+            vehicle_type = 'country:' + rnd.choice(tank_ids)
+            first_vehicles[vehicle_id] = {
+                'name': name,
+                'team': team,
+                'clanAbbrev': clans[team - 1],
+                'vehicleType': vehicle_type,
+                'isAlive': True,
+            }
+            second_vehicles[vehicle_id] = {
+                'name': name,
+                'team': team,
+                'clanAbbrev': clans[team - 1],
+                'vehicleType': vehicle_type,
+                'isAlive': rnd.random() > 0.5,
+            }
+            vehicle_results[vehicle_id] = {
+                'accountDBID': account_id,
+                'team': team,
+                'damageDealt': rnd.randint(0, 5000),
+                'potentialDamageReceived': rnd.randint(0, 10000),
+                'xp': rnd.randint(0, 2000),
+                'kills': rnd.randint(0, 5),
+                'shots': rnd.randint(0, 30),
+                'pierced': rnd.randint(0, 20),
+                'piercings': rnd.randint(0, 20),
+                'capturePoints': rnd.randint(0, 100),
+                'droppedCapturePoints': rnd.randint(0, 100),
+                'spotted': rnd.randint(0, 10),
+                'deathReason': rnd.choice((-1, 0, 1)),
+                'damageAssistedRadio': rnd.randint(0, 3000),
+                'fortResource': rnd.randint(0, 50),
+            }
+            players[account_id] = {'name': name, 'team': team, 'clanAbbrev': clans[team - 1]}
+
+    first = {
+        'playerName': 'player_1_0',
+        'playerID': 500001000,
+        'mapName': '01_karelia',
+        'mapDisplayName': 'Karelia',
+        'dateTime': '01.02.2014 20:15:00',
+        'battleType': 1,
+        'clientVersionFromExe': VERSION_FORMATS[version_format],
+        'vehicles': first_vehicles,
+    }
+    common = {'winnerTeam': 1, 'duration': rnd.randint(120, 900)}
+    battle_result = {
+        'common': common,
+        'vehicles': dict((vid, [v]) for vid, v in vehicle_results.iteritems()),
+        'players': dict((str(k), v) for k, v in players.iteritems()),
+    }
+    second = [battle_result, second_vehicles, {}]
+    the_pickle = {
+        'common': common,
+        'vehicles': vehicle_results,
+        'players': players,
+    }
+
+    blocks = [json.dumps(first), json.dumps(second), pickle.dumps(the_pickle, 2)]
+    data = struct.pack('II', REPLAY_MAGIC, len(blocks))
+    for block in blocks:
+        data += struct.pack('I', len(block)) + block
+    return data
+
+
+def generate_corpus(path, player_counts, replays_per_variant):
+    """ Write the synthetic replay corpus to `path`, one folder per format and player count.
+        Returns a dictionary mapping (format, player count) to the list of file names. """
+    corpus = {}
+    for version_format in sorted(VERSION_FORMATS):
+        for player_count in player_counts:
+            folder = os.path.join(path, '%s_%d' % (version_format, player_count))
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            files = []
+            for i in xrange(replays_per_variant):
+                filename = os.path.join(folder, '%05d.wotreplay' % i)
+                with open(filename, 'wb') as f:
+                    f.write(make_replay(version_format, player_count, seed=i))
+                files.append(filename)
+            corpus[(version_format, player_count)] = files
+    return corpus
+
+
+class _Player(object):
+    """ Stand-in for model.Player with the attributes analysis.player_performance reads """
+
+    def __init__(self, wot_id):
+        self.wot_id = wot_id
+
+
+class _Replay(object):
+    def __init__(self, replay_pickle):
+        self.replay_pickle = replay_pickle
+
+    def unpickle(self):
+        return pickle.loads(self.replay_pickle)
+
+
+class _Battle(object):
+    """ Stand-in for model.Battle backed by a pickled parsed replay """
+
+    def __init__(self, replay_pickle, players, victory):
+        self.replay = _Replay(replay_pickle)
+        self.players = players
+        self.victory = victory
+
+    def get_players(self):
+        return self.players
+
+
+def _run_parse_replay(blobs):
+    for blob in blobs:
+        replays.parse_replay(blob)
+
+
+def _run_is_cw(parsed):
+    for replay in parsed:
+        replays.is_cw(replay)
+
+
+def _run_replays_player_performance(parsed):
+    for replay in parsed:
+        replays.player_performance(replay['second'], replay['second'][0]['vehicles'],
+                                   replay['second'][0]['players'])
+
+
+def _run_analysis_player_performance(args):
+    battles, players = args
+    analysis.player_performance(battles, players)
+
+
+def _prepare(benchmark, files):
+    blobs = [open(f, 'rb').read() for f in files]
+    if benchmark == 'parse_replay':
+        return _run_parse_replay, blobs, blobs
+    parsed = [replays.parse_replay(blob) for blob in blobs]
+    if benchmark == 'is_cw':
+        return _run_is_cw, parsed, blobs
+    if benchmark == 'replays.player_performance':
+        return _run_replays_player_performance, parsed, blobs
+
+    players_by_wot_id = {}
+    battles = []
+    for replay in parsed:
+        own_team = replays.get_own_team(replay)
+        battle_players = []
+        for account_id, info in replay['second'][0]['players'].iteritems():
+            if info['team'] != own_team:
+                continue
+            if account_id not in players_by_wot_id:
+                players_by_wot_id[account_id] = _Player(account_id)
+            battle_players.append(players_by_wot_id[account_id])
+        battles.append(_Battle(pickle.dumps(replay), battle_players, replays.player_won(replay)))
+    return _run_analysis_player_performance, (battles, players_by_wot_id.values()), blobs
+
+
+def _measure(benchmark, files, repeat, queue):
+    """ Runs in a child process so the peak memory usage belongs to this benchmark alone """
+    func, data, blobs = _prepare(benchmark, files)
+    timings = []
+    for _ in xrange(repeat):
+        start = time.time()
+        func(data)
+        timings.append(time.time() - start)
+    best = min(timings) or 1e-9
+    total_bytes = sum(len(blob) for blob in blobs)
+    queue.put({
+        'replays_per_s': len(blobs) / best,
+        'bytes_per_s': total_bytes / best,
+        # ru_maxrss is reported in kilobytes on Linux
+        'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+
+
+def run_benchmarks(corpus, repeat):
+    results = {}
+    for (version_format, player_count), files in sorted(corpus.iteritems()):
+        for benchmark in BENCHMARKS:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_measure, args=(benchmark, files, repeat, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            key = '%s/%s/%d' % (benchmark, version_format, player_count)
+            results[key] = result
+            print '%-45s %10.1f replays/s %10.2f MB/s %8.1f MB peak' % (
+                key, result['replays_per_s'], result['bytes_per_s'] / (1024.0 * 1024.0),
+                result['peak_memory_kb'] / 1024.0)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Returns a list of regressions of the results compared to the baseline """
+    regressions = []
+    for key, result in sorted(results.iteritems()):
+        if key not in baseline:
+            continue
+        expected = baseline[key]
+        if result['replays_per_s'] < expected['replays_per_s'] * (1.0 - threshold):
+            regressions.append('%s: throughput %.1f replays/s, baseline %.1f replays/s' % (
+                key, result['replays_per_s'], expected['replays_per_s']))
+        if result['peak_memory_kb'] > expected['peak_memory_kb'] * (1.0 + threshold):
+            regressions.append('%s: peak memory %d kB, baseline %d kB' % (
+                key, result['peak_memory_kb'], expected['peak_memory_kb']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark replay parsing and analysis')
+    parser.add_argument('--corpus', help='Folder for the synthetic replay corpus (default: temporary folder)')
+    parser.add_argument('--players', default='7,15', help='Comma separated list of players per team')
+    parser.add_argument('--replays', type=int, default=200, help='Number of replays per format and player count')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of each benchmark, the best counts')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline results file')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as new baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Allowed relative regression compared to the baseline (default: 0.1)')
+    args = parser.parse_args()
+
+    player_counts = [int(c) for c in args.players.split(',')]
+    corpus_path = args.corpus or tempfile.mkdtemp(prefix='wotreplays')
+    try:
+        corpus = generate_corpus(corpus_path, player_counts, args.replays)
+        results = run_benchmarks(corpus, args.repeat)
+    finally:
+        if not args.corpus:
+            shutil.rmtree(corpus_path)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print 'Baseline written to', args.baseline
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print 'Performance regressions (threshold %d%%):' % (args.threshold * 100)
+            for regression in regressions:
+                print '  ' + regression
+            return 1
+        print 'No regressions compared to', args.baseline
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
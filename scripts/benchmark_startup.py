@@ -0,0 +1,110 @@
+"""
+    Startup benchmark
+    ~~~~~~~~~~~~~~~~~
+
+    Measures how long it takes to import the modules used by the web server
+    processes and the command line scripts (e.g. import_replays.py imports the
+    model and the replay parser, server processes import the web application
+    and call webapp.create_app).
+
+    Each import runs in a fresh Python interpreter, as the modules are cached
+    after the first import. The time of the import, the number of modules it
+    loaded and the peak memory usage of the interpreter are reported. Results
+    can be stored as baseline and later runs fail with a non-zero exit code
+    when they regress beyond a given threshold:
+
+      python scripts/benchmark_startup.py --save-baseline
+      python scripts/benchmark_startup.py --threshold 0.15
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# Statements run by each benchmark
+BENCHMARKS = (
+    ('model', 'from whyattend import model'),
+    ('import_replays', 'from whyattend.model import db_session, Battle; from whyattend import config, replays'),
+    ('webapp', 'from whyattend import webapp'),
+    ('create_app', 'from whyattend.webapp import create_app; create_app()'),
+)
+
+DEFAULT_BASELINE = 'startup_baseline.json'
+
+MEASURE = '''
+import sys, time, json, resource
+sys.path += ['.', '..']
+modules = len(sys.modules)
+start = time.time()
+exec %r
+print json.dumps({'seconds': time.time() - start, 'modules': len(sys.modules) - modules,
+                  'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+'''
+
+
+def _measure(statement):
+    """ Runs statement in a new interpreter, so no module is imported yet """
+    output = subprocess.check_output([sys.executable, '-c', MEASURE % statement])
+    return json.loads(output.splitlines()[-1])
+
+
+def run_benchmarks(repeat):
+    results = {}
+    for name, statement in BENCHMARKS:
+        runs = [_measure(statement) for _ in xrange(repeat)]
+        result = min(runs, key=lambda run: run['seconds'])
+        results[name] = result
+        print '%-20s %8.1f ms %6d modules %8.1f MB peak' % (name, result['seconds'] * 1000, result['modules'],
+                                                            result['peak_memory_kb'] / 1024.0)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Returns a list of regressions of the results compared to the baseline """
+    regressions = []
+    for key, result in sorted(results.iteritems()):
+        if key not in baseline:
+            continue
+        expected = baseline[key]
+        if result['seconds'] > expected['seconds'] * (1.0 + threshold):
+            regressions.append('%s: import took %.1f ms, baseline %.1f ms' % (
+                key, result['seconds'] * 1000, expected['seconds'] * 1000))
+        if result['modules'] > expected['modules'] * (1.0 + threshold):
+            regressions.append('%s: %d modules loaded, baseline %d' % (key, result['modules'], expected['modules']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the import time of the application')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs of each benchmark, the best counts')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline results file')
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as new baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Allowed relative regression compared to the baseline (default: 0.1)')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.repeat)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print 'Baseline written to', args.baseline
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print 'Startup regressions (threshold %d%%):' % (args.threshold * 100)
+            for regression in regressions:
+                print '  ' + regression
+            return 1
+        print 'No regressions compared to', args.baseline
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
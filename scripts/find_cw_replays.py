@@ -2,34 +2,133 @@
     Script that goes through all .wotreplay files in a folder
     and tries to find CW replays that were not uploaded to the tracker yet
     by comparing the list of players, enemy clan and map name.
+
+    Usage: python find_cw_replays.py <tracker URL> <replay folder>
+
+    Fingerprints of the replay files and the tracker's battles are kept in a
+    local SQLite manifest, so subsequent runs only parse new or changed files
+    and only download the fingerprints added to or removed from the tracker since the last run.
 """
 
-import os, hashlib, urllib2, json, sys
+import os, urllib2, sys, sqlite3, argparse, multiprocessing
 
 sys.path += ['.', '..']
 
 from whyattend import replays
 
-TRACKER_URL = sys.argv[1]
+DEFAULT_MANIFEST = os.path.join(os.path.expanduser('~'), '.find_cw_replays.sqlite')
 
-if __name__ == '__main__':
-    checksums = json.load(urllib2.urlopen(TRACKER_URL + '/api/battle-checksums'))['hashes']
 
-    for root, subfolders, files in os.walk(sys.argv[2]):
+def open_manifest(path):
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE IF NOT EXISTS replay_file (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, '
+               'is_cw INTEGER, fingerprint TEXT)')
+    db.execute('CREATE TABLE IF NOT EXISTS tracker_battle (tracker_url TEXT, fingerprint TEXT, '
+               'PRIMARY KEY (tracker_url, fingerprint))')
+    # tracker_sync stored the last battle ID, the tracker now numbers the changes of its fingerprints
+    db.execute('DROP TABLE IF EXISTS tracker_sync')
+    db.execute('CREATE TABLE IF NOT EXISTS tracker_changes (tracker_url TEXT PRIMARY KEY, last_sequence INTEGER, '
+               'etag TEXT)')
+    return db
+
+
+def sync_checksums(db, tracker_url, full_sync=False):
+    """ Download the fingerprints added to or removed from the tracker since the last run """
+    if full_sync:
+        db.execute('DELETE FROM tracker_battle WHERE tracker_url = ?', (tracker_url, ))
+        db.execute('DELETE FROM tracker_changes WHERE tracker_url = ?', (tracker_url, ))
+    row = db.execute('SELECT last_sequence, etag FROM tracker_changes WHERE tracker_url = ?',
+                     (tracker_url, )).fetchone()
+    last_sequence, etag = row if row else (0, None)
+
+    request = urllib2.Request(tracker_url + '/api/battle-checksums?format=text&since=%d' % last_sequence)
+    if etag:
+        request.add_header('If-None-Match', etag)
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+        if e.code == 304:
+            return
+        raise
+
+    hashes = [h for h in response.read().split('\n') if h]
+    db.executemany('INSERT OR IGNORE INTO tracker_battle (tracker_url, fingerprint) VALUES (?, ?)',
+                   [(tracker_url, h) for h in hashes if not h.startswith('-')])
+    db.executemany('DELETE FROM tracker_battle WHERE tracker_url = ? AND fingerprint = ?',
+                   [(tracker_url, h[1:]) for h in hashes if h.startswith('-')])
+    last_sequence = int(response.info().getheader('X-Last-Sequence', last_sequence))
+    db.execute('INSERT OR REPLACE INTO tracker_changes (tracker_url, last_sequence, etag) VALUES (?, ?, ?)',
+               (tracker_url, last_sequence, response.info().getheader('ETag')))
+    db.commit()
+
+
+def fingerprint_file(args):
+    """ Parse a replay file and return (path, mtime, size, is_cw, fingerprint).
+        Runs in the worker processes. """
+    path, mtime, size = args
+    try:
+        replay = replays.parse_replay(open(path, 'rb').read())
+        if not replay or not replays.is_cw(replay):
+            return path, mtime, size, False, None
+        return path, mtime, size, True, replays.battle_fingerprint(replay)
+    except Exception:
+        return path, mtime, size, False, None
+
+
+def scan_folder(db, folder, processes=None):
+    """ Update the manifest with all replay files in the folder, parsing only new or changed files """
+    known = dict((path, (mtime, size)) for path, mtime, size in
+                 db.execute('SELECT path, mtime, size FROM replay_file'))
+    found = set()
+    changed = []
+    for root, subfolders, files in os.walk(folder):
         for file in files:
             if not file.endswith('.wotreplay'): continue
-            try:
-                replay_blob = open(os.path.join(root, file), 'rb').read()
-                replay = replays.parse_replay(replay_blob)
-                if not replays.is_cw(replay): continue
-
-                hash = hashlib.sha1()
-                hash.update(''.join(sorted(replays.player_team(replay))))
-                hash.update(replays.guess_enemy_clan(replay))
-                hash.update(replay['first']['mapName'])
-
-                if hash.hexdigest() not in checksums:
-                    print file, 'is an unknown CW replay!'
-            except Exception as e:
-                pass
-                #print "Error processing " + file + " " + str(e)
+            path = os.path.abspath(os.path.join(root, file))
+            stat = os.stat(path)
+            found.add(path)
+            if known.get(path) != (stat.st_mtime, stat.st_size):
+                changed.append((path, stat.st_mtime, stat.st_size))
+
+    if changed:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.imap_unordered(fingerprint_file, changed, chunksize=16)
+            db.executemany('INSERT OR REPLACE INTO replay_file (path, mtime, size, is_cw, fingerprint) '
+                           'VALUES (?, ?, ?, ?, ?)', results)
+        finally:
+            pool.close()
+            pool.join()
+
+    folder_prefix = os.path.join(os.path.abspath(folder), '')
+    db.executemany('DELETE FROM replay_file WHERE path = ?',
+                   [(path, ) for path in known if path.startswith(folder_prefix) and path not in found])
+    db.commit()
+    return len(found), len(changed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find CW replays that were not uploaded to the tracker yet')
+    parser.add_argument('tracker_url')
+    parser.add_argument('folder')
+    parser.add_argument('--manifest', default=DEFAULT_MANIFEST, help='Manifest file (default: %(default)s)')
+    parser.add_argument('--processes', type=int, default=None, help='Number of parser processes (default: #CPUs)')
+    parser.add_argument('--full-sync', action='store_true', help='Download all fingerprints from the tracker again')
+    args = parser.parse_args()
+
+    db = open_manifest(args.manifest)
+    sync_checksums(db, args.tracker_url, args.full_sync)
+    total, parsed = scan_folder(db, args.folder, args.processes)
+    print >>sys.stderr, 'Scanned %d replay files, parsed %d new or changed files' % (total, parsed)
+
+    folder_prefix = os.path.join(os.path.abspath(args.folder), '')
+    unknown = db.execute('SELECT path FROM replay_file WHERE is_cw AND fingerprint IS NOT NULL '
+                         'AND fingerprint NOT IN (SELECT fingerprint FROM tracker_battle WHERE tracker_url = ?) '
+                         'ORDER BY path', (args.tracker_url, ))
+    for path, in unknown:
+        if path.startswith(folder_prefix):
+            print os.path.relpath(path, args.folder), 'is an unknown CW replay!'
+
+
+if __name__ == '__main__':
+    main()
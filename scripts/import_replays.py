@@ -16,6 +16,8 @@ from whyattend import config, replays
 if __name__ == '__main__':
     for root, subfolders, files in os.walk(config.UPLOAD_FOLDER):
         for file in files:
+            if not file.endswith('.wotreplay'):
+                continue
             try:
                 replay_blob = open(os.path.join(root, file), 'rb').read()
                 replay = replays.parse_replay(replay_blob)
@@ -38,8 +40,10 @@ if __name__ == '__main__':
                     continue
 
                 battle.replay.replay_blob = replay_blob
+                battle.invalidate_view_model()
                 print "Adding replay " + file + " for battle " + str(battle.id) + " " + battle.enemy_clan
                 db_session.add(battle.replay)
+                db_session.add(battle)
                 db_session.commit()
             except Exception as e:
                 print "Error processing " + file + " " + str(e)
@@ -3,7 +3,7 @@
     DO NOT use this for application deployment.
 """
 
-from whyattend.webapp import app
+from whyattend.webapp import create_app
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', debug=True)
+    create_app().run(host='0.0.0.0', debug=True)
@@ -0,0 +1,51 @@
+"""Battle fingerprint index
+
+Revision ID: 1f8d3b6c0a27
+Revises: 4c1e7a9d2b3f
+Create Date: 2026-10-19 11:02:15.840312
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f8d3b6c0a27'
+down_revision = '4c1e7a9d2b3f'
+
+import pickle
+
+from alembic import op
+import sqlalchemy as sa
+
+from whyattend import replays
+
+battle = sa.table('battle',
+                  sa.column('id', sa.Integer),
+                  sa.column('replay_id', sa.Integer),
+                  sa.column('fingerprint', sa.String))
+replay = sa.table('replay',
+                  sa.column('id', sa.Integer),
+                  sa.column('replay_pickle', sa.Binary))
+
+
+def upgrade():
+    op.add_column('battle', sa.Column('fingerprint', sa.String(length=40), nullable=True))
+    op.create_index('ix_battle_fingerprint', 'battle', ['fingerprint'])
+
+    # Compute fingerprints from existing replay pickles
+    connection = op.get_bind()
+    rows = connection.execute(sa.select([battle.c.id, replay.c.replay_pickle])
+                              .select_from(battle.join(replay, battle.c.replay_id == replay.c.id))).fetchall()
+    for battle_id, replay_pickle in rows:
+        if not replay_pickle:
+            continue
+        try:
+            replay_data = pickle.loads(replay_pickle)
+            fingerprint = replays.battle_fingerprint(replay_data) if replay_data else None
+        except Exception as e:
+            print "Error parsing pickle of battle " + str(battle_id), e
+            continue
+        connection.execute(battle.update().where(battle.c.id == battle_id).values(fingerprint=fingerprint))
+
+
+def downgrade():
+    op.drop_index('ix_battle_fingerprint', 'battle')
+    op.drop_column('battle', 'fingerprint')
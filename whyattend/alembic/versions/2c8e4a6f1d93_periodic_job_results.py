@@ -0,0 +1,22 @@
+"""Periodic job results
+
+Revision ID: 2c8e4a6f1d93
+Revises: 9b3d5e1f7a42
+Create Date: 2026-10-19 15:02:11.847310
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2c8e4a6f1d93'
+down_revision = '9b3d5e1f7a42'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('webapp_data', sa.Column('job_results', sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('webapp_data', 'job_results')
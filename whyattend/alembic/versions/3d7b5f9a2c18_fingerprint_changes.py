@@ -0,0 +1,44 @@
+"""Log of battle fingerprint changes
+
+Revision ID: 3d7b5f9a2c18
+Revises: 6f2a8c4e1b57
+Create Date: 2026-10-20 10:12:43.271905
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3d7b5f9a2c18'
+down_revision = '6f2a8c4e1b57'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('fingerprint_sequence',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('value', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_table('fingerprint_change',
+                    sa.Column('sequence', sa.Integer(), autoincrement=False, nullable=False),
+                    sa.Column('fingerprint', sa.String(length=40), nullable=True),
+                    sa.Column('removed', sa.Boolean(), nullable=False),
+                    sa.PrimaryKeyConstraint('sequence'))
+
+    # the existing fingerprints are the first changes
+    battle = sa.table('battle', sa.column('id', sa.Integer), sa.column('fingerprint', sa.String))
+    connection = op.get_bind()
+    fingerprints = [fingerprint for fingerprint, in connection.execute(
+        sa.select([battle.c.fingerprint]).where(battle.c.fingerprint != None).order_by(battle.c.id))]
+    if fingerprints:
+        change = sa.table('fingerprint_change', sa.column('sequence', sa.Integer),
+                          sa.column('fingerprint', sa.String), sa.column('removed', sa.Boolean))
+        op.bulk_insert(change, [{'sequence': sequence, 'fingerprint': fingerprint, 'removed': False}
+                                for sequence, fingerprint in enumerate(fingerprints, 1)])
+    op.bulk_insert(sa.table('fingerprint_sequence', sa.column('id', sa.Integer), sa.column('value', sa.Integer)),
+                   [{'id': 1, 'value': len(fingerprints)}])
+
+
+def downgrade():
+    op.drop_table('fingerprint_change')
+    op.drop_table('fingerprint_sequence')
@@ -0,0 +1,25 @@
+"""Battle view model cache
+
+Revision ID: 4c1e7a9d2b3f
+Revises: 2413542ce715
+Create Date: 2026-10-19 10:12:41.203118
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c1e7a9d2b3f'
+down_revision = '2413542ce715'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Both columns are filled lazily when a battle is viewed for the first time
+    op.add_column('battle', sa.Column('view_cache', sa.Binary(), nullable=True))
+    op.add_column('replay', sa.Column('summary_pickle', sa.Binary(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('replay', 'summary_pickle')
+    op.drop_column('battle', 'view_cache')
@@ -0,0 +1,52 @@
+"""Battle group membership cache
+
+Revision ID: 5e9b1d3f7a64
+Revises: 8a4c2e6f0b31
+Create Date: 2026-10-19 21:07:14.582306
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e9b1d3f7a64'
+down_revision = '8a4c2e6f0b31'
+
+import pickle
+
+from alembic import op
+import sqlalchemy as sa
+
+battlegroup = sa.table('battlegroup',
+                       sa.column('id', sa.Integer),
+                       sa.column('members_cache', sa.Binary))
+battle = sa.table('battle',
+                  sa.column('id', sa.Integer),
+                  sa.column('battle_group_id', sa.Integer))
+attendance = sa.table('player_battle',
+                      sa.column('battle_id', sa.Integer),
+                      sa.column('player_id', sa.Integer),
+                      sa.column('reserve', sa.Boolean))
+
+
+def upgrade():
+    # Written whenever a change to a group is committed (see model.BattleGroup.invalidate_members),
+    # the existing groups are filled in here
+    op.add_column('battlegroup', sa.Column('members_cache', sa.Binary(), nullable=True))
+
+    connection = op.get_bind()
+    members = dict((bg_id, {'players': set(), 'reserves': set()})
+                   for bg_id, in connection.execute(sa.select([battlegroup.c.id])))
+    rows = connection.execute(sa.select([battle.c.battle_group_id, attendance.c.player_id, attendance.c.reserve])
+                              .select_from(attendance.join(battle, attendance.c.battle_id == battle.c.id))
+                              .where(battle.c.battle_group_id != None).distinct())
+    for bg_id, player_id, reserve in rows:
+        if bg_id in members:
+            members[bg_id]['reserves' if reserve else 'players'].add(player_id)
+    if members:
+        connection.execute(battlegroup.update().where(battlegroup.c.id == sa.bindparam('bg_id'))
+                           .values(members_cache=sa.bindparam('members')),
+                           [{'bg_id': bg_id, 'members': pickle.dumps(bg_members, pickle.HIGHEST_PROTOCOL)}
+                            for bg_id, bg_members in members.iteritems()])
+
+
+def downgrade():
+    op.drop_column('battlegroup', 'members_cache')
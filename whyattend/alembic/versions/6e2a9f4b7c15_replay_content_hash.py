@@ -0,0 +1,41 @@
+"""Replay content hash
+
+Revision ID: 6e2a9f4b7c15
+Revises: 1f8d3b6c0a27
+Create Date: 2026-10-19 12:48:03.517904
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6e2a9f4b7c15'
+down_revision = '1f8d3b6c0a27'
+
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+replay = sa.table('replay',
+                  sa.column('id', sa.Integer),
+                  sa.column('replay_blob', sa.Binary),
+                  sa.column('content_hash', sa.String))
+
+
+def upgrade():
+    op.add_column('replay', sa.Column('content_hash', sa.String(length=40), nullable=True))
+    op.create_index('ix_replay_content_hash', 'replay', ['content_hash'])
+
+    # Checksums of the stored replay files, loaded one at a time
+    connection = op.get_bind()
+    replay_ids = [row[0] for row in connection.execute(
+        sa.select([replay.c.id]).where(replay.c.replay_blob != None))]
+    for replay_id in replay_ids:
+        replay_blob = connection.execute(sa.select([replay.c.replay_blob])
+                                         .where(replay.c.id == replay_id)).scalar()
+        connection.execute(replay.update().where(replay.c.id == replay_id)
+                           .values(content_hash=hashlib.sha1(replay_blob).hexdigest()))
+
+
+def downgrade():
+    op.drop_index('ix_replay_content_hash', 'replay')
+    op.drop_column('replay', 'content_hash')
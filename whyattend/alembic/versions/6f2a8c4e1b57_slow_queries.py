@@ -0,0 +1,34 @@
+"""Slow query log
+
+Revision ID: 6f2a8c4e1b57
+Revises: 5e9b1d3f7a64
+Create Date: 2026-10-19 22:31:05.114872
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6f2a8c4e1b57'
+down_revision = '5e9b1d3f7a64'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('slow_query',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('checksum', sa.String(length=40), nullable=True),
+                    sa.Column('endpoint', sa.String(length=100), nullable=True),
+                    sa.Column('statement', sa.Text(), nullable=True),
+                    sa.Column('count', sa.Integer(), nullable=True),
+                    sa.Column('failed', sa.Integer(), nullable=True),
+                    sa.Column('total_time', sa.Float(), nullable=True),
+                    sa.Column('max_time', sa.Float(), nullable=True),
+                    sa.Column('last_parameters', sa.Text(), nullable=True),
+                    sa.Column('last_date', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('checksum'))
+
+
+def downgrade():
+    op.drop_table('slow_query')
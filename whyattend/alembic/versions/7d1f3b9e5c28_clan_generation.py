@@ -0,0 +1,26 @@
+"""Clan data generation for the page cache
+
+Revision ID: 7d1f3b9e5c28
+Revises: 2c8e4a6f1d93
+Create Date: 2026-10-19 15:48:26.301947
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7d1f3b9e5c28'
+down_revision = '2c8e4a6f1d93'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('clan_generation',
+                    sa.Column('clan', sa.String(length=10), nullable=False),
+                    sa.Column('generation', sa.Integer(), nullable=False),
+                    sa.Column('attendance_generation', sa.Integer(), nullable=False, server_default='0'),
+                    sa.PrimaryKeyConstraint('clan'))
+
+
+def downgrade():
+    op.drop_table('clan_generation')
@@ -0,0 +1,61 @@
+"""Saved payout runs
+
+Revision ID: 8a4c2e6f0b31
+Revises: 7d1f3b9e5c28
+Create Date: 2026-10-19 18:02:41.519360
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8a4c2e6f0b31'
+down_revision = '7d1f3b9e5c28'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('payout_run',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('clan', sa.String(length=10), nullable=True),
+                    sa.Column('date', sa.DateTime(), nullable=True),
+                    sa.Column('creator_id', sa.Integer(), nullable=True),
+                    sa.Column('from_date', sa.DateTime(), nullable=True),
+                    sa.Column('to_date', sa.DateTime(), nullable=True),
+                    sa.Column('victories_only', sa.Boolean(), nullable=True),
+                    sa.Column('gold', sa.Integer(), nullable=True),
+                    sa.Column('recruit_factor', sa.Float(), nullable=True),
+                    sa.Column('points_per_resource', sa.Float(), nullable=True),
+                    sa.Column('attendance_generation', sa.Integer(), nullable=True),
+                    sa.Column('paid', sa.Boolean(), nullable=True),
+                    sa.ForeignKeyConstraint(['creator_id'], ['player.id'], ondelete='set null'),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_table('payout_run_battle',
+                    sa.Column('run_id', sa.Integer(), nullable=False),
+                    sa.Column('battle_id', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['run_id'], ['payout_run.id'], ondelete='cascade'),
+                    sa.ForeignKeyConstraint(['battle_id'], ['battle.id'], ondelete='cascade'),
+                    sa.PrimaryKeyConstraint('run_id', 'battle_id'))
+    op.create_table('payout_run_player',
+                    sa.Column('run_id', sa.Integer(), nullable=False),
+                    sa.Column('player_id', sa.Integer(), nullable=False),
+                    sa.Column('fced_win', sa.Integer(), nullable=True),
+                    sa.Column('fced_draws', sa.Integer(), nullable=True),
+                    sa.Column('fced_defeat', sa.Integer(), nullable=True),
+                    sa.Column('played', sa.Integer(), nullable=True),
+                    sa.Column('victories', sa.Integer(), nullable=True),
+                    sa.Column('draws', sa.Integer(), nullable=True),
+                    sa.Column('defeats', sa.Integer(), nullable=True),
+                    sa.Column('reserve', sa.Integer(), nullable=True),
+                    sa.Column('resources', sa.Integer(), nullable=True),
+                    sa.Column('points', sa.Float(), nullable=True),
+                    sa.Column('gold', sa.Integer(), nullable=True),
+                    sa.ForeignKeyConstraint(['run_id'], ['payout_run.id'], ondelete='cascade'),
+                    sa.ForeignKeyConstraint(['player_id'], ['player.id']),
+                    sa.PrimaryKeyConstraint('run_id', 'player_id'))
+
+
+def downgrade():
+    op.drop_table('payout_run_player')
+    op.drop_table('payout_run_battle')
+    op.drop_table('payout_run')
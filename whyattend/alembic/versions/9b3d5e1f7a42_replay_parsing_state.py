@@ -0,0 +1,24 @@
+"""Replay parsing state
+
+Revision ID: 9b3d5e1f7a42
+Revises: 6e2a9f4b7c15
+Create Date: 2026-10-19 14:21:37.120584
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9b3d5e1f7a42'
+down_revision = '6e2a9f4b7c15'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('replay', sa.Column('pending', sa.Boolean(), nullable=True))
+    op.add_column('replay', sa.Column('parse_error', sa.String(length=200), nullable=True))
+
+
+def downgrade():
+    op.drop_column('replay', 'parse_error')
+    op.drop_column('replay', 'pending')
@@ -19,6 +19,29 @@ USER_TIMEZONES = ('Europe/Amsterdam',
 
 # Database URI (see http://docs.sqlalchemy.org/en/latest/core/engines.html#supported-databases)
 DATABASE_URI = 'mysql://user@host/database?charset=utf8&use_unicode=0'  # forces UTF-8 encoding in DB
+# Optional read-only replica of the database. If set, GET requests of the read-only pages (statistics,
+# player lists, battle lists, ...) query the replica while all writes go to DATABASE_URI.
+DATABASE_READ_URI = None
+# Connection pool of each database: connections kept open, additional connections allowed under load,
+# seconds to wait for a free connection and seconds after which connections are replaced.
+# The pool size settings are ignored for SQLite.
+DATABASE_POOL_SIZE = 5
+DATABASE_MAX_OVERFLOW = 10
+DATABASE_POOL_TIMEOUT = 30
+DATABASE_POOL_RECYCLE = 3600
+# Test pooled connections before using them, e.g. after the database server restarted
+DATABASE_PRE_PING = True
+# Maximum duration of a single SQL statement in seconds (None for no limit) and the limits of
+# particular views by endpoint name, e.g. {'reserve_conflicts': 60}, see querylog.py
+STATEMENT_TIMEOUT = 30
+STATEMENT_TIMEOUTS = {}
+# Statements taking longer than this many seconds are logged and listed on the administration
+# page (None to disable)
+SLOW_QUERY_THRESHOLD = 1.0
+
+# Raise model.LazyLoadError when a page touches a relationship its query's loading profile
+# (e.g. Battle.with_roster) did not load. Meant for development to catch N+1 query patterns.
+RAISE_ON_LAZY_LOAD = False
 
 # Path to temporary folder for OpenID authentication files
 OID_STORE_PATH = 'tmp/oid'
@@ -36,6 +59,8 @@ CLAN_IDS = {
 
 # Temporary folder for uploaded replays
 UPLOAD_FOLDER = 'tmp/uploads'
+# Larger replay uploads are rejected (bytes, None: no limit)
+MAX_REPLAY_SIZE = 10 * 1024 * 1024
 
 # Wargaming.net API token and base URL
 # API tokens can be generated using the Wargaming Developer Partner program
@@ -93,9 +118,63 @@ LOG_FILE = '/tmp/whyattend.log'
 
 # Celery task queue settings
 # See http://docs.celeryproject.org/en/latest/getting-started/first-steps-with-celery.html#choosing-a-broker
-# Currently not really used.
 CELERY_BROKER_URL = 'redis://localhost:6379'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379'
+# Run tasks (e.g. parsing uploaded replays) in the web application process instead of
+# sending them to workers. Set to False when workers are started with
+#   celery -A whyattend.tasks worker
+CELERY_ALWAYS_EAGER = True
+
+# Periodic jobs (clan member synchronisation of all CLAN_IDS, refreshing the cached Wargaming
+# data and statistics pages). None to disable them, 'thread' to run them in a thread of the
+# web application process or 'celery' to schedule them with celery beat:
+#   celery -A whyattend.tasks worker --beat
+# With 'celery' the warmed caches are only seen by the web application if it uses a cache
+# backend shared between processes.
+SCHEDULER = None
+# Interval of each periodic job in seconds. Cached Wargaming data expires after 60 seconds,
+# so warm_caches should run more often than that.
+SCHEDULE = {
+    'sync_players': 6 * 60 * 60,
+    'warm_caches': 45,
+}
+# Tornado server (runtornado.py): address and port to listen on, threads handling requests in each
+# process and number of processes (0 for one per CPU core, see CACHE_CONFIG). On SIGTERM or SIGINT
+# running requests get up to SERVER_SHUTDOWN_TIMEOUT seconds to finish. Set SERVER_XHEADERS to True
+# behind a reverse proxy that sets the X-Real-Ip/X-Forwarded-For headers.
+SERVER_ADDRESS = ''
+SERVER_PORT = 5000
+SERVER_THREADS = 8
+SERVER_PROCESSES = 1
+SERVER_SHUTDOWN_TIMEOUT = 30
+SERVER_XHEADERS = False
+# With several processes (or SERVER_MAX_REQUESTS) a master process supervises them: processes are
+# replaced after handling SERVER_MAX_REQUESTS requests (0: never) or when they haven't reported
+# back for SERVER_HEALTH_TIMEOUT seconds.
+SERVER_MAX_REQUESTS = 0
+SERVER_HEALTH_TIMEOUT = 30
+
+# Flask-Cache backend for cached Wargaming data and pages. 'simple' keeps a separate cache in every
+# process; to share it between the processes of the server use e.g.
+#   {'CACHE_TYPE': 'filesystem', 'CACHE_DIR': '/tmp/whyattend-cache'}
+#   {'CACHE_TYPE': 'whyattend.sqlitecache.sqlite', 'CACHE_SQLITE_PATH': '/tmp/whyattend-cache.sqlite'}
+#   {'CACHE_TYPE': 'redis', 'CACHE_REDIS_URL': 'redis://localhost:6379/1'}
+CACHE_CONFIG = {'CACHE_TYPE': 'simple'}
+
+# Cache of expensive pages (clan statistics, players, performance), see pagecache.py.
+# Number of entries kept in each process and seconds they are kept.
+PAGE_CACHE_SIZE = 200
+PAGE_CACHE_TIMEOUT = 60 * 60
+
+# Number of battles per page of the battle history on the profile page
+PROFILE_BATTLES_PER_PAGE = 50
+
+# Compress text responses of at least COMPRESS_MIN_SIZE bytes if the client supports it (zlib level 1-9).
+# Disable by setting COMPRESS_MIN_SIZE to None, e.g. if the reverse proxy compresses responses.
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+COMPRESS_MIMETYPES = ('text/html', 'text/plain', 'text/csv', 'text/css', 'application/json',
+                      'application/javascript')
 
 # Customize the "Links" menu shown in the tracker
 MENU_LINKS = [
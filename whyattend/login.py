@@ -0,0 +1,118 @@
+"""
+    OpenID login
+    ~~~~~~~~~~~~
+
+    Login, logout and profile creation views. They are registered by webapp.create_app,
+    so scripts importing the web application don't load the OpenID library.
+"""
+
+import datetime
+
+from flask import g, session, render_template, flash, redirect, request, url_for
+from flask_openid import OpenID
+
+from . import config, wotapi
+from .model import Player, ClanGeneration, db_session
+from .webapp import app, logger, require_login
+
+oid = OpenID(fs_store_path=config.OID_STORE_PATH)
+
+
+@app.route('/login', methods=['GET', 'POST'])
+@oid.loginhandler
+def login():
+    """
+        Login page.
+    :return:
+    """
+    if g.player is not None:
+        return redirect(oid.get_next_url())
+    if request.method == 'POST':
+        openid = request.form.get('openid', "http://eu.wargaming.net/id")
+        if openid:
+            return oid.try_login(openid, ask_for=['nickname'])
+    return render_template('login.html', next=oid.get_next_url(),
+                           error=oid.fetch_error())
+
+
+@oid.after_login
+def create_or_login(resp):
+    """
+        This is called when login with OpenID succeeded and it's not
+        necessary to figure out if this is the users's first login or not.
+        This function has to redirect otherwise the user will be presented
+        with a terrible URL which we certainly don't want.
+    """
+    session['openid'] = resp.identity_url
+    session['nickname'] = resp.nickname
+    player = Player.query.filter_by(openid=resp.identity_url, locked=False).first()
+    if player is not None:
+        flash(u'Signed in successfully', 'success')
+        session.permanent = True
+        g.player = player
+        return redirect(oid.get_next_url())
+    return redirect(url_for('create_profile', next=oid.get_next_url(),
+                            name=resp.nickname))
+
+
+@app.route('/create-profile', methods=['GET', 'POST'])
+def create_profile():
+    """
+        If this is the user's first login, the create_or_login function
+        will redirect here so that the user can set up his profile.
+    """
+    if g.player is not None or 'openid' not in session or 'nickname' not in session:
+        return redirect(url_for('index'))
+    if request.method == 'POST':
+        wot_id = [x for x in session['openid'].split('/') if x][-1].split('-')[0]
+        if not wot_id:
+            flash(u'Error: Could not determine your player ID from the OpenID string. Contact an admin for help :-)',
+                  'error')
+            return render_template('create_profile.html', next_url=oid.get_next_url())
+
+        player_data = wotapi.get_player(wot_id)
+        player_clan_info = wotapi.get_players_membership_info([wot_id])
+        if not player_data or not player_data['data'][str(wot_id)]:
+            flash(u'Error: Could not retrieve player information from Wargaming. Contact an admin for help :-)',
+                  'error')
+            return render_template('create_profile.html', next_url=oid.get_next_url())
+
+        clan_ids_to_name = dict((v, k) for k, v in config.CLAN_IDS.iteritems())
+        clan_id = str(player_clan_info['data'][str(wot_id)]['clan']['clan_id'])
+
+        if clan_id not in config.CLAN_IDS.values():
+            flash(u'You have to be in one of the clans to login', 'error')
+            return render_template('create_profile.html', next_url=oid.get_next_url())
+
+        clan = clan_ids_to_name[str(clan_id)]
+
+        role = player_clan_info['data'][str(wot_id)]['role']
+        member_since = datetime.datetime.fromtimestamp(float(player_clan_info['data'][str(wot_id)]['joined_at']))
+        if not role:
+            flash(u'Error: Could not retrieve player role from wargaming server', 'error')
+            return render_template('create_profile.html', next_url=oid.get_next_url())
+
+        db_session.add(Player(wot_id, session['openid'], member_since, session['nickname'], clan, role))
+        ClanGeneration.bump(clan)
+        db_session.commit()
+        logger.info("New player profile registered [" + session['nickname'] + ", " + clan + ", " + role + "]")
+        flash(u'Welcome!', 'success')
+        return redirect(oid.get_next_url())
+    return render_template('create_profile.html', next_url=oid.get_next_url())
+
+
+@app.route('/logout')
+@require_login
+def logout():
+    """
+        Log out the current user.
+    :return:
+    """
+    session.pop('openid', None)
+    session.pop('nickname', None)
+    g.player = None
+    flash(
+        u'You were signed out from the tracker. You have to sign out from Wargaming\'s '
+        u'website yourself if you wish to do that.',
+        'info')
+    return redirect(oid.get_next_url())
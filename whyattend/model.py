@@ -3,16 +3,116 @@
     ~~~~~~~~~~~~~~~~
 """
 
+import json
+import datetime
 import pickle
+import threading
+from contextlib import contextmanager
+
+from . import config, replays
+
+from sqlalchemy import create_engine, event, exc, select, Column, Integer, String, DateTime, Boolean, ForeignKey, \
+    Text, Binary, Float
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker, deferred, relationship, joinedload, subqueryload, \
+    strategies, strategy_options, Session
+from sqlalchemy.orm.properties import RelationshipProperty
+from sqlalchemy.sql.expression import UpdateBase
+from sqlalchemy.ext.declarative import declarative_base
 
-from . import config
 
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, ForeignKey, Text, Binary
-from sqlalchemy.orm import scoped_session, sessionmaker, deferred, relationship
-from sqlalchemy.ext.declarative import declarative_base
+def _ping_connection(connection, branch):
+    """ engine_connect listener testing pooled connections before use, so connections the database
+        server closed in the meantime are replaced instead of failing the request """
+    if branch:
+        return
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as e:
+        if not e.connection_invalidated:
+            raise
+        # the pool was invalidated, the next statement gets a fresh connection
+        connection.scalar(select([1]))
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+def make_engine(uri):
+    """ Create the engine of the database at uri with the pool settings of config.py """
+    options = dict(convert_unicode=True, pool_recycle=config.DATABASE_POOL_RECYCLE)
+    if not make_url(uri).drivername.startswith('sqlite'):
+        options.update(pool_size=config.DATABASE_POOL_SIZE, max_overflow=config.DATABASE_MAX_OVERFLOW,
+                       pool_timeout=config.DATABASE_POOL_TIMEOUT)
+    new_engine = create_engine(uri, **options)
+    if config.DATABASE_PRE_PING:
+        event.listen(new_engine, 'engine_connect', _ping_connection)
+    return new_engine
+
+
+_engines = {}
+_engine_lock = threading.Lock()
+_engine_listeners = []
+
+
+def get_engine(read=False):
+    """ The engine of config.DATABASE_URI, or with read=True the engine of the optional read-only
+        replica at config.DATABASE_READ_URI (None if not configured), see replica_reads.
+        Engines are created on first use, so importing the model doesn't load the database driver. """
+    uri = config.DATABASE_READ_URI if read else config.DATABASE_URI
+    if not uri:
+        return None
+    with _engine_lock:
+        if read not in _engines:
+            new_engine = make_engine(uri)
+            for listener in _engine_listeners:
+                listener(new_engine)
+            _engines[read] = new_engine
+        return _engines[read]
+
+
+def add_engine_listener(listener):
+    """ Call listener with each engine, the ones already created and the ones created later """
+    with _engine_lock:
+        _engine_listeners.append(listener)
+        for created_engine in _engines.values():
+            listener(created_engine)
+
+
+def dispose_engines():
+    """ Close the pooled connections of the created engines, e.g. in a forked process """
+    with _engine_lock:
+        for created_engine in _engines.values():
+            created_engine.dispose()
+
+
+_routing = threading.local()
+
 
-engine = create_engine(config.DATABASE_URI, convert_unicode=True, pool_recycle=3600)
-db_session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+@contextmanager
+def replica_reads():
+    """ Send the queries of the current thread to the replica engine (if configured) while the block runs.
+        Flushes and other writes still go to the primary database. """
+    previous = getattr(_routing, 'replica', False)
+    _routing.replica = True
+    try:
+        yield
+    finally:
+        _routing.replica = previous
+
+
+class RoutingSession(Session):
+    """ Session choosing the engine per statement: reads inside replica_reads() use the replica """
+
+    def get_bind(self, mapper=None, clause=None):
+        if config.DATABASE_READ_URI and getattr(_routing, 'replica', False) and not self._flushing \
+                and not isinstance(clause, UpdateBase):
+            return get_engine(read=True)
+        return get_engine()
+
+
+db_session = scoped_session(sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False))
 
 Base = declarative_base()
 Base.query = db_session.query_property()
@@ -21,7 +121,40 @@ Base.query = db_session.query_property()
 def init_db():
     """ Creates the database tables from the model class declarations.
     Existing tables will not be overwritten. """
-    Base.metadata.create_all(bind=engine)
+    Base.metadata.create_all(bind=get_engine())
+
+
+class LazyLoadError(Exception):
+    pass
+
+
+@RelationshipProperty.strategy_for(lazy='raise')
+class RaiseLoader(strategies.LazyLoader):
+    """ Like lazy loading but raises LazyLoadError instead of emitting SQL.
+        Objects already in the session's identity map are still returned. """
+
+    def _emit_lazyload(self, *args):
+        raise LazyLoadError('%s is not loaded by the query\'s loading profile' % self.parent_property)
+
+
+def raiseload(*keys):
+    """ Loader option like lazyload(*keys) which makes the relationships raise LazyLoadError when accessed """
+    # Built like the loader options of SQLAlchemy 1.0 (e.g. lazyload) from its private _UnboundLoad class,
+    # SQLAlchemy 1.1 comes with a raiseload option that replaces this
+    return strategy_options._UnboundLoad._from_keys(
+        lambda loadopt, attr: loadopt.set_relationship_strategy(attr, {'lazy': 'raise'}), keys, False, {})
+
+
+def loading_profile(query, *options):
+    """ Apply the loader options of a loading profile to query. If config.RAISE_ON_LAZY_LOAD is set, any
+        other relationship of the query's entity and of the objects the options load raises on access
+        instead of being lazy loaded. """
+    if config.RAISE_ON_LAZY_LOAD:
+        # the relationship path of each option and its prefixes (_UnboundLoad.path in SQLAlchemy 1.0),
+        # e.g. ('battles',) and ('battles', 'attendances') for subqueryload('battles').subqueryload('attendances')
+        paths = set(option.path[:i] for option in options for i in range(1, len(option.path) + 1))
+        options += (raiseload('*'),) + tuple(raiseload(*(path + ('*',))) for path in sorted(paths))
+    return query.options(*options)
 
 
 class Player(Base):
@@ -125,6 +258,9 @@ class Battle(Base):
     map_name = Column(String(80))
     # Which province the battle was for (or provinces, if encounter)
     map_province = Column(String(80))
+    # replays.battle_fingerprint of the battle's replay, used to find replays missing in the database.
+    # Has to be changed with set_fingerprint(), which logs the change for webapp.battle_checksums.
+    fingerprint = Column(String(40), index=True)
 
     battle_commander_id = Column(Integer, ForeignKey('player.id'))
     battle_commander = relationship("Player", backref="battles_commanded", foreign_keys=[battle_commander_id])
@@ -142,6 +278,10 @@ class Battle(Base):
     # Is this the "final battle" of the group? Exactly one per group should be true
     battle_group_final = Column(Boolean)
 
+    # Pickled data displayed on the battle details page (see view_model). Has to be reset with
+    # invalidate_view_model() whenever the battle, its attendances or its replays change.
+    view_cache = deferred(Column(Binary))
+
     def __init__(self, date, clan, enemy_clan, victory, draw, creator, battle_commander, map_name, map_province,
                  duration, description='', paid=False):
         self.date = date
@@ -187,12 +327,76 @@ class Battle(Base):
                 return True
         return False
 
+    def set_fingerprint(self, fingerprint):
+        """ Change the fingerprint (None when the battle is deleted) and log the change in FingerprintChange """
+        if fingerprint == self.fingerprint:
+            return
+        old_fingerprint = self.fingerprint
+        self.fingerprint = fingerprint
+        if old_fingerprint and not db_session.query(Battle.id).filter(Battle.fingerprint == old_fingerprint,
+                                                                       Battle.id != self.id).first():
+            FingerprintChange.record(old_fingerprint, removed=True)
+        if fingerprint:
+            FingerprintChange.record(fingerprint)
+
     def get_players(self):
         return [ba.player for ba in self.attendances if not ba.reserve]
 
     def get_reserve_players(self):
         return [ba.player for ba in self.attendances if ba.reserve]
 
+    def view_model(self):
+        """ Return the data displayed on the battle details page: roster, replay summaries,
+            score and duration. The result is computed once and stored in view_cache. """
+        if self.view_cache is None:
+            self.view_cache = pickle.dumps({
+                'players': sorted(({'id': p.id, 'name': p.name} for p in self.get_players()),
+                                  key=lambda p: p['name']),
+                'reserves': sorted(({'id': p.id, 'name': p.name} for p in self.get_reserve_players()),
+                                   key=lambda p: p['name']),
+                'replay': self.replay.summary() if self.replay else None,
+                'replay_pending': bool(self.replay and self.replay.pending),
+                'replay_error': self.replay.parse_error if self.replay else None,
+                # checked without loading the deferred blob
+                'replay_downloadable': db_session.query(Replay.id).filter(
+                    Replay.id == self.replay_id, Replay.replay_blob.isnot(None)).count() > 0,
+                'additional_replays': [{'id': r.id, 'player_name': r.player_name, 'pending': bool(r.pending),
+                                        'error': r.parse_error} for r in self.additional_replays],
+                'score': (self.score_own_team or 0, self.score_enemy_team or 0),
+                'duration': self.duration,
+            })
+        return pickle.loads(self.view_cache)
+
+    @classmethod
+    def for_listing(cls):
+        """ Query of battles for tables showing the battle commander """
+        return loading_profile(cls.query, joinedload('battle_commander'))
+
+    @classmethod
+    def with_roster(cls):
+        """ Query of battles with their attendances and players, e.g. to count participation """
+        return loading_profile(cls.query, subqueryload('attendances').joinedload('player'))
+
+    @classmethod
+    def with_replay(cls):
+        """ Query of battles with their attendances, players and replay, e.g. for replay statistics """
+        return loading_profile(cls.query, joinedload('replay'), subqueryload('attendances').joinedload('player'))
+
+    def invalidate_view_model(self):
+        self.view_cache = None
+        if self.battle_group:
+            self.battle_group.invalidate_members()
+
+    @classmethod
+    def invalidate_view_models_of(cls, player):
+        """ Reset the view cache of the battles the player attended, e.g. because the player was renamed.
+            Returns the clans of these battles. """
+        attended = db_session.query(BattleAttendance.battle_id).filter(BattleAttendance.player_id == player.id)
+        battles = cls.query.filter(cls.id.in_(attended.subquery()))
+        clans = set(clan for clan, in battles.with_entities(cls.clan).distinct())
+        battles.filter(cls.view_cache != None).update({'view_cache': None}, synchronize_session='fetch')
+        return clans
+
     def __str__(self):
         return "%s vs. %s on %s" % (self.clan, self.enemy_clan, self.map_name)
 
@@ -208,6 +412,10 @@ class BattleGroup(Base):
     description = Column(Text)
     clan = Column(String(10))
     date = Column(DateTime)
+    # pickled sets of the IDs of the players and reserves of all battles in the group. Only written
+    # when changes of the group are committed (see _store_battle_group_members), never by views that
+    # might read from a lagging replica.
+    members_cache = deferred(Column(Binary))
 
     def __init__(self, title, description, clan, date):
         self.title = title
@@ -215,21 +423,65 @@ class BattleGroup(Base):
         self.clan = clan
         self.date = date
 
+    def _members(self):
+        """ Return the membership sets stored in members_cache, or computed by preload_members if there are none """
+        if self.members_cache is not None:
+            return pickle.loads(self.members_cache)
+        if getattr(self, '_computed_members', None) is None:
+            BattleGroup.preload_members([self])
+        return self._computed_members
+
+    @staticmethod
+    def query_members(battle_group_ids, execute=None):
+        """ Dictionary of battle group IDs to their membership sets, computed by a single query
+        :param execute: function executing the query, db_session.execute by default
+        """
+        members = dict((bg_id, {'players': set(), 'reserves': set()}) for bg_id in battle_group_ids)
+        if not members:
+            return members
+        query = select([Battle.battle_group_id, BattleAttendance.player_id, BattleAttendance.reserve]) \
+            .select_from(BattleAttendance.__table__.join(Battle.__table__)) \
+            .where(Battle.battle_group_id.in_(members.keys())).distinct()
+        for bg_id, player_id, reserve in (execute or db_session.execute)(query):
+            members[bg_id]['reserves' if reserve else 'players'].add(player_id)
+        return members
+
+    @staticmethod
+    def preload_members(battle_groups):
+        """ Compute the members of the given battle groups without members_cache with a single query.
+            They are only kept in memory, see members_cache. """
+        missing = dict((bg.id, bg) for bg in battle_groups
+                       if bg.members_cache is None and getattr(bg, '_computed_members', None) is None)
+        for bg_id, members in BattleGroup.query_members(missing.keys()).iteritems():
+            missing[bg_id]._computed_members = members
+
+    @classmethod
+    def with_battles(cls):
+        """ Query of battle groups with their battles, the battles' commanders, attendances and players """
+        return loading_profile(cls.query, subqueryload('battles').joinedload('battle_commander'),
+                               subqueryload('battles').subqueryload('attendances').joinedload('player'))
+
+    def invalidate_members(self):
+        """ Recompute members_cache when the session is committed """
+        self.members_cache = None
+        self._computed_members = None
+        db_session.info.setdefault('stale_battle_groups', set()).add(self)
+
+    def get_player_ids(self):
+        """ IDs of the players that played in any battle of the group """
+        return self._members()['players']
+
+    def get_reserve_ids(self):
+        """ IDs of the players that were reserve in any battle of the group """
+        return self._members()['reserves']
+
     def get_players(self):
-        players = set()
-        for battle in self.battles:
-            for ba in battle.attendances:
-                if not ba.reserve:
-                    players.add(ba.player)
-        return players
+        player_ids = self.get_player_ids()
+        return set(Player.query.filter(Player.id.in_(player_ids)).all()) if player_ids else set()
 
     def get_reserves(self):
-        players = set()
-        for battle in self.battles:
-            for ba in battle.attendances:
-                if ba.reserve:
-                    players.add(ba.player)
-        return players
+        player_ids = self.get_reserve_ids()
+        return set(Player.query.filter(Player.id.in_(player_ids)).all()) if player_ids else set()
 
     def get_final_battle(self):
         for battle in self.battles:
@@ -246,6 +498,22 @@ class BattleGroup(Base):
         return None
 
 
+@event.listens_for(RoutingSession, 'before_commit')
+def _store_battle_group_members(session):
+    """ Store the members_cache of the battle groups invalidated in the transaction, computed on
+        the primary database within the transaction so they include its changes """
+    stale = session.info.pop('stale_battle_groups', None)
+    if not stale:
+        return
+    session.flush()
+    battle_groups = dict((bg.id, bg) for bg in stale if bg in session and bg.id is not None)
+    members = BattleGroup.query_members(battle_groups.keys(),
+                                        lambda query: session.execute(query, bind=get_engine()))
+    for bg_id, bg in battle_groups.iteritems():
+        bg.members_cache = pickle.dumps(members[bg_id], pickle.HIGHEST_PROTOCOL)
+    session.flush()
+
+
 class Replay(Base):
     __tablename__ = 'replay'
     id = Column(Integer, primary_key=True)
@@ -257,20 +525,173 @@ class Replay(Base):
     associated_battle_id = Column(Integer, ForeignKey('battle.id', use_alter=True, name="add_replay_battle_id"))
     associated_battle = relationship("Battle", backref="additional_replays", foreign_keys=[associated_battle_id])
     player_name = Column(String(100))  # Name of the player recording the replay
+    # The data returned by replays.summary as Python pickle
+    summary_pickle = Column(Binary)
+    # SHA-1 checksum of the replay file to detect duplicate uploads
+    content_hash = Column(String(40), index=True)
+    # Set while the replay file is parsed in the background (see tasks.parse_and_attach_replay)
+    pending = Column(Boolean, default=False)
+    # Reason why the replay file was not accepted by the background parsing
+    parse_error = Column(String(200))
 
     def __init__(self, replay_blob, replay_pickle):
         self.replay_pickle = replay_pickle
         self.replay_blob = replay_blob
 
     def unpickle(self):
+        if self.replay_pickle is None:
+            return None  # not parsed (yet)
         return pickle.loads(self.replay_pickle)
 
+    def summary(self):
+        """ Return the condensed replay information (see replays.summary). It is derived from
+            the full replay data only if it wasn't stored along with the replay. """
+        if self.pending:
+            return None
+        if self.summary_pickle is None:
+            replay_data = self.unpickle()
+            self.summary_pickle = pickle.dumps(replays.summary(replay_data) if replay_data else None)
+        return pickle.loads(self.summary_pickle)
+
+
+class ClanGeneration(Base):
+    """
+        Counter of changes to the data of a clan (battles, attendances, players). Cached pages
+        are stored per generation (see pagecache.py), so every change has to bump() it.
+        The attendance generation only counts changes to what the payout counts of existing
+        battles depend on (outcome, commander, attendances, resources), see PayoutRun.
+    """
+    __tablename__ = 'clan_generation'
+    clan = Column(String(10), primary_key=True)
+    generation = Column(Integer, nullable=False, default=0)
+    attendance_generation = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def current(cls, clan):
+        return db_session.query(cls.generation).filter_by(clan=clan).scalar() or 0
+
+    @classmethod
+    def current_attendances(cls, clan):
+        return db_session.query(cls.attendance_generation).filter_by(clan=clan).scalar() or 0
+
+    @classmethod
+    def bump(cls, clan, attendances=False):
+        """ Increment the generation of the clan and with attendances also its attendance generation.
+            Committed along with the changes it belongs to. """
+        values = {cls.generation: cls.generation + 1}
+        if attendances:
+            values[cls.attendance_generation] = cls.attendance_generation + 1
+        if not db_session.query(cls).filter_by(clan=clan).update(values, synchronize_session=False):
+            db_session.add(cls(clan=clan, generation=1, attendance_generation=1 if attendances else 0))
+
+
+class FingerprintSequence(Base):
+    """ Single row counter numbering the FingerprintChanges """
+    __tablename__ = 'fingerprint_sequence'
+    id = Column(Integer, primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def current(cls):
+        return db_session.query(cls.value).filter_by(id=1).scalar() or 0
+
+
+class FingerprintChange(Base):
+    """
+        Log of the battle fingerprints added and removed. Clients pass the sequence number of the
+        last change they have seen to webapp.battle_checksums to only fetch the changes since.
+    """
+    __tablename__ = 'fingerprint_change'
+    sequence = Column(Integer, primary_key=True, autoincrement=False)
+    fingerprint = Column(String(40))
+    removed = Column(Boolean, nullable=False, default=False)
+
+    @classmethod
+    def record(cls, fingerprint, removed=False):
+        """ Log a change, committed along with it. Incrementing the counter locks its row until
+            the commit, so the changes are numbered in the order they are committed and clients
+            never skip a change that is committed later than one with a greater number. """
+        if not db_session.query(FingerprintSequence).filter_by(id=1).update(
+                {FingerprintSequence.value: FingerprintSequence.value + 1}, synchronize_session=False):
+            db_session.add(FingerprintSequence(id=1, value=1))
+            db_session.flush()
+        db_session.add(cls(sequence=FingerprintSequence.current(), fingerprint=fingerprint, removed=removed))
+
+
+class PayoutRun(Base):
+    """
+        A saved payout calculation (see payout.py). Later runs over the same period
+        start from the counts of the last run and only add the battles that are new,
+        as long as the attendance generation of the clan did not change.
+    """
+    __tablename__ = 'payout_run'
+    id = Column(Integer, primary_key=True)
+    clan = Column(String(10))
+    date = Column(DateTime)
+    creator_id = Column(Integer, ForeignKey('player.id', ondelete='set null'), nullable=True)
+    creator = relationship("Player", foreign_keys=[creator_id])
+    # the period as passed to payout.battles_query, i.e. to_date is the day after the last day
+    from_date = Column(DateTime)
+    to_date = Column(DateTime)
+    victories_only = Column(Boolean)
+    gold = Column(Integer)
+    recruit_factor = Column(Float)
+    points_per_resource = Column(Float)
+    # ClanGeneration.attendance_generation of the clan at the time of the run
+    attendance_generation = Column(Integer)
+    # whether the battles were marked as paid and the gold added to Player.gold_earned
+    paid = Column(Boolean, default=False)
+
+    players = relationship("PayoutRunPlayer", backref="run", cascade="all, delete-orphan")
+
+    def last_day(self):
+        return self.to_date - datetime.timedelta(days=1)
+
+    def get_battle_ids(self):
+        battle_ids = db_session.query(PayoutRunBattle.battle_id).filter_by(run_id=self.id)
+        return [battle_id for battle_id, in battle_ids.order_by(PayoutRunBattle.battle_id)]
+
+
+class PayoutRunBattle(Base):
+    __tablename__ = 'payout_run_battle'
+    run_id = Column(Integer, ForeignKey('payout_run.id', ondelete='cascade'), primary_key=True)
+    battle_id = Column(Integer, ForeignKey('battle.id', ondelete='cascade'), primary_key=True)
+
+
+class PayoutRunPlayer(Base):
+    """ The counts (see payout.PlayerCounts), points and gold of a player in a payout run """
+    __tablename__ = 'payout_run_player'
+    run_id = Column(Integer, ForeignKey('payout_run.id', ondelete='cascade'), primary_key=True)
+    player_id = Column(Integer, ForeignKey('player.id'), primary_key=True)
+    player = relationship("Player")
+    fced_win = Column(Integer)
+    fced_draws = Column(Integer)
+    fced_defeat = Column(Integer)
+    played = Column(Integer)
+    victories = Column(Integer)
+    draws = Column(Integer)
+    defeats = Column(Integer)
+    reserve = Column(Integer)
+    resources = Column(Integer)
+    points = Column(Float)
+    gold = Column(Integer)
 
 class WebappData(Base):
     __tablename__ = 'webapp_data'
     id = Column(Integer, primary_key=True)
     last_successful_sync = Column(DateTime)
     last_sync_attempt = Column(DateTime)
+    # Results of the periodic jobs (see scheduler.py) as JSON: job name -> {'time', 'success', 'message'}
+    job_results = Column(Text)
+
+    def get_job_results(self):
+        return json.loads(self.job_results) if self.job_results else {}
+
+    def record_job_result(self, name, success, message=''):
+        results = self.get_job_results()
+        results[name] = {'time': datetime.datetime.now().strftime('%d.%m.%Y %H:%M:%S'), 'success': success,
+                         'message': message}
+        self.job_results = json.dumps(results)
 
     @classmethod
     def get(cls):
@@ -280,3 +701,23 @@ class WebappData(Base):
             db_session.add(data)
             db_session.commit()
         return data
+
+
+class SlowQuery(Base):
+    """ Statements of a view that took longer than config.SLOW_QUERY_THRESHOLD (see querylog.py) """
+    __tablename__ = 'slow_query'
+    id = Column(Integer, primary_key=True)
+    # SHA-1 of endpoint and statement
+    checksum = Column(String(40), unique=True)
+    endpoint = Column(String(100))
+    statement = Column(Text)
+    count = Column(Integer)
+    # executions that failed, e.g. because they exceeded the statement timeout
+    failed = Column(Integer)
+    total_time = Column(Float)
+    max_time = Column(Float)
+    last_parameters = Column(Text)
+    last_date = Column(DateTime)
+
+    def average_time(self):
+        return self.total_time / self.count if self.count else 0
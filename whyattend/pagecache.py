@@ -0,0 +1,73 @@
+"""
+    Page cache
+    ~~~~~~~~~~
+
+    Cache for the results of expensive read-only pages (rendered fragments or the data
+    they are rendered from). Entries are stored per clan and generation of the clan's
+    data (see model.ClanGeneration), so they become obsolete as soon as a change
+    bumps the generation and never have to be deleted explicitly.
+
+    Lookups go to a small in-process LRU first and then to the shared cache backend,
+    which lets processes reuse what another process computed.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+from .model import ClanGeneration
+
+
+class LRUCache(object):
+    """ Thread-safe in-process cache of a limited number of entries with expiry """
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            self._entries[key] = entry  # most recently used
+            return entry[1]
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + timeout, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+class PageCache(object):
+    """
+        :param shared_cache: Flask-Cache instance used as shared backend
+        :param size: number of entries kept in the in-process LRU
+        :param timeout: seconds entries are kept
+    """
+
+    def __init__(self, shared_cache, size, timeout):
+        self.shared_cache = shared_cache
+        self.lru = LRUCache(size)
+        self.timeout = timeout
+
+    def get(self, name, clan, variant, compute):
+        """
+            Return the cached result of compute() for the current generation of the clan's data.
+        :param name: page or fragment name
+        :param clan:
+        :param variant: anything else the result depends on, e.g. role-dependent parts or a date range
+        :param compute: function without arguments computing the result if it is not cached
+        """
+        key = 'page/%s/%s/%s/%d' % (name, clan, variant, ClanGeneration.current(clan))
+        value = self.lru.get(key)
+        if value is None:
+            value = self.shared_cache.get(key)
+            if value is None:
+                value = compute()
+                self.shared_cache.set(key, value, timeout=self.timeout)
+            self.lru.set(key, value, self.timeout)
+        return value
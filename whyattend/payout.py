@@ -0,0 +1,241 @@
+"""
+    Payout calculation
+    ~~~~~~~~~~~~~~~~~~
+
+    Gold payouts are split in two steps. attendance_counts() aggregates what each player
+    did in the battles of a period with a few grouped queries. Its result only depends on
+    the battles, so it can be cached and reused while distribute() is run again with
+    different amounts of gold, recruit factors or points per resource.
+
+    Payout runs can be saved (save_run). incremental_counts() then starts from the counts
+    of the last run over the same period and only aggregates the battles added since,
+    unless the attendance generation of the clan (see model.ClanGeneration) shows that
+    existing battles were changed.
+"""
+
+import datetime
+from collections import namedtuple
+
+from sqlalchemy import or_, and_, case, func, bindparam
+from sqlalchemy.orm import aliased
+
+from .model import Battle, BattleAttendance, Player, PayoutRun, PayoutRunBattle, PayoutRunPlayer, ClanGeneration, \
+    db_session
+
+# What a player did in the battles of a payout period
+PlayerCounts = namedtuple('PlayerCounts', ['fced_win', 'fced_draws', 'fced_defeat', 'played', 'victories', 'draws',
+                                           'defeats', 'reserve', 'resources'])
+NO_COUNTS = PlayerCounts(0, 0, 0, 0, 0, 0, 0, 0, 0)
+
+# Result of attendance_counts: the IDs of the paid out battles and a dictionary of player IDs to PlayerCounts
+AttendanceCounts = namedtuple('AttendanceCounts', ['battle_ids', 'players'])
+
+
+class AlreadyPaid(Exception):
+    """ Raised by save_run if some of the battles were already marked as paid """
+    pass
+
+
+def battles_query(clan, from_date, to_date, victories_only=False, battle=Battle):
+    """
+        Query of the battles paid out for a period. Of landing tournaments only the final
+        battle counts (for the players of all battles of the tournament).
+    :param to_date: end of the period (inclusive)
+    :param battle: Battle or an alias of it
+    """
+    query = db_session.query(battle).filter(battle.clan == clan, battle.date >= from_date, battle.date <= to_date,
+                                            or_(battle.battle_group_id == None, battle.battle_group_final == True))
+    if victories_only:
+        query = query.filter(battle.victory == True)
+    return query
+
+
+def _outcome_sums(battle):
+    """ Columns summing up the victories and draws, the defeats are the rest """
+    return (func.sum(case([(battle.victory == True, 1)], else_=0)),
+            func.sum(case([(battle.victory == True, 0), (battle.draw == True, 1)], else_=0)))
+
+
+def _attendances(battles, selected):
+    """ Subquery of the distinct (battle, player, reserve) attendances of the regular (non-stronghold) battles,
+        for a final of a landing tournament those of all its battles """
+    member = aliased(Battle)
+    return battles.filter(or_(selected.stronghold == False, selected.stronghold == None)) \
+        .join(member, or_(member.id == selected.id,
+                          and_(selected.battle_group_id != None, member.battle_group_id == selected.battle_group_id))) \
+        .join(BattleAttendance, BattleAttendance.battle_id == member.id) \
+        .with_entities(selected.id.label('battle_id'), selected.victory.label('victory'), selected.draw.label('draw'),
+                       selected.battle_commander_id.label('commander_id'),
+                       BattleAttendance.player_id.label('player_id'), BattleAttendance.reserve.label('reserve')) \
+        .distinct().subquery()
+
+
+def _selected_battles(clan, from_date, to_date, victories_only, battle_ids):
+    selected = aliased(Battle)
+    battles = battles_query(clan, from_date, to_date, victories_only, selected)
+    if battle_ids is not None:
+        battles = battles.filter(selected.id.in_(battle_ids))
+    return selected, battles
+
+
+def attendance_counts(clan, from_date, to_date, victories_only=False, battle_ids=None):
+    """
+        Count the commanded, played and reserve battles of each player and the resources earned
+        in stronghold battles within the period.
+    :param battle_ids: only count these battles of the period
+    :return: AttendanceCounts
+    """
+    selected, battles = _selected_battles(clan, from_date, to_date, victories_only, battle_ids)
+    regular = battles.filter(or_(selected.stronghold == False, selected.stronghold == None))
+    counts = {}
+
+    def add(player_id, **values):
+        counts[player_id] = counts.get(player_id, NO_COUNTS)._replace(**values)
+
+    # commanders
+    victories, draws = _outcome_sums(selected)
+    commanded = regular.join(Player, Player.id == selected.battle_commander_id).filter(Player.locked == False) \
+        .with_entities(selected.battle_commander_id, func.count(), victories, draws) \
+        .group_by(selected.battle_commander_id)
+    for player_id, count, victories, draws in commanded:
+        add(player_id, fced_win=int(victories), fced_draws=int(draws), fced_defeat=int(count - victories - draws))
+
+    # players and reserves
+    attendances = _attendances(battles, selected)
+    victories, draws = _outcome_sums(attendances.c)
+    played = db_session.query(attendances.c.player_id, attendances.c.reserve, func.count(), victories, draws) \
+        .join(Player, Player.id == attendances.c.player_id).filter(Player.locked == False) \
+        .filter(or_(attendances.c.reserve == True, attendances.c.commander_id == None,
+                    attendances.c.player_id != attendances.c.commander_id)) \
+        .group_by(attendances.c.player_id, attendances.c.reserve)
+    for player_id, reserve, count, victories, draws in played:
+        if reserve:
+            add(player_id, reserve=count)
+        else:
+            add(player_id, played=count, victories=int(victories), draws=int(draws),
+                defeats=int(count - victories - draws))
+
+    # resources earned in stronghold battles
+    resources = battles.filter(selected.stronghold == True) \
+        .join(BattleAttendance, BattleAttendance.battle_id == selected.id) \
+        .with_entities(BattleAttendance.player_id, func.sum(func.coalesce(BattleAttendance.resources_earned, 0))) \
+        .group_by(BattleAttendance.player_id)
+    for player_id, earned in resources:
+        add(player_id, resources=int(earned))
+
+    battle_ids = [battle_id for battle_id, in battles.with_entities(selected.id).order_by(selected.id)]
+    return AttendanceCounts(battle_ids, counts)
+
+
+def add_counts(a, b):
+    """ Sum of two PlayerCounts """
+    return PlayerCounts(*[x + y for x, y in zip(a, b)])
+
+
+def last_run(clan, from_date, to_date, victories_only):
+    """ The last saved payout run over the period or None """
+    return PayoutRun.query.filter_by(clan=clan, from_date=from_date, to_date=to_date,
+                                     victories_only=bool(victories_only)).order_by(PayoutRun.id.desc()).first()
+
+
+def incremental_counts(clan, from_date, to_date, victories_only=False):
+    """
+        Like attendance_counts but reuses the counts of the last saved payout run over the
+        same period if no battle of the clan was changed since, so only battles added since
+        are aggregated.
+    :return: AttendanceCounts
+    """
+    run = last_run(clan, from_date, to_date, victories_only)
+    if run is None or run.attendance_generation != ClanGeneration.current_attendances(clan):
+        return attendance_counts(clan, from_date, to_date, victories_only)
+
+    run_battle_ids = run.get_battle_ids()
+    selected, battles = _selected_battles(clan, from_date, to_date, victories_only, None)
+    battle_ids = [battle_id for battle_id, in battles.with_entities(selected.id).order_by(selected.id)]
+    if not set(run_battle_ids) <= set(battle_ids):
+        return attendance_counts(clan, from_date, to_date, victories_only)
+
+    counts = dict((p.player_id, PlayerCounts(*[getattr(p, field) for field in PlayerCounts._fields]))
+                  for p in run.players)
+    new_battle_ids = sorted(set(battle_ids) - set(run_battle_ids))
+    if new_battle_ids:
+        for player_id, player_counts in attendance_counts(clan, from_date, to_date, victories_only,
+                                                          new_battle_ids).players.iteritems():
+            counts[player_id] = add_counts(counts.get(player_id, NO_COUNTS), player_counts)
+    return AttendanceCounts(battle_ids, counts)
+
+
+def points(counts, points_per_resource):
+    """ Points of a player for the given PlayerCounts """
+    return counts.fced_win * 6 + counts.fced_defeat * 4 + counts.fced_draws * 2 + counts.victories * 3 + \
+        counts.defeats * 2 + counts.draws * 2 + counts.reserve + counts.resources * points_per_resource
+
+
+def distribute(attendance, players, gold, recruit_factor, points_per_resource):
+    """
+        Split the gold among the players according to their points. Recruits get recruit_factor
+        times the gold per point of the other players.
+    :param attendance: AttendanceCounts
+    :param players: the clan members, only those who took part in the battles are paid
+    :return: (paid players, dictionary of players to points, dictionary of players to gold)
+    """
+    paid_players = set(p for p in players if attendance.players.get(p.id, NO_COUNTS) != NO_COUNTS)
+    player_points = dict((p, points(attendance.players[p.id], points_per_resource)) for p in paid_players)
+
+    total_points = sum(player_points.values())
+    recruit_points = sum(player_points[p] for p in paid_players if p.is_recruit())
+    others_points = total_points - recruit_points
+    weighted_points = recruit_factor * recruit_points + others_points
+    others_gold_per_point = float(gold) / weighted_points if weighted_points else 0.0
+    recruit_gold_per_point = recruit_factor * others_gold_per_point
+    player_gold = dict()
+    for p in paid_players:
+        if p.is_recruit():
+            player_gold[p] = int(round(player_points[p] * recruit_gold_per_point))
+        else:
+            player_gold[p] = int(round(player_points[p] * others_gold_per_point))
+    return paid_players, player_points, player_gold
+
+
+def save_run(clan, from_date, to_date, victories_only, gold, recruit_factor, points_per_resource, attendance,
+             players, creator, mark_paid=False):
+    """
+        Save a payout run of the AttendanceCounts. With mark_paid, the battles are marked as paid
+        and the gold is added to the players' gold_earned, both by bulk updates. If any of the
+        battles is already paid, AlreadyPaid is raised and the caller has to roll back.
+        The caller commits.
+    :param players: the clan members
+    :return: PayoutRun
+    """
+    paid_players, player_points, player_gold = distribute(attendance, players, gold, recruit_factor,
+                                                          points_per_resource)
+    run = PayoutRun(clan=clan, date=datetime.datetime.now(), creator=creator, from_date=from_date, to_date=to_date,
+                    victories_only=bool(victories_only), gold=gold, recruit_factor=recruit_factor,
+                    points_per_resource=points_per_resource, paid=mark_paid,
+                    attendance_generation=ClanGeneration.current_attendances(clan))
+    points_by_id = dict((p.id, player_points[p]) for p in paid_players)
+    gold_by_id = dict((p.id, player_gold[p]) for p in paid_players)
+    for player_id, player_counts in attendance.players.iteritems():
+        run.players.append(PayoutRunPlayer(player_id=player_id, points=points_by_id.get(player_id, 0),
+                                           gold=gold_by_id.get(player_id, 0), **player_counts._asdict()))
+    db_session.add(run)
+    db_session.flush()
+
+    if attendance.battle_ids:
+        db_session.execute(PayoutRunBattle.__table__.insert(),
+                           [{'run_id': run.id, 'battle_id': battle_id} for battle_id in attendance.battle_ids])
+    if mark_paid:
+        if attendance.battle_ids:
+            # only unpaid battles are updated, so concurrent runs can't both pay the same battles
+            updated = Battle.query.filter(Battle.id.in_(attendance.battle_ids),
+                                          or_(Battle.paid == False, Battle.paid == None)) \
+                .update({Battle.paid: True}, synchronize_session=False)
+            if updated != len(attendance.battle_ids):
+                raise AlreadyPaid('%d of the battles were already paid' % (len(attendance.battle_ids) - updated))
+        player_table = Player.__table__
+        if gold_by_id:
+            db_session.execute(player_table.update().where(player_table.c.id == bindparam('player_id'))
+                               .values(gold_earned=func.coalesce(player_table.c.gold_earned, 0) + bindparam('gold')),
+                               [{'player_id': player_id, 'gold': player_gold}
+                                for player_id, player_gold in gold_by_id.iteritems()])
+    return run
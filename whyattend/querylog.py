@@ -0,0 +1,156 @@
+"""
+    Statement timeouts and slow query log
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Each request runs with the statement timeout of its view (config.STATEMENT_TIMEOUTS,
+    defaulting to config.STATEMENT_TIMEOUT), so a single pathological query can't hold a
+    database connection and worker indefinitely. Depending on the database it is applied as
+    PostgreSQL statement_timeout, MySQL max_execution_time (5.7.8 or later, SELECT statements
+    only), MariaDB max_statement_time (10.1 or later) or an SQLite progress handler.
+
+    Statements taking longer than config.SLOW_QUERY_THRESHOLD are logged and aggregated
+    per view and statement in model.SlowQuery at the end of the request.
+"""
+
+import time
+import hashlib
+import logging
+import datetime
+import threading
+
+from sqlalchemy import event, case
+from sqlalchemy.exc import SQLAlchemyError
+
+from . import config
+from .model import SlowQuery, get_engine, add_engine_listener
+
+logger = logging.getLogger(__name__)
+
+# Number of SQLite virtual machine instructions between checks of the timeout
+SQLITE_PROGRESS_INTERVAL = 10000
+
+_state = threading.local()
+
+
+def start(endpoint):
+    """ Set up the statement timeout and slow query log of a request to endpoint """
+    _state.endpoint = endpoint
+    _state.timeout = config.STATEMENT_TIMEOUTS.get(endpoint, config.STATEMENT_TIMEOUT)
+    _state.slow = []
+
+
+def finish():
+    """ Store the slow statements of the request and reset the timeout """
+    slow = getattr(_state, 'slow', None)
+    _state.endpoint = _state.timeout = _state.slow = None
+    if slow:
+        try:
+            _store(slow)
+        except SQLAlchemyError:
+            logger.exception("Storing slow queries failed")
+
+
+def _timeout():
+    return getattr(_state, 'timeout', None)
+
+
+def _store(slow):
+    table = SlowQuery.__table__
+    with get_engine().begin() as connection:
+        for endpoint, statement, parameters, duration, failed in slow:
+            checksum = hashlib.sha1(('%s\n%s' % (endpoint, statement)).encode('utf-8')).hexdigest()
+            values = {'count': table.c.count + 1, 'failed': table.c.failed + int(failed),
+                      'total_time': table.c.total_time + duration,
+                      'max_time': case([(table.c.max_time < duration, duration)], else_=table.c.max_time),
+                      'last_parameters': parameters, 'last_date': datetime.datetime.now()}
+            if not connection.execute(table.update().where(table.c.checksum == checksum).values(**values)).rowcount:
+                connection.execute(table.insert().values(checksum=checksum, endpoint=endpoint, statement=statement,
+                                                         count=1, failed=int(failed), total_time=duration,
+                                                         max_time=duration, last_parameters=parameters,
+                                                         last_date=datetime.datetime.now()))
+
+
+def _record(connection, statement, parameters, failed=False):
+    start_times = connection.info.get('query_start_times')
+    if not start_times:
+        return
+    duration = time.time() - start_times.pop()
+    slow = getattr(_state, 'slow', None)
+    if slow is None or config.SLOW_QUERY_THRESHOLD is None or duration < config.SLOW_QUERY_THRESHOLD:
+        return
+    endpoint = getattr(_state, 'endpoint', None)
+    parameters = repr(parameters)[:1000]
+    logger.warning("%s query in %s took %.3f s: %s %s", 'Failed' if failed else 'Slow', endpoint, duration,
+                   statement, parameters)
+    slow.append((endpoint, statement, parameters, duration, failed))
+
+
+def _timeouts_enabled():
+    return bool(config.STATEMENT_TIMEOUT or config.STATEMENT_TIMEOUTS)
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_start_times', []).append(time.time())
+    if connection.dialect.name == 'sqlite' and _timeouts_enabled():
+        timeout = _timeout()
+        if timeout:
+            deadline = time.time() + timeout
+            connection.connection.set_progress_handler(lambda: time.time() > deadline, SQLITE_PROGRESS_INTERVAL)
+        else:
+            connection.connection.set_progress_handler(None, SQLITE_PROGRESS_INTERVAL)
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    _record(connection, statement, parameters)
+
+
+def _handle_error(exception_context):
+    if exception_context.connection is not None and exception_context.statement is not None:
+        _record(exception_context.connection, exception_context.statement, exception_context.parameters, True)
+
+
+def _mariadb_version(dialect):
+    """ Returns the MariaDB version of a MySQL dialect's server or None for MySQL. MariaDB 10 servers may
+        prefix their version with 5.5.5- for replication compatibility, e.g. 5.5.5-10.1.2-MariaDB """
+    version = dialect.server_version_info
+    if 'MariaDB' not in version:
+        return None
+    if version[:3] == (5, 5, 5) and len(version) > 3 and version[3] >= 10:
+        version = version[3:]
+    return version
+
+
+def _begin(connection):
+    """ Apply the timeout of the current request to the transaction (PostgreSQL) or session (MySQL) """
+    timeout = _timeout() or 0
+    dialect = connection.dialect
+    if dialect.name == 'postgresql':
+        statement = 'SET LOCAL statement_timeout = %d' % (timeout * 1000)
+    elif dialect.name == 'mysql' and _mariadb_version(dialect):
+        if _mariadb_version(dialect) < (10, 1):
+            return
+        statement = 'SET SESSION max_statement_time = %f' % timeout
+    elif dialect.name == 'mysql':
+        if dialect.server_version_info < (5, 7, 8):
+            return
+        statement = 'SET SESSION max_execution_time = %d' % (timeout * 1000)
+    else:
+        return
+    # on the DBAPI connection, as the transaction is just being started
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(statement)
+    finally:
+        cursor.close()
+
+
+def install(target):
+    """ Register the timeout and slow query listeners with an engine """
+    event.listen(target, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(target, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(target, 'handle_error', _handle_error)
+    if _timeouts_enabled():
+        event.listen(target, 'begin', _begin)
+
+
+add_engine_listener(install)
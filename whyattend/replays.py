@@ -8,50 +8,122 @@
 import json
 import struct
 import pickle
+import hashlib
+import datetime
 from copy import copy
+from collections import namedtuple
 
-from .constants import WOT_TANKS
+from .constants import WOT_TANKS, MAP_EN_NAME_BY_ID
 
 
 def parse_replay(replay_blob):
     """
         Parse the replay file and return the extracted information as Python dictionary
     """
-    num_blocks = struct.unpack('I', replay_blob[4:8])[0]
-    first_chunk_length = struct.unpack('I', replay_blob[8:12])[0]
-    first_chunk = replay_blob[12:12 + first_chunk_length]
-    second_chunk_length = struct.unpack('I', replay_blob[12 + first_chunk_length:12 + first_chunk_length + 4])[0]
-    second_chunk_start = 12 + first_chunk_length + 4
-    second_chunk = replay_blob[second_chunk_start:second_chunk_start + second_chunk_length]
-
-    try:
-        first_chunk = json.loads(first_chunk.decode('utf-8'))
-    except UnicodeDecodeError:
-        # if we can't decode the first chunk, this is probably not even a wotreplay file
-        return None
+    parser = ReplayParser()
+    parser.feed(replay_blob)
+    return parser.close()
+
 
-    try:
-        second_chunk = json.loads(second_chunk.decode('utf-8'))
-    except UnicodeDecodeError:
-        # Second chunk does not exist if the battle was left before it ended
-        second_chunk = None
+class ReplayParser(object):
+    """
+        Incremental replay parser. The contents of a replay file can be passed to feed() in
+        chunks as they arrive, e.g. while an upload is written to disk. close() returns the
+        same information as parse_replay.
+
+        A replay file starts with a magic number and the number of blocks, followed by
+        length-prefixed blocks: the JSON battle information, the JSON battle result and a
+        pickled dictionary. Only these blocks are kept in memory, the packet stream
+        following them is skipped.
+    """
+
+    def __init__(self):
+        self.num_blocks = None
+        self.blocks = []
+        # Data not consumed yet. The chunks are only joined once there are enough bytes
+        # for the next step (header, block length or block), so buffering stays linear.
+        self._chunks = []
+        self._buffered = 0
+        self._needed = 8
+        self._done = False
+
+    def _expected_blocks(self):
+        # The second block is read even if it is missing, in that case decoding it fails
+        return 3 if self.num_blocks == 3 else 2
+
+    def _buffer(self):
+        if len(self._chunks) > 1:
+            self._chunks = [''.join(self._chunks)]
+        return self._chunks[0] if self._chunks else ''
+
+    def feed(self, data):
+        if self._done or not data:
+            return
+        self._chunks.append(data)
+        self._buffered += len(data)
+        if self._buffered < self._needed:
+            return
+        buf = self._buffer()
+        offset = 0
+        if self.num_blocks is None:
+            self.num_blocks = struct.unpack('I', buf[4:8])[0]
+            offset = 8
+        self._needed = 4
+        while len(self.blocks) < self._expected_blocks() and len(buf) - offset >= 4:
+            length = struct.unpack('I', buf[offset:offset + 4])[0]
+            if len(buf) - offset - 4 < length:
+                self._needed = 4 + length
+                break
+            self.blocks.append(buf[offset + 4:offset + 4 + length])
+            offset += 4 + length
+        if len(self.blocks) == self._expected_blocks():
+            self._done = True
+            buf, offset = '', 0
+        rest = buf[offset:] if offset else buf
+        self._chunks = [rest] if rest else []
+        self._buffered = len(rest)
+
+    def _take_truncated_block(self, buf):
+        """ Append the block at the start of buf, cut off at its end, and return the rest of buf """
+        length = struct.unpack('I', buf[:4])[0]
+        self.blocks.append(buf[4:4 + length])
+        return buf[4 + length:]
+
+    def close(self):
+        """ Finish parsing and return the extracted information as Python dictionary """
+        buf = self._buffer()
+        if self.num_blocks is None:
+            self.num_blocks = struct.unpack('I', buf[4:8])[0]
+            buf = buf[8:]
+        # If the file was truncated, use what is there
+        while len(self.blocks) < 2:
+            buf = self._take_truncated_block(buf)
 
-    # after the second JSON chunk there is a Python serialized dictionary (pickle)
-    the_pickle = None
-    if num_blocks == 3:
         try:
-            pickle_start = second_chunk_start + second_chunk_length + 4
-            pickle_length = struct.unpack('I',
-                                          replay_blob[second_chunk_start +
-                                                      second_chunk_length:second_chunk_start +
-                                                                          second_chunk_length + 4])[0]
-            the_pickle = pickle.loads(replay_blob[pickle_start:pickle_start + pickle_length])
-        except pickle.UnpicklingError:
-            the_pickle = None
+            first_chunk = json.loads(self.blocks[0].decode('utf-8'))
+        except UnicodeDecodeError:
+            # if we can't decode the first chunk, this is probably not even a wotreplay file
+            return None
 
-    return {'first': first_chunk,
-            'second': second_chunk,
-            'pickle': the_pickle}
+        try:
+            second_chunk = json.loads(self.blocks[1].decode('utf-8'))
+        except UnicodeDecodeError:
+            # Second chunk does not exist if the battle was left before it ended
+            second_chunk = None
+
+        # after the second JSON chunk there is a Python serialized dictionary (pickle)
+        the_pickle = None
+        if self.num_blocks == 3:
+            try:
+                if len(self.blocks) < 3:
+                    self._take_truncated_block(buf)
+                the_pickle = pickle.loads(self.blocks[2])
+            except pickle.UnpicklingError:
+                the_pickle = None
+
+        return {'first': first_chunk,
+                'second': second_chunk,
+                'pickle': the_pickle}
 
 
 def players_list(replay_json, team):
@@ -70,6 +142,80 @@ def players_list(replay_json, team):
     return vehicles
 
 
+def summary(replay_json):
+    """ Condensed information of a replay as shown by replay_details.html: recorder, time, map,
+        duration and both teams with resolved vehicle names.
+        This is stored along with the replay so displaying it does not require the full replay data.
+    """
+    duration = None
+    if replay_json.get('pickle'):
+        duration = replay_json['pickle']['common']['duration']
+    elif replay_json['second']:
+        duration = replay_json['second'][0]['common']['duration']
+
+    teams = None
+    if replay_json['second']:
+        teams = []
+        for team in (1, 2):
+            players = [dict((key, v.get(key)) for key in ('name', 'clanAbbrev', 'vehicleType', 'isAlive'))
+                       for v in players_list(replay_json, team)]
+            teams.append(sorted(players, key=lambda v: v['vehicleType']))
+
+    return {
+        'player_name': replay_json['first']['playerName'],
+        'date_time': replay_json['first']['dateTime'],
+        'map_display_name': replay_json['first'].get('mapDisplayName'),
+        'duration': duration,
+        'teams': teams,
+    }
+
+
+# Information about a replay needed to create a battle from it
+ReplayFacts = namedtuple('ReplayFacts',
+                         ['player_name', 'clan', 'enemy_clan', 'map_id', 'map_name', 'date', 'stronghold', 'cw',
+                          'complete', 'won', 'duration', 'score', 'team', 'fingerprint', 'resources', 'summary'])
+
+
+def replay_facts(replay_json):
+    """ Extract the information needed to create a battle from a parsed replay as ReplayFacts.
+        enemy_clan and won are None unless the replay is complete and from a clan war
+        or stronghold battle.
+    """
+    complete = bool(replay_json['second'])
+    stronghold = is_stronghold(replay_json)
+    cw = complete and is_cw(replay_json)
+    enemy_clan = None
+    won = None
+    if complete and (cw or stronghold):
+        enemy_clan = guess_enemy_clan(replay_json)
+        won = player_won(replay_json)
+
+    resources = {}
+    if complete:
+        for v in replay_json['second'][0]['vehicles'].itervalues():
+            v = v[0]
+            resources[str(v['accountDBID'])] = v.get('fortResource')
+
+    return ReplayFacts(
+        player_name=replay_json['first']['playerName'],
+        clan=guess_clan(replay_json),
+        enemy_clan=enemy_clan,
+        map_id=replay_json['first']['mapName'],
+        map_name=MAP_EN_NAME_BY_ID.get(replay_json['first']['mapName'], 'Unknown'),
+        date=datetime.datetime.strptime(replay_json['first']['dateTime'], '%d.%m.%Y %H:%M:%S'),
+        stronghold=stronghold,
+        cw=cw,
+        complete=complete,
+        won=won,
+        duration=int(replay_json['second'][0]['common']['duration']) if complete else None,
+        score=score(replay_json) if complete else (0, 0),
+        team=player_team(replay_json),
+        fingerprint=battle_fingerprint(replay_json),
+        resources=resources,
+        summary=summary(replay_json),
+    )
+
+
 def player_won(replay_json):
     own_team = get_own_team(replay_json)
     return replay_json['second'][0]['common']['winnerTeam'] == own_team
@@ -127,6 +273,21 @@ def guess_enemy_clan(replay_json):
     return players_list(replay_json, 1 if own_team == 2 else 2)[0]['clanAbbrev']
 
 
+def battle_fingerprint(replay_json):
+    """ Checksum identifying a battle by the names of the players on the replay recorder's team,
+        the enemy clan and the map. Replays of the same battle recorded by different players of
+        the team have the same fingerprint.
+        Returns None for incomplete replays.
+    """
+    if not replay_json['second']:
+        return None
+    sha = hashlib.sha1()
+    sha.update(''.join(sorted(player_team(replay_json))))
+    sha.update(guess_enemy_clan(replay_json))
+    sha.update(replay_json['first']['mapName'])
+    return sha.hexdigest()
+
+
 def score(replay_json):
     own_team = get_own_team(replay_json)
     own_team_deaths = 0
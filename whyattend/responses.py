@@ -0,0 +1,62 @@
+"""
+    Response encoding
+    ~~~~~~~~~~~~~~~~~
+
+    Compact JSON serialization and gzip/deflate compression of text responses.
+    Flask uses simplejson (if installed) as faster JSON encoder.
+"""
+
+import zlib
+
+from flask import current_app, request, json
+
+from . import config
+
+# zlib window bits of the supported content codings, in order of preference
+ENCODINGS = (
+    ('gzip', 16 + zlib.MAX_WBITS),
+    ('deflate', zlib.MAX_WBITS),
+)
+
+
+def jsonify(*args, **kwargs):
+    """ Like flask.jsonify but without any whitespace """
+    return current_app.response_class(json.dumps(dict(*args, **kwargs), separators=(',', ':')),
+                                      mimetype='application/json')
+
+
+def _accepted_encoding():
+    for encoding, wbits in ENCODINGS:
+        if request.accept_encodings[encoding] > 0:
+            return encoding, wbits
+    return None, None
+
+
+def compress_response(response):
+    """
+        after_request handler compressing text responses larger than config.COMPRESS_MIN_SIZE
+        if the client accepts it. Binary responses like replay downloads are left alone.
+    :param response:
+    :return:
+    """
+    if config.COMPRESS_MIN_SIZE is None or response.mimetype not in config.COMPRESS_MIMETYPES \
+            or response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+            or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+
+    data = response.get_data()
+    if len(data) < config.COMPRESS_MIN_SIZE:
+        return response
+    encoding, wbits = _accepted_encoding()
+    if encoding is None:
+        return response
+
+    compressor = zlib.compressobj(config.COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+    response.set_data(compressor.compress(data) + compressor.flush())
+    response.headers['Content-Encoding'] = encoding
+    # the compressed body differs byte-wise from the uncompressed one
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,41 @@
+"""
+    Read-only rows
+    ~~~~~~~~~~~~~~
+
+    Aggregate pages (clan statistics, participation tables) read a few columns of every
+    battle and attendance of a clan. Loading them as ORM objects costs an identity map
+    entry, instance state and relationship bookkeeping per row, so these pages use the
+    plain rows of column-only selects instead.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import select, and_
+
+from .model import Battle, BattleAttendance, db_session
+
+BATTLE_COLUMNS = (Battle.id, Battle.date, Battle.clan, Battle.victory, Battle.draw, Battle.battle_group_id,
+                  Battle.battle_group_final, Battle.battle_commander_id, Battle.map_name, Battle.enemy_clan)
+BattleRow = namedtuple('BattleRow', [column.key for column in BATTLE_COLUMNS])
+
+ATTENDANCE_COLUMNS = (BattleAttendance.player_id, BattleAttendance.battle_id, BattleAttendance.reserve)
+AttendanceRow = namedtuple('AttendanceRow', [column.key for column in ATTENDANCE_COLUMNS])
+
+
+def battle_rows(*criteria):
+    """
+        BattleRow of each battle matching criteria (e.g. Battle.clan == clan), ordered by date.
+    :return: list of BattleRow
+    """
+    query = select(BATTLE_COLUMNS).where(and_(*criteria)).order_by(Battle.date)
+    return [BattleRow(*row) for row in db_session.execute(query)]
+
+
+def attendance_rows(*criteria):
+    """
+        AttendanceRow of each attendance of the battles matching criteria on Battle.
+    :return: list of AttendanceRow
+    """
+    query = select(ATTENDANCE_COLUMNS).select_from(BattleAttendance.__table__.join(Battle.__table__)) \
+        .where(and_(*criteria))
+    return [AttendanceRow(*row) for row in db_session.execute(query)]
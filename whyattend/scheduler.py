@@ -0,0 +1,82 @@
+"""
+    Periodic jobs
+    ~~~~~~~~~~~~~
+
+    Clan member synchronisation and cache warming at the intervals of config.SCHEDULE,
+    either scheduled by celery beat (config.SCHEDULER = 'celery', see tasks.py) or by
+    a thread of the web application process (config.SCHEDULER = 'thread').
+    The outcome of each run is recorded in WebappData.
+"""
+
+import time
+import logging
+import threading
+
+from . import config
+from .model import WebappData, db_session
+
+logger = logging.getLogger(__name__)
+
+
+def sync_players():
+    from . import tasks
+
+    for clan_id in config.CLAN_IDS.values():
+        tasks.synchronize_players.delay(str(clan_id))
+    return 'Triggered for ' + ', '.join(config.CLAN_IDS.keys())
+
+
+def warm_caches():
+    from .webapp import create_app, warm_caches as warm_webapp_caches
+
+    with create_app().app_context():
+        return warm_webapp_caches()
+
+
+JOBS = {
+    'sync_players': sync_players,
+    'warm_caches': warm_caches,
+}
+
+
+def run_job(name):
+    """ Run a periodic job and record its outcome """
+    try:
+        success, message = True, JOBS[name]() or ''
+    except Exception as e:
+        logger.exception("Periodic job " + name + " failed")
+        db_session.rollback()
+        success, message = False, str(e)
+
+    try:
+        webapp_data = WebappData.get()
+        webapp_data.record_job_result(name, success, message)
+        db_session.add(webapp_data)
+        db_session.commit()
+    finally:
+        db_session.remove()
+    return success
+
+
+def _run_thread():
+    next_run = dict((name, 0) for name in config.SCHEDULE)
+    while next_run:
+        for name, interval in config.SCHEDULE.iteritems():
+            if time.time() >= next_run[name]:
+                next_run[name] = time.time() + interval
+                run_job(name)
+        time.sleep(max(0, min(next_run.values()) - time.time()))
+
+
+_thread = None
+_thread_lock = threading.Lock()
+
+
+def start_thread():
+    """ Start the scheduler thread unless it is already running """
+    global _thread
+    with _thread_lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_run_thread, name='whyattend-scheduler')
+            _thread.daemon = True
+            _thread.start()
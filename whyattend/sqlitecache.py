@@ -0,0 +1,87 @@
+"""
+    SQLite cache backend
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Flask-Cache backend storing the entries in an SQLite database file, so several
+    server processes on one host share their cache without running Redis or memcached.
+    Configured with CACHE_TYPE 'whyattend.sqlitecache.sqlite' and the database file
+    as CACHE_SQLITE_PATH (see config.CACHE_CONFIG).
+"""
+
+import time
+import pickle
+import sqlite3
+import threading
+
+from werkzeug.contrib.cache import BaseCache
+
+
+class SQLiteCache(BaseCache):
+    def __init__(self, path, default_timeout=300, threshold=5000):
+        super(SQLiteCache, self).__init__(default_timeout)
+        self.path = path
+        self.threshold = threshold
+        self._local = threading.local()
+        # not kept open, the cache may be created before the server forks its processes
+        connection = sqlite3.connect(self.path, timeout=10)
+        try:
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires REAL, value BLOB)')
+        finally:
+            connection.close()
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=10)
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute('SELECT expires, value FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or row[0] < time.time():
+            return None
+        return pickle.loads(str(row[1]))
+
+    def _store(self, key, value, timeout, verb):
+        timeout = self.default_timeout if timeout is None else timeout
+        data = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self._connection() as connection:
+            if verb == 'INSERT':
+                # add() may replace an expired entry
+                connection.execute('DELETE FROM cache WHERE key = ? AND expires < ?', (key, time.time()))
+            cursor = connection.execute(verb + ' INTO cache (key, expires, value) VALUES (?, ?, ?)',
+                                        (key, time.time() + timeout, data))
+            if self.threshold and cursor.lastrowid % 100 == 0:
+                self._prune(connection)
+        return True
+
+    def _prune(self, connection):
+        connection.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+        connection.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires LIMIT '
+                           'max(0, (SELECT count(*) FROM cache) - ?))', (self.threshold,))
+
+    def set(self, key, value, timeout=None):
+        return self._store(key, value, timeout, 'INSERT OR REPLACE')
+
+    def add(self, key, value, timeout=None):
+        try:
+            return self._store(key, value, timeout, 'INSERT')
+        except sqlite3.IntegrityError:
+            return False
+
+    def delete(self, key):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+        return True
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute('DELETE FROM cache')
+        return True
+
+
+def sqlite(app, config, args, kwargs):
+    """ Flask-Cache backend factory """
+    kwargs.update(threshold=config.get('CACHE_THRESHOLD', 5000))
+    return SQLiteCache(config['CACHE_SQLITE_PATH'], *args, **kwargs)
@@ -80,4 +80,38 @@ $(document).ready(function () {
             return ((x < y) ?  1 : ((x > y) ? -1 : 0));
           };
     }
-});
\ No newline at end of file
+});
+/*
+ * DataTables fnServerData replacement for JSON handlers that support conditional requests.
+ * Leaves out the draw counter and jQuery's cache buster so repeated requests have the same URL
+ * and the browser can revalidate its cached copy (If-None-Match) instead of downloading it again.
+ */
+function fnServerDataConditional(sSource, aoData, fnCallback, oSettings) {
+    var sEcho = null;
+    var aoParams = jQuery.grep(aoData, function (param) {
+        if (param.name === 'sEcho') {
+            sEcho = param.value;
+            return false;
+        }
+        return true;
+    });
+    oSettings.jqXHR = jQuery.ajax({
+        "url": sSource,
+        "data": aoParams,
+        "dataType": "json",
+        "cache": true,
+        "type": oSettings.sServerMethod,
+        "success": function (json) {
+            if (sEcho !== null) {
+                json.sEcho = sEcho;
+            }
+            jQuery(oSettings.oInstance).trigger('xhr', [oSettings, json]);
+            fnCallback(json);
+        },
+        "error": function (xhr, error) {
+            if (error === "parsererror") {
+                oSettings.oApi._fnLog(oSettings, 0, "DataTables warning: JSON data from server could not be parsed.");
+            }
+        }
+    });
+}
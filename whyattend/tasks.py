@@ -11,19 +11,28 @@
       res = t.wait()
 
     The tasks are rate-limited to avoid errors from the WoT API.
+
+    With CELERY_ALWAYS_EAGER (the default) tasks run in the calling process instead.
 """
 
 import datetime
 import logging
+import pickle
 
-from celery import Celery
+from celery import Celery, chord, group
 from celery.utils.log import get_task_logger
 
-from . import config, wotapi
-from .model import Player, WebappData, db_session
+from . import config, wotapi, uploads, replays
+from .model import Player, Battle, Replay, WebappData, ClanGeneration, db_session
 
 celery = Celery(broker=config.CELERY_BROKER_URL)
-celery.conf.update({'CELERY_RESULT_BACKEND': config.CELERY_RESULT_BACKEND})
+celery.conf.update({'CELERY_RESULT_BACKEND': config.CELERY_RESULT_BACKEND,
+                    'CELERY_ALWAYS_EAGER': config.CELERY_ALWAYS_EAGER})
+if config.SCHEDULER == 'celery':
+    celery.conf.update({'CELERYBEAT_SCHEDULE': dict(
+        (name, {'task': 'whyattend.tasks.run_scheduled_job', 'schedule': datetime.timedelta(seconds=interval),
+                'args': (name, )})
+        for name, interval in config.SCHEDULE.iteritems())})
 
 logger = get_task_logger(__name__)
 logger.setLevel(logging.INFO)
@@ -41,69 +50,260 @@ def get_clan_info(clan_id):
     return wotapi.get_clan(clan_id)
 
 
-@celery.task(rate_limit='1/m')
-def synchronize_players(clan_id):
-    logger.info("synchronize_players(" + clan_id + ")")
-    logger.info("Clan member synchronization triggered for " + str(clan_id))
-    webapp_data = WebappData.get()
-    webapp_data.last_sync_attempt = datetime.datetime.now()
-    db_session.add(webapp_data)
-    db_session.commit()
-    db_session.remove()
+# Number of account IDs per WoT API request, the clan membership endpoint accepts at most 20
+PLAYER_CHUNK_SIZE = 20
+
+
+def _release_session():
+    """ Worker processes start each task with a fresh session. In eager mode the task runs
+        within a web request whose session must stay usable. """
+    if not celery.conf.CELERY_ALWAYS_EAGER:
+        db_session.remove()
 
-    clan_info = get_clan_info.delay(str(clan_id)).wait()
-    logger.info("Synchronizing " + clan_info['data'][str(clan_id)]['abbreviation'])
+
+def update_clan_members(clan_id, clan_info, players_info, member_info):
+    """
+        Update the players of a clan in the database from the member list of the WoT API:
+        Add new members, update the information of existing ones and lock players that left the clan.
+        The changes are not committed.
+    :param clan_id:
+    :param clan_info: wotapi.get_clan result
+    :param players_info: Account ID -> account information (data of wotapi.get_players)
+    :param member_info: Account ID -> clan membership information (data of wotapi.get_players_membership_info)
+    """
+    clan_data = clan_info['data'][str(clan_id)]
     processed = set()
-    for player_id in clan_info['data'][str(clan_id)]['members']:
-        player = clan_info['data'][str(clan_id)]['members'][player_id]
-        player_data = get_player_info.delay(str(player['account_id'])).wait()
+    locks_changed = False  # the payout counts skip locked players
+    for player_id, player in clan_data['members'].iteritems():
+        player_data = players_info.get(player_id)
+        member_data = member_info.get(player_id)
         p = Player.query.filter_by(wot_id=str(player['account_id'])).first()
-        if not player_data:
+        if not player_data or not member_data:
             if p:
                 processed.add(p.id)  # skip this guy later when locking players
+            logger.info("Missing player info of " + player['account_name'])
             continue  # API Error?
 
-        since = datetime.datetime.fromtimestamp(
-            float(player_data['data'][str(player['account_id'])]['clan']['since']))
+        since = datetime.datetime.fromtimestamp(float(member_data['joined_at']))
+        openid = 'https://' + config.WOT_SERVER_REGION_CODE + '.wargaming.net/id/' + \
+                 str(player['account_id']) + '-' + player['account_name'] + '/'
 
         if p:
             # Player exists, update information
             processed.add(p.id)
+            if p.name != player['account_name']:
+                # the battle pages show the names of the players
+                for clan in Battle.invalidate_view_models_of(p):
+                    ClanGeneration.bump(clan)
+            p.name = player['account_name']
+            p.openid = openid
+            locks_changed = locks_changed or bool(p.locked)
             p.locked = False
-            p.clan = clan_info['data'][str(clan_id)]['abbreviation']
+            if p.clan != clan_data['tag']:
+                ClanGeneration.bump(p.clan)  # left the other clan
+            p.clan = clan_data['tag']
             p.role = player['role']  # role might have changed
             p.member_since = since  # might have rejoined
         else:
             # New player
-            p = Player(str(player['account_id']),
-                       'https://eu.wargaming.net/id/' + str(player['account_id']) + '-' + player[
-                           'account_name'] + '/',
-                       since,
-                       player['account_name'],
-                       clan_info['data'][str(clan_id)]['abbreviation'],
+            p = Player(str(player['account_id']), openid, since, player['account_name'], clan_data['tag'],
                        player['role'])
             logger.info('Adding player ' + player['account_name'])
         db_session.add(p)
 
-    # Lock players which are no longer in the clan
-    for player in Player.query.filter_by(clan=clan_info['data'][str(clan_id)]['abbreviation']):
+    # All players of the clan in the DB, which are no longer in the clan
+    for player in Player.query.filter_by(clan=clan_data['tag']):
         if player.id in processed or player.id is None or player.locked:
             continue
         logger.info("Locking player " + player.name)
         player.locked = True
+        locks_changed = True
         player.lock_date = datetime.datetime.now()
         db_session.add(player)
+    ClanGeneration.bump(clan_data['tag'], attendances=locks_changed)
+
+
+@celery.task(rate_limit='5/s')
+def get_players_info(player_ids):
+    """ Account and clan membership information of a chunk of players (see PLAYER_CHUNK_SIZE) """
+    logger.info("get_players_info(" + ','.join(player_ids) + ")")
+    players_info = wotapi.get_players(player_ids)
+    member_info = wotapi.get_players_membership_info(player_ids)
+    return {'players': players_info['data'] if players_info else {},
+            'members': member_info['data'] if member_info else {}}
+
+
+@celery.task
+def apply_player_sync(chunks, clan_id, clan_info):
+    """ Final step of synchronize_players: merge the player information chunks and update the database """
+    players_info, member_info = {}, {}
+    for chunk in chunks:
+        players_info.update(chunk['players'])
+        member_info.update(chunk['members'])
 
     try:
-        db_session.commit()
+        update_clan_members(clan_id, clan_info, players_info, member_info)
+        webapp_data = WebappData.get()
         webapp_data.last_successful_sync = datetime.datetime.now()
         db_session.add(webapp_data)
+        db_session.commit()
         logger.info("Clan member synchronization successful")
+        return True
     except Exception as e:
         logger.warning("Clan member synchronization failed. Rolling back database transaction:")
         logger.exception(e)
         db_session.rollback()
+        return False
     finally:
-        db_session.remove()
+        _release_session()
+
+
+@celery.task(rate_limit='1/m')
+def synchronize_players(clan_id):
+    """
+        Synchronize the players of a clan with the WoT API. The player information is requested
+        in chunks by parallel get_players_info tasks and applied by apply_player_sync once all of
+        them finished, so no worker waits for other tasks.
+    :return: ID of the apply_player_sync result
+    """
+    logger.info("Clan member synchronization triggered for " + str(clan_id))
+    webapp_data = WebappData.get()
+    webapp_data.last_sync_attempt = datetime.datetime.now()
+    db_session.add(webapp_data)
+    db_session.commit()
+    _release_session()
+
+    clan_info = wotapi.get_clan(str(clan_id))
+    if not clan_info:
+        logger.warning("Clan member synchronization failed: No clan information for " + str(clan_id))
+        return None
+    logger.info("Synchronizing " + clan_info['data'][str(clan_id)]['tag'])
+
+    player_ids = clan_info['data'][str(clan_id)]['members'].keys()
+    if not player_ids:
+        return apply_player_sync.delay([], clan_id, clan_info).id
+    header = group(get_players_info.s(player_ids[i:i + PLAYER_CHUNK_SIZE])
+                   for i in xrange(0, len(player_ids), PLAYER_CHUNK_SIZE))
+    return chord(header)(apply_player_sync.s(clan_id, clan_info)).id
+
+
+@celery.task
+def parse_upload(folder, token):
+    """ Parse an uploaded replay file, so the battle form can be filled in from it """
+    upload = uploads.load(folder, token)
+    return upload is not None and uploads.parse(upload).facts is not None
+
+
+def _check_additional_replay(replay, battle, facts):
+    """ Return the reason why an additional replay doesn't belong to the battle or None """
+    battle_replay = battle.replay
+    if facts.fingerprint and battle.fingerprint:
+        # Same players, enemy clan and map
+        if facts.fingerprint != battle.fingerprint:
+            return u'The replay is most likely from a different battle (list of players, enemy clan or map differs)'
+    else:
+        # Incomplete replays have no fingerprint, compare the first JSON block instead
+        battle_replay_data = battle_replay.unpickle() if battle_replay else None
+        if battle_replay_data:
+            if set(facts.team) != set(replays.player_team(battle_replay_data)):
+                return u'The replay is most likely from a different battle (list of players differs)'
+            if facts.map_id != battle_replay_data['first']['mapName']:
+                return u'The replay is most likely from a different battle (map name differs)'
+
+    if battle_replay and facts.player_name == battle_replay.player_name:
+        return u'Replay of this player already exists'
+    for existing_replay in battle.additional_replays:
+        if existing_replay.id != replay.id and existing_replay.player_name == facts.player_name:
+            return u'Replay of this player already exists'
+    return None
+
+
+def _replay_failed(replay_id, error):
+    """ Mark a pending replay as failed, so its battle page doesn't show it as being parsed forever """
+    replay = Replay.query.get(replay_id)
+    if replay is None:
+        return
+    replay.pending = False
+    replay.parse_error = error
+    battle = replay.associated_battle or (replay.battle[0] if replay.battle else None)
+    if battle:
+        battle.invalidate_view_model()
+        ClanGeneration.bump(battle.clan)
+    db_session.commit()
+
+
+@celery.task
+def parse_and_attach_replay(replay_id, folder, token):
+    """
+        Parse an uploaded replay file and store the results with the pending Replay
+        created by the web application: the parsed replay, its summary, the battle's
+        fingerprint and score and the resources earned by the players in stronghold battles.
+        Additional replays that don't belong to their battle are marked with the reason.
+    """
+    logger.info("parse_and_attach_replay(" + str(replay_id) + ")")
+    try:
+        replay = Replay.query.get(replay_id)
+        upload = uploads.load(folder, token)
+        if not replay or not upload:
+            logger.warning("Replay " + str(replay_id) + " or its uploaded file no longer exists")
+            _replay_failed(replay_id, u'The uploaded replay file no longer exists, please upload it again')
+            return False
+
+        upload = uploads.parse(upload)
+        facts = upload.facts
+        additional = replay.associated_battle is not None
+        battle = replay.associated_battle if additional else (replay.battle[0] if replay.battle else None)
+
+        error = None
+        resources_changed = False
+        if not facts:
+            error = u'Parsing replay file failed'
+        elif additional:
+            error = _check_additional_replay(replay, battle, facts)
+
+        replay.pending = False
+        if error:
+            replay.parse_error = error
+        else:
+            replay.replay_pickle = upload.replay_pickle
+            replay.player_name = facts.player_name
+            replay.summary_pickle = pickle.dumps(facts.summary)
+            if additional or config.STORE_REPLAYS_IN_DB:
+                replay.replay_blob = uploads.read_replay(upload)
+            if battle and not additional:
+                battle.set_fingerprint(facts.fingerprint)
+                battle.score_own_team, battle.score_enemy_team = facts.score
+                if facts.stronghold:
+                    battle.stronghold = True
+                    resources_changed = True
+                    for ba in battle.attendances:
+                        if not ba.reserve:
+                            ba.resources_earned = facts.resources.get(str(ba.player.wot_id)) or 0
+        if battle:
+            battle.invalidate_view_model()
+            ClanGeneration.bump(battle.clan, attendances=resources_changed)
+        db_session.commit()
+
+        if additional:
+            # Additional replays are only kept in the database
+            uploads.discard(upload)
+        return error is None
+    except Exception as e:
+        logger.exception(e)
+        db_session.rollback()
+        try:
+            _replay_failed(replay_id, u'Processing the replay failed, please upload it again')
+        except Exception:
+            logger.exception("Could not mark replay " + str(replay_id) + " as failed")
+            db_session.rollback()
+        raise
+    finally:
+        _release_session()
+
+
+@celery.task
+def run_scheduled_job(name):
+    """ Run a periodic job of scheduler.JOBS, scheduled by celery beat """
+    from . import scheduler
 
-    return True
+    return scheduler.run_job(name)
@@ -0,0 +1,160 @@
+"""
+    Replay uploads
+    ~~~~~~~~~~~~~~
+
+    Uploaded replay files are spooled to the upload folder in a single pass which
+    also computes their checksum. They are parsed once by a task queue worker (see
+    tasks.parse_upload and tasks.parse_and_attach_replay), which stores the results
+    next to the file, so the requests that follow an upload (battle form, saving the
+    battle) refer to it by folder and token without reading or parsing the file again.
+"""
+
+import os
+import re
+import uuid
+import pickle
+import hashlib
+import datetime
+from collections import namedtuple
+
+from . import config, replays
+
+# Size of the chunks uploads are read in
+CHUNK_SIZE = 64 * 1024
+
+# Result of spooling an upload. parsed tells whether the file was parsed yet, facts are the
+# replays.ReplayFacts or None if parsing failed, replay_pickle is the pickled output of
+# replays.parse_replay as stored in model.Replay.
+ReplayUpload = namedtuple('ReplayUpload', ['folder', 'token', 'filename', 'content_hash', 'size', 'parsed',
+                                           'facts', 'replay_pickle'])
+
+_TOKEN_RE = re.compile(r'^[0-9a-f]{32}$')
+_FOLDER_RE = re.compile(r'^\d\d\.\d\d\.\d{4}$')
+
+
+class UploadTooLarge(Exception):
+    """ Raised by spool if the file exceeds the maximum size, nothing is kept of it """
+    pass
+
+
+def _paths(folder, token):
+    if not _FOLDER_RE.match(folder or '') or not _TOKEN_RE.match(token or ''):
+        raise ValueError('Invalid upload reference')
+    base = os.path.join(config.UPLOAD_FOLDER, folder, token)
+    return base + '.wotreplay', base + '.upload'
+
+
+def _store(upload):
+    """ Write the record of an upload. It is renamed into place, so load() never reads a partially written one """
+    _, upload_path = _paths(upload.folder, upload.token)
+    temp_path = '%s.%s.tmp' % (upload_path, uuid.uuid4().hex)
+    try:
+        with open(temp_path, 'wb') as f:
+            pickle.dump(upload, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, upload_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return upload
+
+
+def _close_parser(parser):
+    """ Return (facts, replay_pickle) of a fully fed ReplayParser """
+    try:
+        replay = parser.close()
+        if replay:
+            return replays.replay_facts(replay), pickle.dumps(replay)
+    except Exception:
+        pass  # not a (supported) replay file
+    return None, None
+
+
+def spool(file_storage, max_size=None):
+    """
+        Write an uploaded replay file to the upload folder, computing its checksum while
+        it is read. The file is parsed by a later call of parse().
+    :param file_storage: werkzeug FileStorage of the upload
+    :param max_size: maximum file size in bytes, raises UploadTooLarge if exceeded
+    :return: ReplayUpload
+    """
+    folder = datetime.datetime.now().strftime("%d.%m.%Y")
+    token = uuid.uuid4().hex
+    if not os.path.exists(os.path.join(config.UPLOAD_FOLDER, folder)):
+        os.makedirs(os.path.join(config.UPLOAD_FOLDER, folder))
+    replay_path, _ = _paths(folder, token)
+
+    sha = hashlib.sha1()
+    size = 0
+    try:
+        with open(replay_path, 'wb') as f:
+            while True:
+                chunk = file_storage.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise UploadTooLarge()
+                sha.update(chunk)
+                f.write(chunk)
+    except Exception:
+        os.remove(replay_path)
+        raise
+    return _store(ReplayUpload(folder, token, file_storage.filename, sha.hexdigest(), size, False, None, None))
+
+
+def parse(upload):
+    """
+        Parse a spooled upload that was not parsed yet and store the results with it.
+        The checksum and size are computed again, as load() may have returned an incomplete record.
+    :return: the updated ReplayUpload
+    """
+    if upload.parsed:
+        return upload
+    replay_path, _ = _paths(upload.folder, upload.token)
+    sha = hashlib.sha1()
+    parser = replays.ReplayParser()
+    size = 0
+    with open(replay_path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            sha.update(chunk)
+            parser.feed(chunk)
+    facts, replay_pickle = _close_parser(parser)
+    return _store(upload._replace(content_hash=sha.hexdigest(), size=size, parsed=True, facts=facts,
+                                  replay_pickle=replay_pickle))
+
+
+def load(folder, token):
+    """
+        Return the ReplayUpload of an earlier upload or None if it doesn't exist (anymore).
+        If its record can't be read, it is returned as still pending without a checksum.
+    """
+    try:
+        replay_path, upload_path = _paths(folder, token)
+    except ValueError:
+        return None
+    if not os.path.exists(upload_path):
+        return None
+    with open(upload_path, 'rb') as f:
+        try:
+            return pickle.load(f)
+        except (EOFError, pickle.UnpicklingError):
+            return ReplayUpload(folder, token, '', None, None, False, None, None)
+
+
+def read_replay(upload):
+    """ Return the contents of the uploaded replay file """
+    replay_path, _ = _paths(upload.folder, upload.token)
+    with open(replay_path, 'rb') as f:
+        return f.read()
+
+
+def discard(upload):
+    """ Delete the files of an upload, e.g. when it is a duplicate """
+    for path in _paths(upload.folder, upload.token):
+        if os.path.exists(path):
+            os.remove(path)
@@ -3,6 +3,10 @@
     ~~~~~~~~~~~~~~~~~~~
 
     Implementation of all request handlers and core functionality.
+
+    Importing this module only defines the application and its views. create_app sets it up
+    (configuration, cache, logging, OpenID login), the code paths with heavy dependencies
+    (Wargaming API, tasks, timezones, analysis) import them when they run.
 """
 
 import csv
@@ -13,33 +17,32 @@ import logging
 import hashlib
 import tarfile
 import calendar
+import threading
 
 from cStringIO import StringIO
 from collections import defaultdict, OrderedDict
 from functools import wraps
 from datetime import timedelta
 import jinja2
-from flask import Flask, g, session, render_template, flash, redirect, request, url_for, abort, make_response, jsonify
+from flask import Flask, g, session, render_template, flash, redirect, request, url_for, abort, make_response
 from flask import Response
-from flask_openid import OpenID
 from flask_cache import Cache
-from sqlalchemy import or_, and_, alias
-from sqlalchemy.orm import joinedload, joinedload_all
+from sqlalchemy import or_, and_, not_, alias, case, select, func, exists
+from sqlalchemy.orm import joinedload, joinedload_all, undefer
 from werkzeug.utils import secure_filename, Headers
-from pytz import timezone
 
-from . import config, replays, wotapi, util, constants, analysis
-from .model import Player, Battle, BattleAttendance, Replay, BattleGroup, db_session, WebappData
+from . import config, replays, util, uploads, scheduler, rows, querylog
+from .model import Player, Battle, BattleAttendance, Replay, BattleGroup, db_session, WebappData, ClanGeneration, \
+    PayoutRun, PayoutRunPlayer, SlowQuery, FingerprintChange, FingerprintSequence, replica_reads
+from .pagecache import PageCache
+from .payout import battles_query, incremental_counts, distribute, save_run, AlreadyPaid
+from .responses import jsonify, compress_response
 
 # Set up Flask application
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = config.DATABASE_URI
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['SECRET_KEY'] = config.SECRET_KEY
-app.config['UPLOAD_FOLDER'] = config.UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB at a time should be plenty for replays
-cache = Cache(app, config={'CACHE_TYPE': 'simple'})
-oid = OpenID(app, config.OID_STORE_PATH)
+cache = Cache()
+page_cache = PageCache(cache, config.PAGE_CACHE_SIZE, config.PAGE_CACHE_TIMEOUT)
+app.after_request(compress_response)
 
 app.jinja_env.undefined = jinja2.StrictUndefined
 
@@ -48,32 +51,74 @@ app.jinja_env.filters['int'] = int
 app.jinja_env.globals['datetime'] = datetime
 app.jinja_env.globals['STATISTICS_VISIBLE'] = config.STATISTICS_VISIBLE
 
-# Uncomment to set up middleware in case we are behind a reverse proxy server
-# from .util import ReverseProxied
-# app.wsgi_app = ReverseProxied(app.wsgi_app)
+logger = logging.getLogger(__name__)
 
-# Set up error logging
-if not app.debug and config.ERROR_LOG_FILE:
-    from logging.handlers import RotatingFileHandler
+_app_created = False
+_app_lock = threading.Lock()
 
-    file_handler = RotatingFileHandler(config.ERROR_LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=5)
-    file_handler.setLevel(logging.WARNING)
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s %(levelname)s: %(message)s '
-        '[in %(pathname)s:%(lineno)d]'))
-    app.logger.addHandler(file_handler)
 
-# Set up application logging
-logger = logging.getLogger(__name__)
-if config.LOG_FILE:
-    from logging.handlers import RotatingFileHandler
+def create_app():
+    """
+        Set up the Flask application: configuration, cache, logging and the OpenID login views.
+        Servers, tests and jobs needing request or application contexts call this once after
+        importing the module, later calls return the same application.
+    :return: The application
+    """
+    global _app_created
+    with _app_lock:
+        if _app_created:
+            return app
+
+        app.config['SQLALCHEMY_DATABASE_URI'] = config.DATABASE_URI
+        app.config['SQLALCHEMY_ECHO'] = False
+        app.config['SECRET_KEY'] = config.SECRET_KEY
+        app.config['UPLOAD_FOLDER'] = config.UPLOAD_FOLDER
+        app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB at a time should be plenty for replays
+        cache.init_app(app, config=dict(config.CACHE_CONFIG))
+
+        from .login import oid  # registers the login views
+
+        oid.init_app(app)
+
+        # Uncomment to set up middleware in case we are behind a reverse proxy server
+        # from .util import ReverseProxied
+        # app.wsgi_app = ReverseProxied(app.wsgi_app)
+
+        # Set up error logging
+        if not app.debug and config.ERROR_LOG_FILE:
+            from logging.handlers import RotatingFileHandler
+
+            file_handler = RotatingFileHandler(config.ERROR_LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=5)
+            file_handler.setLevel(logging.WARNING)
+            file_handler.setFormatter(logging.Formatter(
+                '%(asctime)s %(levelname)s: %(message)s '
+                '[in %(pathname)s:%(lineno)d]'))
+            app.logger.addHandler(file_handler)
+
+        # Set up application logging
+        if config.LOG_FILE:
+            from logging.handlers import RotatingFileHandler
+
+            file_handler = RotatingFileHandler(config.LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=5)
+            file_handler.setLevel(logging.INFO)
+            logger.setLevel(logging.INFO)
+            file_handler.setFormatter(logging.Formatter(
+                '%(asctime)s %(levelname)s: %(message)s '))
+            logger.addHandler(file_handler)
+
+        _app_created = True
+        return app
+
+
+@app.before_request
+def start_query_log():
+    """ Apply the statement timeout of the view and collect its slow queries, see querylog.py """
+    querylog.start(request.endpoint)
+
 
-    file_handler = RotatingFileHandler(config.LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=5)
-    file_handler.setLevel(logging.INFO)
-    logger.setLevel(logging.INFO)
-    file_handler.setFormatter(logging.Formatter(
-        '%(asctime)s %(levelname)s: %(message)s '))
-    logger.addHandler(file_handler)
+@app.teardown_request
+def finish_query_log(exception=None):
+    querylog.finish()
 
 
 @app.before_request
@@ -178,6 +223,20 @@ def require_clan_membership(f):
     return decorated_f
 
 
+def duplicate_replay_battle_id(content_hash):
+    """
+        Return the ID of the battle an identical replay file was uploaded for, or None.
+    :param content_hash: SHA-1 hex digest of the replay file
+    """
+    # replays rejected by the background parsing don't count
+    replay = Replay.query.filter_by(content_hash=content_hash, parse_error=None).first()
+    if replay is None:
+        return None
+    if replay.associated_battle_id:
+        return replay.associated_battle_id
+    return db_session.query(Battle.id).filter_by(replay_id=replay.id).scalar()
+
+
 @decorator_with_args
 def require_role(f, roles):
     """
@@ -200,6 +259,59 @@ def require_role(f, roles):
     return decorated_f
 
 
+def read_replica(f):
+    """
+        Request handler decorator for read-only pages: the queries of GET requests go to the
+        read-only replica (config.DATABASE_READ_URI) if one is configured.
+        Has to be applied before etag_by_generation, so the generation is read from the replica as well.
+    :param f:
+    :return:
+    """
+
+    @wraps(f)
+    def decorated_f(*args, **kwargs):
+        if request.method != 'GET':
+            return f(*args, **kwargs)
+        with replica_reads():
+            return f(*args, **kwargs)
+
+    return decorated_f
+
+
+# request parameters that differ between otherwise identical requests (DataTables' draw counter and
+# jQuery's cache buster) and don't take part in the ETag
+ETAG_IGNORED_ARGS = ('sEcho', '_')
+
+
+@decorator_with_args
+def etag_by_generation(f, clans):
+    """
+        Request handler decorator for JSON handlers that answers conditional requests
+        without running the handler as long as the data generation (see model.ClanGeneration)
+        of the clans the response depends on hasn't changed.
+    :param f:
+    :param clans: function of the view arguments returning the clans the response depends on
+    :return:
+    """
+
+    @wraps(f)
+    def decorated_f(*args, **kwargs):
+        validator = [request.path, g.player.id if g.player else None]
+        validator += sorted((k, v) for k, v in request.args.iteritems(multi=True) if k not in ETAG_IGNORED_ARGS)
+        validator += [(clan, ClanGeneration.current(clan)) for clan in sorted(set(clans(**kwargs)))]
+        etag = hashlib.sha1(repr(validator)).hexdigest()
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = make_response(f(*args, **kwargs))
+        response.set_etag(etag)
+        # let browsers keep the response but revalidate it every time
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    return decorated_f
+
+
 @app.route('/sync-players/')
 @app.route('/sync-players/<int:clan_id>')
 def sync_players(clan_id=None):
@@ -208,6 +320,8 @@ def sync_players(clan_id=None):
     :param clan_id:
     :return:
     """
+    from . import wotapi, tasks
+
     if config.API_KEY == request.args['API_KEY']:
         if clan_id:
             clan_ids = [clan_id]
@@ -228,50 +342,7 @@ def sync_players(clan_id=None):
             for i in xrange(0, len(player_ids), 20):
                 member_info_data.update(wotapi.get_players_membership_info(player_ids[i:i+20])['data'])
 
-            processed = set()
-            for player_id in player_ids:
-                player = clan_info['data'][str(clan_id)]['members'][player_id]
-                player_data = players_info['data'][player_id]
-                member_data = member_info_data[player_id]
-                p = Player.query.filter_by(wot_id=str(player['account_id'])).first()
-                if not player_data:
-                    if p:
-                        processed.add(p.id)  # skip this guy later when locking players
-                    logger.info("Missing player info of " + player['account_name'])
-                    continue  # API Error?
-
-                since = datetime.datetime.fromtimestamp(
-                    float(member_data['joined_at']))
-
-                if p:
-                    # Player exists, update information
-                    processed.add(p.id)
-                    p.name = player['account_name']
-                    p.openid = 'https://'+config.WOT_SERVER_REGION_CODE+'.wargaming.net/id/' + str(player_id) + '-' + player['account_name'] + '/'
-                    p.locked = False
-                    p.clan = clan_info['data'][str(clan_id)]['tag']
-                    p.role = player['role']  # role might have changed
-                    p.member_since = since  # might have rejoined
-                else:
-                    # New player
-                    p = Player(str(player['account_id']),
-                               'https://'+config.WOT_SERVER_REGION_CODE+'.wargaming.net/id/' + str(player['account_id']) + '-' + player[
-                                   'account_name'] + '/',
-                               since,
-                               player['account_name'],
-                               clan_info['data'][str(clan_id)]['tag'],
-                               player['role'])
-                    logger.info('Adding player ' + player['account_name'])
-                db_session.add(p)
-
-            # All players of the clan in the DB, which are no longer in the clan
-            for player in Player.query.filter_by(clan=clan_info['data'][str(clan_id)]['tag']):
-                if player.id in processed or player.id is None or player.locked:
-                    continue
-                logger.info("Locking player " + player.name)
-                player.locked = True
-                player.lock_date = datetime.datetime.now()
-                db_session.add(player)
+            tasks.update_clan_members(clan_id, clan_info, players_info['data'], member_info_data)
 
             webapp_data.last_successful_sync = datetime.datetime.now()
             db_session.add(webapp_data)
@@ -284,6 +355,59 @@ def sync_players(clan_id=None):
     return redirect(url_for('index'))
 
 
+def current_hour():
+    """ page_cache variant of pages covering the last days, so their time range moves on """
+    return datetime.datetime.now().strftime('%Y%m%d%H')
+
+
+# Cache provinces owned for 60 seconds to avoid spamming WG's server
+@cache.memoize(timeout=60)
+def cached_provinces_owned(clan_id):
+    from . import wotapi
+
+    logger.info("Querying Wargaming server for provinces owned by clan " + str(clan_id))
+    try:
+        return wotapi.get_provinces(clan_id)
+    except Exception:
+        logger.exception("Error querying WG server for provinces owned")
+        return None
+
+
+@cache.memoize(timeout=60)
+def cached_battle_schedule(clan_id):
+    from . import wotapi
+
+    logger.info("Querying Wargaming server for battle schedule of clan " + str(clan_id))
+    try:
+        return wotapi.get_battle_schedule(clan_id)
+    except Exception:
+        logger.exception("Error querying WG server for battle schedule")
+        return None
+
+
+def warm_caches():
+    """
+        Refresh the cached Wargaming data and clan statistics of all clans, so users
+        don't have to wait for them (see scheduler.py).
+    :return: Summary of the refreshed data
+    """
+    for clan, clan_id in config.CLAN_IDS.iteritems():
+        cache.delete_memoized(cached_provinces_owned, clan_id)
+        cached_provinces_owned(clan_id)
+        cache.delete_memoized(cached_battle_schedule, clan_id)
+        cached_battle_schedule(clan_id)
+    for clan in config.CLAN_NAMES:
+        page_cache.get('clan_statistics', clan, current_hour(), lambda: clan_statistics_data(clan))
+    db_session.remove()
+    return 'Refreshed ' + ', '.join(config.CLAN_NAMES)
+
+
+@app.before_first_request
+def start_scheduler():
+    if config.SCHEDULER == 'thread':
+        scheduler.start_thread()
+
+
 @app.route("/")
 def index():
     """
@@ -293,25 +417,6 @@ def index():
     if g.player:
         latest_battles = Battle.query.filter_by(clan=g.player.clan).order_by('date desc').limit(3)
 
-        # Cache provinces owned for 60 seconds to avoid spamming WG's server
-        @cache.memoize(timeout=60)
-        def cached_provinces_owned(clan_id):
-            logger.info("Querying Wargaming server for provinces owned by clan " + str(clan_id) + " " + g.player.clan)
-            try:
-                return wotapi.get_provinces(clan_id)
-            except Exception:
-                logger.exception("Error querying WG server for provinces owned")
-                return None
-
-        @cache.memoize(timeout=60)
-        def cached_battle_schedule(clan_id):
-            logger.info("Querying Wargaming server for battle schedule of clan " + str(clan_id) + " " + g.player.clan)
-            try:
-                return wotapi.get_battle_schedule(clan_id)
-            except Exception:
-                logger.exception("Error querying WG server for battle schedule")
-                return None
-
         provinces_owned = cached_provinces_owned(config.CLAN_IDS[g.player.clan])
         total_revenue = 0
         if provinces_owned:
@@ -340,121 +445,44 @@ def admin():
     return render_template('admin.html', webapp_data=WebappData.get(), API_KEY=config.API_KEY)
 
 
-@app.route('/help')
-def help_page():
+@app.route('/admin/slow-queries')
+@require_login
+@require_role(config.ADMIN_ROLES)
+def slow_queries():
     """
-        Help page.
+        The slow queries recorded by querylog, worst offenders (by total time) first.
     :return:
     """
-    return render_template('help.html')
+    queries = SlowQuery.query.order_by(SlowQuery.total_time.desc()).limit(100).all()
+    return render_template('slow_queries.html', queries=queries, threshold=config.SLOW_QUERY_THRESHOLD)
 
 
-@app.route('/attributions')
-def attributions():
+@app.route('/health')
+def health():
     """
-        Page with attributions and licencing information.
+        Health check for load balancers and process supervisors: answers 200 if the database is reachable.
     :return:
     """
-    return render_template('attributions.html')
+    db_session.execute('SELECT 1')
+    return Response('OK', mimetype='text/plain')
 
 
-@app.route('/login', methods=['GET', 'POST'])
-@oid.loginhandler
-def login():
+@app.route('/help')
+def help_page():
     """
-        Login page.
+        Help page.
     :return:
     """
-    if g.player is not None:
-        return redirect(oid.get_next_url())
-    if request.method == 'POST':
-        openid = request.form.get('openid', "http://eu.wargaming.net/id")
-        if openid:
-            return oid.try_login(openid, ask_for=['nickname'])
-    return render_template('login.html', next=oid.get_next_url(),
-                           error=oid.fetch_error())
-
-
-@oid.after_login
-def create_or_login(resp):
-    """
-        This is called when login with OpenID succeeded and it's not
-        necessary to figure out if this is the users's first login or not.
-        This function has to redirect otherwise the user will be presented
-        with a terrible URL which we certainly don't want.
-    """
-    session['openid'] = resp.identity_url
-    session['nickname'] = resp.nickname
-    player = Player.query.filter_by(openid=resp.identity_url, locked=False).first()
-    if player is not None:
-        flash(u'Signed in successfully', 'success')
-        session.permanent = True
-        g.player = player
-        return redirect(oid.get_next_url())
-    return redirect(url_for('create_profile', next=oid.get_next_url(),
-                            name=resp.nickname))
-
-
-@app.route('/create-profile', methods=['GET', 'POST'])
-def create_profile():
-    """
-        If this is the user's first login, the create_or_login function
-        will redirect here so that the user can set up his profile.
-    """
-    if g.player is not None or 'openid' not in session or 'nickname' not in session:
-        return redirect(url_for('index'))
-    if request.method == 'POST':
-        wot_id = [x for x in session['openid'].split('/') if x][-1].split('-')[0]
-        if not wot_id:
-            flash(u'Error: Could not determine your player ID from the OpenID string. Contact an admin for help :-)',
-                  'error')
-            return render_template('create_profile.html', next_url=oid.get_next_url())
-
-        player_data = wotapi.get_player(wot_id)
-        player_clan_info = wotapi.get_players_membership_info([wot_id])
-        if not player_data or not player_data['data'][str(wot_id)]:
-            flash(u'Error: Could not retrieve player information from Wargaming. Contact an admin for help :-)',
-                  'error')
-            return render_template('create_profile.html', next_url=oid.get_next_url())
-
-        clan_ids_to_name = dict((v, k) for k, v in config.CLAN_IDS.iteritems())
-        clan_id = str(player_clan_info['data'][str(wot_id)]['clan']['clan_id'])
-
-        if clan_id not in config.CLAN_IDS.values():
-            flash(u'You have to be in one of the clans to login', 'error')
-            return render_template('create_profile.html', next_url=oid.get_next_url())
-
-        clan = clan_ids_to_name[str(clan_id)]
-
-        role = player_clan_info['data'][str(wot_id)]['role']
-        member_since = datetime.datetime.fromtimestamp(float(player_clan_info['data'][str(wot_id)]['joined_at']))
-        if not role:
-            flash(u'Error: Could not retrieve player role from wargaming server', 'error')
-            return render_template('create_profile.html', next_url=oid.get_next_url())
-
-        db_session.add(Player(wot_id, session['openid'], member_since, session['nickname'], clan, role))
-        db_session.commit()
-        logger.info("New player profile registered [" + session['nickname'] + ", " + clan + ", " + role + "]")
-        flash(u'Welcome!', 'success')
-        return redirect(oid.get_next_url())
-    return render_template('create_profile.html', next_url=oid.get_next_url())
+    return render_template('help.html')
 
 
-@app.route('/logout')
-@require_login
-def logout():
+@app.route('/attributions')
+def attributions():
     """
-        Log out the current user.
+        Page with attributions and licencing information.
     :return:
     """
-    session.pop('openid', None)
-    session.pop('nickname', None)
-    g.player = None
-    flash(
-        u'You were signed out from the tracker. You have to sign out from Wargaming\'s '
-        u'website yourself if you wish to do that.',
-        'info')
-    return redirect(oid.get_next_url())
+    return render_template('attributions.html')
 
 
 @app.route('/battles/create/from-replay', methods=['GET', 'POST'])
@@ -465,20 +493,28 @@ def create_battle_from_replay():
         Upload replay form to create battles.
     :return:
     """
+    from . import tasks
+
     if request.method == 'POST':
         replay_file = request.files['replay']
         if replay_file and replay_file.filename.endswith('.wotreplay'):
             battle_group_id = int(request.form.get('battle_group_id', -2))
-            folder = datetime.datetime.now().strftime("%d.%m.%Y")
-            filename = secure_filename(g.player.name + '_' + replay_file.filename)
-            if not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], folder)):
-                os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], folder))
-            replay_file.save(os.path.join(app.config['UPLOAD_FOLDER'], folder, filename))
+            try:
+                upload = uploads.spool(replay_file, config.MAX_REPLAY_SIZE)
+            except uploads.UploadTooLarge:
+                flash(u'The replay file is too large', 'error')
+                return redirect(url_for('create_battle_from_replay'))
+            existing_battle_id = duplicate_replay_battle_id(upload.content_hash)
+            if existing_battle_id:
+                uploads.discard(upload)
+                flash(u'This replay was already uploaded', 'error')
+                return redirect(url_for('battle_details', battle_id=existing_battle_id))
+            tasks.parse_upload.delay(upload.folder, upload.token)
             if battle_group_id:
-                return redirect(
-                    url_for('create_battle', battle_group_id=battle_group_id, folder=folder, filename=filename))
+                return redirect(url_for('create_battle', battle_group_id=battle_group_id, folder=upload.folder,
+                                        upload=upload.token))
             else:
-                return redirect(url_for('create_battle', folder=folder, filename=filename))
+                return redirect(url_for('create_battle', folder=upload.folder, upload=upload.token))
     return render_template('battles/create_from_replay.html')
 
 
@@ -488,35 +524,30 @@ def add_replay(battle_id):
     """
         Upload additional replays for battles.
     """
+    from . import tasks
+
     battle = Battle.query.get(battle_id) or abort(404)
-    battle_replay = battle.replay
     if request.method == 'POST':
         replay_file = request.files['replay']
         if replay_file and replay_file.filename.endswith('.wotreplay'):
-            replay_blob = replay_file.read()
-            replay = replays.parse_replay(replay_blob)
-
-            if set(replays.player_team(replay)) != set(replays.player_team(battle_replay.unpickle())):
-                flash(u'The selected replay is most likely from a different battle (list of players differs)', 'error')
-                return redirect(url_for('battle_details', battle_id=battle.id))
-
-            if replay['first']['mapName'] != battle_replay.unpickle()['first']['mapName']:
-                flash(u'The selected replay is most likely for a different battle (map name differs)', 'error')
+            try:
+                upload = uploads.spool(replay_file, config.MAX_REPLAY_SIZE)
+            except uploads.UploadTooLarge:
+                flash(u'The replay file is too large', 'error')
                 return redirect(url_for('battle_details', battle_id=battle.id))
-
-            if replay['first']['playerName'] == battle_replay.player_name:
-                flash(u'Replay of this player already exists', 'error')
+            if duplicate_replay_battle_id(upload.content_hash):
+                uploads.discard(upload)
+                flash(u'This replay was already uploaded', 'error')
                 return redirect(url_for('battle_details', battle_id=battle.id))
 
-            for existing_replay in battle.additional_replays:
-                if existing_replay.player_name == replay['first']['playerName']:
-                    flash(u'Replay of this player already exists', 'error')
-                    return redirect(url_for('battle_details', battle_id=battle.id))
-
-            r = Replay(replay_blob, pickle.dumps(replay))
+            # Parsed and checked against the battle in the background
+            r = Replay(None, None)
             r.associated_battle = battle
-            r.player_name = replay['first']['playerName']
+            r.content_hash = upload.content_hash
+            r.pending = True
+            battle.invalidate_view_model()
             db_session.commit()
+            tasks.parse_and_attach_replay.delay(r.id, upload.folder, upload.token)
 
     return redirect(url_for('battle_details', battle_id=battle.id))
 
@@ -546,7 +577,7 @@ def edit_battle(battle_id):
     battle_group_final = battle.battle_group_final
     players = battle.get_players()
     description = battle.description
-    replay = battle.replay.unpickle()
+    replay = battle.replay.summary()
     duration = battle.duration
     if battle.battle_group:
         battle_group_description = battle.battle_group.description
@@ -612,10 +643,13 @@ def edit_battle(battle_id):
             battle.battle_commander_id = battle_commander.id
             battle.description = description
             battle.duration = duration
+            battle.invalidate_view_model()
+            ClanGeneration.bump(battle.clan, attendances=True)
 
             if bg:
                 battle.battle_group_final = battle_group_final
                 battle.battle_group = bg
+                bg.invalidate_members()
                 db_session.add(bg)
             else:
                 battle.battle_group = None
@@ -650,6 +684,9 @@ def create_battle():
     """
         Create battle form.
     """
+    from pytz import timezone
+    from . import tasks
+
     all_players = Player.query.filter_by(clan=g.player.clan, locked=False).order_by('lower(name)').all()
     sorted_players = sorted(all_players, reverse=True, key=lambda p: p.player_role_value())
 
@@ -673,47 +710,60 @@ def create_battle():
     battle_group_title = ''
     battle_group_description = ''
     battle_group_final = False
-    filename = request.args.get('filename', '')
-    folder = request.args.get('folder', '')
-    if request.method == 'POST':
-        filename = request.form.get('filename', '')
-        folder = request.form.get('folder', '')
-
-    if filename:
-        file_blob = open(os.path.join(app.config['UPLOAD_FOLDER'], folder, secure_filename(filename)), 'rb').read()
-        replay = replays.parse_replay(file_blob)
-        if not replay:
+    # Uploaded replay (see create_battle_from_replay), parsed only once when it was uploaded
+    upload = None
+    upload_token = request.values.get('upload', '')
+    folder = request.values.get('folder', '')
+    if upload_token:
+        upload = uploads.load(folder, upload_token)
+        if not upload:
+            flash(u'Error: The uploaded replay file was not found. Please upload it again.', 'error')
+    elif request.method == 'POST' and request.files.get('replay'):
+        try:
+            upload = uploads.spool(request.files['replay'], config.MAX_REPLAY_SIZE)
+        except uploads.UploadTooLarge:
+            flash(u'The replay file is too large', 'error')
+    filename = upload.filename if upload else ''
+    upload_pending = upload is not None and not upload.parsed
+    facts = upload.facts if upload else None
+    if facts:
+        replay = facts.summary
+
+    if upload and request.method == 'GET':
+        if upload_pending:
+            flash(u'The replay is still being analysed. The form will be filled in as soon as it is done.', 'info')
+        elif not facts:
             flash(u'Error: Parsing replay file failed :-(.', 'error')
         else:
-            clan = replays.guess_clan(replay)
+            clan = facts.clan
             if clan not in config.CLAN_NAMES or clan != g.player.clan:
                 flash(
                     u'Error: "Friendly" clan was not in the list of clans '
                     u'supported by this website or you are not a member',
                     'error')
-            map_name = constants.MAP_EN_NAME_BY_ID.get(replay['first']['mapName'], 'Unknown')
+            map_name = facts.map_name
             all_players = Player.query.filter_by(clan=clan, locked=False).order_by('lower(name)')
-            players = Player.query.filter(Player.name.in_(replays.player_team(replay))).order_by('lower(name)').all()
+            players = Player.query.filter(Player.name.in_(facts.team)).order_by('lower(name)').all()
             if g.player in players:
                 battle_commander = g.player.id
-            date = datetime.datetime.strptime(replay['first']['dateTime'], '%d.%m.%Y %H:%M:%S')
-            stronghold = replays.is_stronghold(replay)
+            date = facts.date
+            stronghold = facts.stronghold
 
-            if not replay['second']:
+            if not facts.complete:
                 flash(u'Error: Uploaded replay file is incomplete (Battle was left before it ended). ' +
                       u'Can not determine all information automatically.', 'error')
-            elif not replays.is_cw(replay) and not replays.is_stronghold(replay):
+            elif not facts.cw and not facts.stronghold:
                 flash(
                     u'Error: Uploaded replay file is probably not from a clan war or stronghold battle '
                     u'(Detected different clan tags in one of the team' +
                     u' or players from the same clan on both sides)', 'error')
             else:
-                enemy_clan = replays.guess_enemy_clan(replay)
-                if replays.player_won(replay):
+                enemy_clan = facts.enemy_clan
+                if facts.won:
                     battle_result = 'victory'
 
-            if replay['second']:
-                duration = int(replay['second'][0]['common']['duration'])
+            if facts.complete:
+                duration = facts.duration
             else:
                 flash('Warning. Replay seems to be incomplete (detailed battle information is missing). '
                       'Cannot determine battle duration automatically and replay cannot be used in player performance'
@@ -721,8 +771,6 @@ def create_battle():
 
     if request.method == 'POST':
         players = map(int, request.form.getlist('players'))
-        filename = request.form.get('filename', '')
-        folder = request.form.get('folder', '')
         map_name = request.form.get('map_name', '')
         province = request.form.get('province', '')
         enemy_clan = request.form.get('enemy_clan', '')
@@ -735,7 +783,6 @@ def create_battle():
         battle_group_title = request.form.get('battle_group_title', '')
         battle_group_description = request.form.get('battle_group_description', '')
         battle_group_final = request.form.get('battle_group_final', '') == 'on'
-        file_blob = None
 
         errors = False
         date = None
@@ -746,14 +793,15 @@ def create_battle():
             errors = True
 
         # Validation
-        if filename:
-            file_blob = open(os.path.join(app.config['UPLOAD_FOLDER'], folder, secure_filename(filename)), 'rb').read()
-        else:
-            if not 'replay' in request.files or not request.files['replay']:
-                flash(u'No replay selected', 'error')
-                errors = True
-            else:
-                file_blob = request.files['replay'].read()
+        if not upload:
+            flash(u'No replay selected', 'error')
+            errors = True
+        elif upload.parsed and not facts:
+            flash(u'Error: Parsing replay file failed :-(.', 'error')
+            errors = True
+        elif not upload.content_hash:
+            flash(u'The replay is still being analysed, please try again in a few seconds', 'error')
+            errors = True
         if not map_name:
             flash(u'Please enter the name of the map', 'error')
             errors = True
@@ -772,6 +820,9 @@ def create_battle():
         if not duration:
             flash(u'Please provide the duration of the battle', 'errors')
             errors = True
+        if upload and upload.content_hash and duplicate_replay_battle_id(upload.content_hash):
+            flash(u'This replay was already uploaded', 'error')
+            errors = True
 
         battle = Battle.query.filter_by(date=date, clan=g.player.clan, enemy_clan=enemy_clan).first()
         if battle:
@@ -802,42 +853,36 @@ def create_battle():
                             battle_commander=battle_commander, description=description,
                             duration=duration)
 
-            if replays.is_stronghold(replay):
-                battle.stronghold = True
-
             if bg:
                 battle.battle_group_final = battle_group_final
                 battle.battle_group = bg
+                bg.invalidate_members()
                 db_session.add(bg)
 
-            if config.STORE_REPLAYS_IN_DB:
-                battle.replay = Replay(file_blob, pickle.dumps(replay))
-            else:
-                battle.replay = Replay(None, pickle.dumps(replay))
-
-            battle.replay.player_name = replay['first']['playerName']
-            if replay['second']:
-                battle.score_own_team, battle.score_enemy_team = replays.score(replay)
-            else:
-                battle.score_own_team, battle.score_enemy_team = 0, 0
+            # The replay data, fingerprint, score and stronghold resources are filled in by the background parsing
+            battle.replay = Replay(None, None)
+            battle.replay.content_hash = upload.content_hash
+            battle.replay.pending = True
 
             for player_id in players:
                 player = Player.query.get(player_id)
                 if not player:
                     abort(404)
                 ba = BattleAttendance(player, battle, reserve=False)
-                if battle.stronghold:
-                    ba.resources_earned = replays.resources_earned(replay['second'], player.wot_id) or 0
                 db_session.add(ba)
 
             db_session.add(battle)
+            # joining an existing landing tournament adds players to the battles counted for its final
+            ClanGeneration.bump(battle.clan, attendances=battle_group >= 0)
             db_session.commit()
+            tasks.parse_and_attach_replay.delay(battle.replay.id, upload.folder, upload.token)
             logger.info(g.player.name + " added the battle " + str(battle.id))
             return redirect(url_for('battles_list', clan=g.player.clan))
 
     return render_template('battles/create.html', CLAN_NAMES=config.CLAN_NAMES, all_players=all_players,
                            players=players, USER_TIMEZONES=config.USER_TIMEZONES, usertimezone=usertimezone,
-                           enemy_clan=enemy_clan, filename=filename, folder=folder, replay=replay,
+                           enemy_clan=enemy_clan, filename=filename, folder=upload.folder if upload else '',
+                           upload=upload.token if upload else '', upload_pending=upload_pending, replay=replay,
                            battle_commander=battle_commander,
                            map_name=map_name, province=province, description=description, replays=replays,
                            battle_result=battle_result, date=date, battle_groups=battle_groups,
@@ -868,8 +913,17 @@ def battles_list(clan):
     return render_template('battles/battles.html', clan=clan)
 
 
+# Values of the battle list rows and permission flags, rendered by battles/battles.html
+BATTLE_TYPE_NORMAL, BATTLE_TYPE_LANDING, BATTLE_TYPE_FINAL, BATTLE_TYPE_STRONGHOLD = range(4)
+OUTCOME_DEFEAT, OUTCOME_VICTORY, OUTCOME_DRAW = range(3)
+ATTENDANCE_NONE, ATTENDANCE_PLAYER, ATTENDANCE_RESERVE = range(3)
+BATTLE_LIST_SIGN_RESERVE, BATTLE_LIST_DELETE, BATTLE_LIST_EDIT = 1, 2, 4
+
+
 @app.route('/battles/list/<clan>/json')
+@read_replica
 @require_login
+@etag_by_generation(lambda clan: [clan])
 def battles_list_json(clan):
     if not clan in config.CLAN_NAMES:
         abort(404)
@@ -955,63 +1009,46 @@ def battles_list_json(clan):
     battle_count = db_session.execute(select([func.count()]).select_from(battles.alias('battles'))).first()[0]
     battles = list(db_session.execute(battles.offset(offset).limit(limit)))
 
+    permissions = 0
+    if g.player.clan == clan and g.RESERVE_SIGNUP_ALLOWED:
+        permissions |= BATTLE_LIST_SIGN_RESERVE
+    if g.player.name in config.ADMINS or g.player.role in g.DELETE_BATTLE_ROLES and g.player.clan == clan:
+        permissions |= BATTLE_LIST_DELETE
+    if g.player.name in config.ADMINS or g.player.role in g.CREATE_BATTLE_ROLES and g.player.clan == clan:
+        permissions |= BATTLE_LIST_EDIT
+
     def make_row(battle):
         if battle.stronghold:
-            type = "Stronghold"
+            battle_type = BATTLE_TYPE_STRONGHOLD
         elif battle.battle_group_id:
-            type = '<a href="' + url_for('battle_group_details', group_id=battle.battle_group_id) + '">'
-            if battle.battle_group_final:
-                type += 'Final'
-            else:
-                type += 'Landing battle'
-            type += '</a>'
+            battle_type = BATTLE_TYPE_FINAL if battle.battle_group_final else BATTLE_TYPE_LANDING
         else:
-            type = 'Normal'
-
-        reserve_button = ''
-        if not battle.battle_group_id:
-            if g.player.clan == clan and g.RESERVE_SIGNUP_ALLOWED:
-                if not battle.was_player and not battle.was_reserve:
-                    reserve_button = '<a href="' + url_for('sign_as_reserve',
-                                                           battle_id=battle.id) + '" class="confirm-sign btn btn-primary btn-sm">Sign as reserve</a>'
-                elif battle.was_reserve:
-                    reserve_button = '<a href="' + url_for('unsign_as_reserve',
-                                                           battle_id=battle.id) + '" class="btn btn-danger btn-sm">Remove from reserve</a>'
-
-        buttons = ''
-        if not battle.battle_group_id:
-            if g.player.name in config.ADMINS or g.player.role in g.DELETE_BATTLE_ROLES and g.player.clan == clan:
-                buttons += '<a href="' + url_for('delete_battle',
-                                                 battle_id=battle.id) + '" class="confirm-delete btn btn-danger btn-sm" title="Delete battle"><i class="icon-remove"></i></a>'
-            if g.player.name in config.ADMINS or g.player.role in g.CREATE_BATTLE_ROLES and g.player.clan == clan:
-                buttons += '<a href="' + url_for('edit_battle',
-                                                 battle_id=battle.id) + '" class="btn btn-primary btn-sm" title="Edit battle"><i class="icon-pencil"></i></a>'
-        else:
-            buttons += '<a href="' + url_for('battle_group_details',
-                                             group_id=battle.battle_group_id) + '" class="btn btn-primary btn-sm" title="Show landing battles"><i class="icon-list"></i></a>'
+            battle_type = BATTLE_TYPE_NORMAL
 
         return [
             battle.id,
-            '<a href="' + url_for('battle_details', battle_id=battle.id) + '">' + battle.date.strftime(
-                '%d.%m.%Y %H:%M:%S') + '</a>',
-            type,
+            calendar.timegm(battle.date.timetuple()) * 1000,
+            battle_type,
+            battle.battle_group_id,
             battle.map_name,
             battle.map_province,
-            '<span class="' + battle.commander_role + '">' + battle.commander_name + '</span>',
-            '<span class="' + battle.outcome.lower() + '">' + battle.outcome + '</span>',
-            "%d-%d" % (battle.score_own_team or 0, battle.score_enemy_team or 0),
+            battle.commander_name,
+            battle.commander_role,
+            OUTCOME_VICTORY if battle.victory else OUTCOME_DRAW if battle.draw else OUTCOME_DEFEAT,
+            battle.score_own_team or 0,
+            battle.score_enemy_team or 0,
             battle.enemy_clan,
             battle.players,
             battle.reserves,
-            reserve_button,
-            buttons,
-            '<span class="label label-success">paid</span>' if battle.paid else '',
+            ATTENDANCE_PLAYER if battle.was_player else ATTENDANCE_RESERVE if battle.was_reserve else ATTENDANCE_NONE,
+            bool(battle.paid),
         ]
 
     response = {
         'iTotalRecords': battle_count,
         'iTotalDisplayRecords': battle_count,
-        'sEcho': int(request.args.get('sEcho')),
+        'sEcho': int(request.args.get('sEcho', 0)),
+        'permissions': permissions,
         'aaData': [make_row(battle) for battle in battles]
     }
     return jsonify(response)
@@ -1025,7 +1062,7 @@ def battle_group_details(group_id):
     :param group_id:
     :return:
     """
-    bg = BattleGroup.query.options(joinedload_all('battles.attendances.player')).get(group_id) or abort(404)
+    bg = BattleGroup.with_battles().get(group_id) or abort(404)
 
     return render_template('battles/battle_group.html', battle_group=bg, battles=bg.battles,
                            clan=bg.clan)
@@ -1040,7 +1077,13 @@ def battle_details(battle_id):
     :return:
     """
     battle = Battle.query.get(battle_id) or abort(404)
-    return render_template('battles/battle.html', battle=battle, replays=replays)
+    view = battle.view_model()
+    # store the view model if it was (re)computed
+    db_session.commit()
+    is_player = g.player.id in set(p['id'] for p in view['players'])
+    is_reserve = g.player.id in set(p['id'] for p in view['reserves'])
+    return render_template('battles/battle.html', battle=battle, view=view, is_player=is_player,
+                           is_reserve=is_reserve)
 
 
 @app.route('/battles/<int:battle_id>/delete')
@@ -1057,103 +1100,91 @@ def delete_battle(battle_id):
         abort(403)
     for ba in battle.attendances:
         db_session.delete(ba)
+    battle.invalidate_view_model()
+    battle.set_fingerprint(None)
     if battle.battle_group and len(battle.battle_group.battles) == 1:
         # last battle in battle group, delete the group as well
         db_session.delete(battle.battle_group)
     db_session.delete(battle)
+    ClanGeneration.bump(battle.clan, attendances=True)
     logger.info(g.player.name + " deleted the battle " + str(battle.id) + " " + str(battle))
     db_session.commit()
 
     return redirect(url_for('battles_list', clan=g.player.clan))
 
 
-@app.route('/players/<clan>')
-@require_login
-def clan_players(clan):
+def render_clan_players(clan, export_csv):
     """
-        List of players with participation of a clan.
+        Render the participation table of clan_players.
     :param clan:
-    :return:
+    :param export_csv: True for CSV, otherwise HTML
+    :return: str
     """
-    if not clan in config.CLAN_NAMES:
-        abort(404)
-    players = Player.query.options(joinedload_all('battles.battle')).filter_by(clan=clan, locked=False).all()
-    possible = defaultdict(int)
-    reserve = defaultdict(int)
-    played = defaultdict(int)
-    present = defaultdict(int)
-    clan_battles = Battle.query.options(joinedload_all('attendances.player')).filter_by(clan=clan).order_by(
-        'date asc').all()
-    battle_groups = BattleGroup.query.options(joinedload_all('battles.attendances.player')).filter_by(clan=clan).all()
+    battle_groups = BattleGroup.query.options(undefer('members_cache')).filter_by(clan=clan).all()
+    BattleGroup.preload_members(battle_groups)
     players_by_battle_group_id = dict()
     reserves_by_battle_group_id = dict()
     for bg in battle_groups:
-        players_by_battle_group_id[bg.id] = bg.get_players()
-        reserves_by_battle_group_id[bg.id] = bg.get_reserves()
-
-    last_battle_by_player = dict()
-    for p in players:
-        last_battle = None
-        for ba in p.battles:
-            if ba.battle.clan == p.clan and (last_battle is None or ba.battle.date > last_battle.date):
-                last_battle = ba.battle
-        last_battle_by_player[p] = last_battle
-
-    for player in players:
-        for battle in clan_battles:
-            if battle.date < player.member_since:
-                continue
-            if battle.battle_group_id and not battle.battle_group_final:
-                continue  # only finals will count
-            possible[player] += 1
-
-            if battle.battle_group_id:
-                if player in players_by_battle_group_id[battle.battle_group_id]:
-                    played[player] += 1
-                    present[player] += 1
-                elif player in reserves_by_battle_group_id[battle.battle_group_id]:
-                    reserve[player] += 1
-                    present[player] += 1
-            else:
-                if battle.has_player(player):
-                    played[player] += 1
-                    present[player] += 1
-                elif battle.has_reserve(player):
-                    reserve[player] += 1
-                    present[player] += 1
+        players_by_battle_group_id[bg.id] = bg.get_player_ids()
+        reserves_by_battle_group_id[bg.id] = bg.get_reserve_ids()
 
-    # 30 days stats
-    oldest_date = datetime.datetime.now() - datetime.timedelta(days=30)
+    players = Player.query.filter_by(clan=clan, locked=False).all()
+    possible = defaultdict(int)
+    reserve = defaultdict(int)
+    played = defaultdict(int)
+    present = defaultdict(int)
     possible30 = defaultdict(int)
     reserve30 = defaultdict(int)
     played30 = defaultdict(int)
     present30 = defaultdict(int)
-    clan_battles = Battle.query.options(joinedload_all('attendances.player')) \
-        .filter_by(clan=clan).filter(Battle.date > oldest_date).order_by('date asc').all()
-    for player in players:
-        for battle in clan_battles:
+    clan_battles = rows.battle_rows(Battle.clan == clan)
+    battles_by_id = dict((battle.id, battle) for battle in clan_battles)
+
+    players_by_battle_id = defaultdict(set)
+    reserves_by_battle_id = defaultdict(set)
+    last_battle_by_player_id = dict()
+    for ba in rows.attendance_rows(Battle.clan == clan):
+        (reserves_by_battle_id if ba.reserve else players_by_battle_id)[ba.battle_id].add(ba.player_id)
+        battle = battles_by_id[ba.battle_id]
+        last_battle = last_battle_by_player_id.get(ba.player_id)
+        if last_battle is None or battle.date > last_battle.date:
+            last_battle_by_player_id[ba.player_id] = battle
+    last_battle_by_player = dict((p, last_battle_by_player_id.get(p.id)) for p in players)
+
+    # 30 days stats
+    oldest_date = datetime.datetime.now() - datetime.timedelta(days=30)
+    for battle in clan_battles:
+        if battle.battle_group_id and not battle.battle_group_final:
+            continue  # only finals will count
+        if battle.battle_group_id:
+            battle_players = players_by_battle_group_id[battle.battle_group_id]
+            battle_reserves = reserves_by_battle_group_id[battle.battle_group_id]
+        else:
+            battle_players = players_by_battle_id[battle.id]
+            battle_reserves = reserves_by_battle_id[battle.id]
+        recent = battle.date > oldest_date
+
+        for player in players:
             if battle.date < player.member_since:
                 continue
-            if battle.battle_group_id and not battle.battle_group_final:
-                continue  # only finals will count
-            possible30[player] += 1
+            possible[player] += 1
+            if recent:
+                possible30[player] += 1
 
-            if battle.battle_group:
-                if player in players_by_battle_group_id[battle.battle_group_id]:
+            if player.id in battle_players:
+                played[player] += 1
+                present[player] += 1
+                if recent:
                     played30[player] += 1
                     present30[player] += 1
-                elif player in reserves_by_battle_group_id[battle.battle_group_id]:
-                    reserve30[player] += 1
-                    present30[player] += 1
-            else:
-                if battle.has_player(player):
-                    played30[player] += 1
-                    present30[player] += 1
-                elif battle.has_reserve(player):
+            elif player.id in battle_reserves:
+                reserve[player] += 1
+                present[player] += 1
+                if recent:
                     reserve30[player] += 1
                     present30[player] += 1
 
-    if request.args.has_key('csv'):
+    if export_csv:
         csv_response = StringIO()
         csv_writer = csv.writer(csv_response)
         csv_writer.writerow(["Name", "Position", "Member Since", "Played", "Reserve", "#possible", "Played",
@@ -1169,20 +1200,41 @@ def clan_players(clan):
                                     last_battle_by_player[player] else '',
                                  player.gold_earned
             ])
+        return csv_response.getvalue()
 
+    return render_template('players/players_table.html', players=players,
+                           played=played, present=present, possible=possible, reserve=reserve,
+                           played30=played30, present30=present30, possible30=possible30,
+                           last_battle_by_player=last_battle_by_player)
+
+
+@app.route('/players/<clan>')
+@read_replica
+@require_login
+def clan_players(clan):
+    """
+        List of players with participation of a clan.
+    :param clan:
+    :return:
+    """
+    if not clan in config.CLAN_NAMES:
+        abort(404)
+
+    export_csv = request.args.has_key('csv')
+    content = page_cache.get('clan_players', clan, ('csv' if export_csv else 'html') + current_hour(),
+                             lambda: render_clan_players(clan, export_csv))
+    if export_csv:
         headers = Headers()
         headers.add('Content-Type', 'text/csv')
         headers.add('Content-Disposition', 'attachment',
                     filename=secure_filename(clan + "_players.csv"))
-        return Response(response=csv_response.getvalue(), headers=headers)
+        return Response(response=content, headers=headers)
 
-    return render_template('players/players.html', clan=clan, players=players,
-                           played=played, present=present, possible=possible, reserve=reserve,
-                           played30=played30, present30=present30, possible30=possible30,
-                           last_battle_by_player=last_battle_by_player)
+    return render_template('players/players.html', clan=clan, players_table=jinja2.Markup(content))
 
 
 @app.route('/players/<int:player_id>')
+@read_replica
 def player_details(player_id):
     """
         Player details page.
@@ -1191,43 +1243,55 @@ def player_details(player_id):
     """
     player = Player.query.get(player_id) or abort(404)
 
-    # current month stats
+    # current month unless a window is given
     today = datetime.datetime.now()
     oldest_date = datetime.datetime(today.year, today.month, 1)
-    possible = 0
-    reserve = 0
-    played = 0
-    present = 0
-    wins = 0
-    clan_battles = Battle.query.options(joinedload_all('attendances.player')) \
-        .filter_by(clan=player.clan).filter(Battle.date > oldest_date).order_by('date asc').all()
-    for battle in clan_battles:
-        if battle.date < player.member_since:
-            continue
-        if battle.battle_group_id and not battle.battle_group_final:
-            continue  # only finals will count
-        possible += 1
-
-        if battle.battle_group:
-            if player in battle.battle_group.get_players():
-                if battle.victory:
-                    wins += 1
-                played += 1
-                present += 1
-            elif player in battle.battle_group.get_reserves():
-                reserve += 1
-                present += 1
-        else:
-            if battle.has_player(player):
-                if battle.victory:
-                    wins += 1
-                played += 1
-                present += 1
-            elif battle.has_reserve(player):
-                reserve += 1
-                present += 1
-    return render_template('players/player.html', player=player, possible=possible, present=present, played=played,
-                           reserve=reserve, oldest_date=oldest_date, wins=wins)
+    newest_date = None
+    try:
+        if request.args.get('fromDate'):
+            oldest_date = datetime.datetime.strptime(request.args['fromDate'], '%d.%m.%Y')
+        if request.args.get('toDate'):
+            newest_date = datetime.datetime.strptime(request.args['toDate'], '%d.%m.%Y') + datetime.timedelta(days=1)
+    except ValueError:
+        flash(u'Invalid date, use the format dd.mm.yyyy')
+        oldest_date, newest_date = datetime.datetime(today.year, today.month, 1), None
+
+    possible, played, reserve, wins = player_participation(player, oldest_date, newest_date)
+    return render_template('players/player.html', player=player, possible=possible, present=played + reserve,
+                           played=played, reserve=reserve, wins=wins, oldest_date=oldest_date,
+                           newest_date=newest_date and newest_date - datetime.timedelta(days=1),
+                           custom_window='fromDate' in request.args or 'toDate' in request.args)
+
+
+def player_participation(player, from_date, to_date=None):
+    """
+        Count the clan battles between from_date and to_date (exclusive, open if None) the player could have
+        attended since joining the clan and how many of them the player played (and won) or was reserve in.
+        Of grouped battles only the final counts, attending any battle of the group counts as attending it.
+    :return: (possible, played, reserve, wins)
+    """
+    group_battle = alias(Battle.__table__)
+
+    def attended(as_reserve):
+        """ attendance of the player in the battle itself or any battle of its group """
+        return exists().where(and_(BattleAttendance.player_id == player.id,
+                                   BattleAttendance.reserve == as_reserve,
+                                   BattleAttendance.battle_id == group_battle.c.id,
+                                   or_(group_battle.c.id == Battle.id,
+                                       group_battle.c.battle_group_id == Battle.battle_group_id)))
+
+    played = attended(False)
+    reserve = and_(attended(True), not_(played))
+
+    query = db_session.query(func.count(Battle.id),
+                             func.sum(case([(played, 1)], else_=0)),
+                             func.sum(case([(reserve, 1)], else_=0)),
+                             func.sum(case([(and_(played, Battle.victory == True), 1)], else_=0))) \
+        .filter(Battle.clan == player.clan, Battle.date >= from_date, Battle.date >= player.member_since) \
+        .filter(or_(Battle.battle_group_id == None, Battle.battle_group_final == True))
+    if to_date is not None:
+        query = query.filter(Battle.date < to_date)
+    return tuple(int(value or 0) for value in query.one())
 
 
 @app.route('/battles/<int:battle_id>/sign-reserve')
@@ -1254,6 +1318,8 @@ def sign_as_reserve(battle_id):
     if not battle.has_player(g.player) and not battle.has_reserve(g.player):
         ba = BattleAttendance(g.player, battle, reserve=True)
         db_session.add(ba)
+        battle.invalidate_view_model()
+        ClanGeneration.bump(battle.clan, attendances=True)
         logger.info(g.player.name + " signed himself as reserve for " + str(battle))
         db_session.commit()
 
@@ -1285,6 +1351,8 @@ def unsign_as_reserve(battle_id):
 
     ba = BattleAttendance.query.filter_by(player=g.player, battle=battle, reserve=True).first() or abort(500)
     db_session.delete(ba)
+    battle.invalidate_view_model()
+    ClanGeneration.bump(battle.clan, attendances=True)
     logger.info(g.player.name + " removed himself as reserve for " + str(battle))
     db_session.commit()
 
@@ -1345,6 +1413,8 @@ def download_additional_replay(replay_id):
 def delete_replay(replay_id):
     replay = Replay.query.get(replay_id) or abort(404)
     battle_id = replay.associated_battle_id
+    if replay.associated_battle:
+        replay.associated_battle.invalidate_view_model()
 
     db_session.delete(replay)
     db_session.commit()
@@ -1394,6 +1464,7 @@ def payout(clan):
 
 
 @app.route('/payout/reserve-conflicts/<clan>')
+@read_replica
 @require_login
 @require_role(config.PAYOUT_ROLES)
 @require_clan_membership
@@ -1415,7 +1486,7 @@ def reserve_conflicts(clan):
                 reserve_count[player] += 1
         return sorted([p for p in reserve_count if reserve_count[p] > 1], key=lambda p: p.name)
 
-    battles = Battle.query.options(joinedload('attendances')).filter_by(clan=clan).order_by('date asc').all()
+    battles = Battle.with_roster().filter_by(clan=clan).order_by('date asc').all()
     all_reserve_conflicts = OrderedDict()
     for battle in battles:
         overlaps = overlapping_battles(battle, battles)
@@ -1426,6 +1497,22 @@ def reserve_conflicts(clan):
     return render_template('payout/reserve_conflicts.html', reserve_conflicts=all_reserve_conflicts)
 
 
+def payout_parameters(values):
+    """
+        Parse the parameters of a payout calculation from the request values.
+    :return: (from_date, to_date, victories_only, gold, recruit_factor, points_per_resource)
+    """
+    from_date = datetime.datetime.strptime(values['fromDate'], '%d.%m.%Y')
+    to_date = datetime.datetime.strptime(values['toDate'], '%d.%m.%Y') + datetime.timedelta(days=1)
+    return (from_date, to_date, values.get('victories_only') == 'on', int(values['gold']),
+            float(values['recruit_factor']), float(values['points_per_resource']))
+
+
+def payout_attendance(clan, from_date, to_date, victories_only):
+    return page_cache.get('payout', clan, '%s-%s-%s' % (from_date.date(), to_date.date(), victories_only),
+                          lambda: incremental_counts(clan, from_date, to_date, victories_only))
+
+
 @app.route('/payout/<clan>/battles', methods=['GET', 'POST'])
 @require_login
 @require_role(config.PAYOUT_ROLES)
@@ -1436,118 +1523,74 @@ def payout_battles(clan):
     :param clan:
     :return:
     """
-    if request.method == 'POST':
-        from_date = request.form['fromDate']
-        to_date = request.form['toDate']
-        gold = int(request.form['gold'])
-        victories_only = request.form.get('victories_only', False)
-        recruit_factor = request.form['recruit_factor']
-        points_per_resource = float(request.form['points_per_resource'])
-    else:
-        from_date = request.args.get('fromDate')
-        to_date = request.args.get('toDate')
-        gold = int(request.args.get('gold'))
-        victories_only = request.args.get('victories_only', False) == 'on'
-        recruit_factor = float(request.args.get('recruit_factor'))
-        points_per_resource = float(request.args.get('points_per_resource'))
-
-    from_date = datetime.datetime.strptime(from_date, '%d.%m.%Y')
-    to_date = datetime.datetime.strptime(to_date, '%d.%m.%Y') + datetime.timedelta(days=1)
-    battles = Battle.query.options(joinedload('attendances')).filter_by(clan=clan).filter(
-        Battle.date >= from_date, Battle.date <= to_date,
-        or_(Battle.battle_group_id == None, Battle.battle_group_final == True))
-    if victories_only:
-        battles = battles.filter_by(victory=True)
-    battles = battles.all()
-
+    from_date, to_date, victories_only, gold, recruit_factor, points_per_resource = \
+        payout_parameters(request.form if request.method == 'POST' else request.args)
+    attendance = payout_attendance(clan, from_date, to_date, victories_only)
     clan_members = Player.query.filter_by(clan=clan, locked=False).all()
-    player_fced = defaultdict(int)
-    player_fced_win = defaultdict(int)
-    player_fced_defeat = defaultdict(int)
-    player_fced_draws = defaultdict(int)
-    player_played = defaultdict(int)
-    player_reserve = defaultdict(int)
-    player_victories = defaultdict(int)
-    player_defeats = defaultdict(int)
-    player_draws = defaultdict(int)
-    player_resources = defaultdict(int)
+    players, player_points, player_gold = distribute(attendance, clan_members, gold, recruit_factor,
+                                                     points_per_resource)
 
-    for battle in battles:
-        if battle.battle_group and not battle.battle_group_final:
-            continue  # only finals count
+    return render_template('payout/payout_battles.html', battle_count=len(attendance.battle_ids), clan=clan,
+                           fromDate=from_date, toDate=to_date - datetime.timedelta(days=1),
+                           counts=attendance.players, players=players,
+                           player_gold=player_gold, gold=gold, victories_only=victories_only,
+                           recruit_factor=recruit_factor, player_points=player_points,
+                           points_per_resource=points_per_resource)
 
-        if battle.battle_group and battle.battle_group_final:
-            battle_players = battle.battle_group.get_players()
-            battle_reserves = battle.battle_group.get_reserves()
-        else:
-            battle_players = battle.get_players()
-            battle_reserves = battle.get_reserve_players()
 
-        if battle.stronghold:
-            for ba in battle.attendances:
-                player_resources[ba.player] += ba.resources_earned or 0
-            continue
-
-        battle_commander = battle.battle_commander
-        if not battle_commander.locked:
-            player_fced[battle_commander] += 1
-            if battle.victory:
-                player_fced_win[battle_commander] += 1
-            elif battle.draw:
-                player_fced_draws[battle_commander] += 1
-            else:
-                player_fced_defeat[battle_commander] += 1
+@app.route('/payout/<clan>/runs', methods=['GET', 'POST'])
+@require_login
+@require_role(config.PAYOUT_ROLES)
+@require_clan_membership
+def payout_runs(clan):
+    """
+        List of the saved payout runs. POST saves a payout run with the parameters of the
+        payout calculation page.
+    :param clan:
+    :return:
+    """
+    if request.method == 'POST':
+        from_date, to_date, victories_only, gold, recruit_factor, points_per_resource = payout_parameters(request.form)
+        mark_paid = request.form.get('mark_paid') == 'on'
+        attendance = payout_attendance(clan, from_date, to_date, victories_only)
+        clan_members = Player.query.filter_by(clan=clan, locked=False).all()
+        try:
+            run = save_run(clan, from_date, to_date, victories_only, gold, recruit_factor, points_per_resource,
+                           attendance, clan_members, g.player, mark_paid)
+        except AlreadyPaid:
+            db_session.rollback()
+            flash(u'Some of the battles were already marked as paid, save the payout without marking them as paid',
+                  'error')
+            return redirect(url_for('payout_battles', clan=clan, fromDate=from_date.strftime('%d.%m.%Y'),
+                                    toDate=(to_date - datetime.timedelta(days=1)).strftime('%d.%m.%Y'),
+                                    gold=gold, recruit_factor=recruit_factor, points_per_resource=points_per_resource,
+                                    victories_only='on' if victories_only else None))
+        if mark_paid:
+            ClanGeneration.bump(clan)
+        db_session.commit()
+        logger.info(g.player.name + " saved the payout run " + str(run.id) + " of " + str(gold) + " gold for " +
+                    str(len(attendance.battle_ids)) + " battles" + (" and marked them as paid" if mark_paid else ""))
+        return redirect(url_for('payout_run_details', clan=clan, run_id=run.id))
 
-        for p in battle_players:
-            if p.locked or p == battle_commander:
-                continue
-            player_played[p] += 1
-            if battle.victory:
-                player_victories[p] += 1
-            elif battle.draw:
-                player_draws[p] += 1
-            else:
-                player_defeats[p] += 1
+    runs = PayoutRun.query.options(joinedload('creator')).filter_by(clan=clan).order_by(PayoutRun.id.desc()).all()
+    return render_template('payout/runs.html', clan=clan, runs=runs)
 
-        for p in battle_reserves:
-            if p.locked:
-                continue
-            player_reserve[p] += 1
-
-    players = set()
-    for p in clan_members:
-        if player_played[p] or player_reserve[p] or player_fced[p] or player_resources[p]:
-            players.add(p)
-
-    player_points = dict()
-    for p in players:
-        player_points[p] = player_fced_win[p] * 6 + player_fced_defeat[p] * 4 + player_fced_draws[p] * 2 + \
-                           player_victories[p] * 3 + player_defeats[p] * 2 + player_draws[p] * 2 + player_reserve[p] + \
-                           player_resources[p] * points_per_resource
-
-    total_points = sum(player_points[p] for p in players)
-    recruit_points = sum(player_points[p] for p in players if p.is_recruit())
-    others_points = total_points - recruit_points
-    others_gold_per_point = float(gold) / (recruit_factor * recruit_points + others_points)
-    recruit_gold_per_point = recruit_factor * others_gold_per_point
-    player_gold = dict()
-    for p in players:
-        if p.is_recruit():
-            player_gold[p] = int(round(player_points[p] * recruit_gold_per_point))
-        else:
-            player_gold[p] = int(round(player_points[p] * others_gold_per_point))
 
-    return render_template('payout/payout_battles.html', battles=battles, clan=clan, fromDate=from_date, toDate=to_date,
-                           player_played=player_played, player_reserve=player_reserve, players=players,
-                           player_gold=player_gold, gold=gold, player_defeats=player_defeats,
-                           player_fced_win=player_fced_win, victories_only=victories_only, recruit_factor=recruit_factor,
-                           player_fced_defeat=player_fced_defeat, player_victories=player_victories,
-                           player_fced_draws=player_fced_draws, player_draws=player_draws, player_points=player_points,
-                           player_resources=player_resources, points_per_resource=points_per_resource)
+@app.route('/payout/<clan>/runs/<int:run_id>')
+@require_login
+@require_role(config.PAYOUT_ROLES)
+@require_clan_membership
+def payout_run_details(clan, run_id):
+    run = PayoutRun.query.filter_by(id=run_id, clan=clan).first() or abort(404)
+    run_players = PayoutRunPlayer.query.options(joinedload('player')).filter_by(run_id=run.id) \
+        .filter(PayoutRunPlayer.gold > 0).all()
+    return render_template('payout/run.html', clan=clan, run=run, battle_count=len(run.get_battle_ids()),
+                           run_players=sorted(run_players, key=lambda p: p.player.name))
 
 
 @app.route('/players/json')
 @require_login
+@etag_by_generation(lambda: [request.args.get('clan')])
 def players_json():
     clan = request.args.get('clan')
     players = Player.query.filter_by(clan=clan, locked=False).all()
@@ -1559,6 +1602,7 @@ def players_json():
 
 @app.route('/reserve-players/json/<clan>/<int:battle_id>')
 @require_login
+@etag_by_generation(lambda clan, battle_id: [clan, db_session.query(Battle.clan).filter_by(id=battle_id).scalar()])
 def reserve_players_json(clan, battle_id):
     battle = Battle.query.get(battle_id) or abort(404)
     battle_player_ids = [p.id for p in (battle.get_players() + battle.get_reserve_players())]
@@ -1591,6 +1635,8 @@ def battle_reserves_update(battle_id):
         reserve_now.add(player)
         ba = BattleAttendance(player, battle, reserve=True)
         db_session.add(ba)
+    battle.invalidate_view_model()
+    ClanGeneration.bump(battle.clan, attendances=True)
     db_session.commit()
     logger.info(g.player.name + " updated the reserves for " + str(battle) + " - added: " +
                 ", ".join([p.name for p in (reserve_now - reserve_before)]) + " - deleted: " +
@@ -1599,8 +1645,10 @@ def battle_reserves_update(battle_id):
 
 
 @app.route('/payout/battles')
+@read_replica
 @require_login
 @require_role(config.PAYOUT_ROLES)
+@etag_by_generation(lambda: [request.args.get('clan')])
 def payout_battles_json():
     """
         Ajax request handler for battles on the payout page.
@@ -1624,12 +1672,7 @@ def payout_battles_json():
     from_date = datetime.datetime.strptime(from_date, '%d.%m.%Y')
     to_date = datetime.datetime.strptime(to_date, '%d.%m.%Y') + datetime.timedelta(days=1)
     victories_only = request.args.get('victories_only', False) == 'on'
-    battles = Battle.query.filter_by(clan=clan).filter(Battle.date >= from_date, Battle.date <= to_date,
-                                                       or_(Battle.battle_group_id == None,
-                                                           Battle.battle_group_final == True))
-    if victories_only:
-        battles = battles.filter_by(victory=True)
-    battles = battles.all()
+    battles = battles_query(clan, from_date, to_date, victories_only).all()
     return jsonify({
         "sEcho": 1,
         "iTotalRecords": len(battles),
@@ -1648,15 +1691,19 @@ def payout_battles_json():
 @require_login
 @require_role(config.COMMANDED_ROLES)
 def players_commanded(clan):
-    commanders = Player.query.filter_by(locked=False, clan=clan).filter(Player.id.in_(db_session.query(Battle.battle_commander_id) \
-                                .distinct())).order_by(Player.name).all()
+    commanders = page_cache.get('players_commanded', clan, '', lambda: [
+        {'id': p.id, 'name': p.name} for p in
+        Player.query.filter_by(locked=False, clan=clan).filter(Player.id.in_(db_session.query(Battle.battle_commander_id) \
+                                .distinct())).order_by(Player.name)])
 
     return render_template('players/commanding.html', commanders=commanders, clan=clan)
 
 
 @app.route('/players/commanded-json')
+@read_replica
 @require_login
 @require_role(config.COMMANDED_ROLES)
+@etag_by_generation(lambda: config.CLAN_NAMES)  # commanders can lead battles of all clans
 def players_commanded_json():
     from_date = request.args.get('fromDate', None)
     to_date = request.args.get('toDate', None)
@@ -1668,57 +1715,53 @@ def players_commanded_json():
     commander = Player.query.get(int(request.args.get('commander_id'))) or abort(404)
     use_battle_groups = request.args.get('use_battle_groups', False) == 'on'
 
-    battles = Battle.query.options(joinedload_all('battle_group.battles')).options(
-        joinedload_all('attendances.player')).filter(Battle.date >= from_date).filter(Battle.date <= to_date) \
-                            .filter_by(battle_commander=commander)
+    battles = Battle.query.options(joinedload('attendances')).filter(Battle.date >= from_date) \
+        .filter(Battle.date <= to_date).filter_by(battle_commander=commander).all()
+    if use_battle_groups:
+        battle_groups = BattleGroup.query.options(undefer('members_cache')).filter(
+            BattleGroup.id.in_(set(b.battle_group_id for b in battles if b.battle_group_id))).all()
+        BattleGroup.preload_members(battle_groups)
+        player_ids_by_battle_group_id = dict((bg.id, bg.get_player_ids()) for bg in battle_groups)
     player_count = defaultdict(int)
     for battle in battles:
         if use_battle_groups:
             if battle.battle_group_id and battle.battle_group_final:
-                players = battle.battle_group.get_players()
+                player_ids = player_ids_by_battle_group_id[battle.battle_group_id]
             elif not battle.battle_group_id:
-                players = battle.get_players()
+                player_ids = [ba.player_id for ba in battle.attendances if not ba.reserve]
             else:
                 continue
         else:
-            players = battle.get_players()
+            player_ids = [ba.player_id for ba in battle.attendances if not ba.reserve]
 
-        for player in players:
-            player_count[player] += 1
+        for player_id in player_ids:
+            player_count[player_id] += 1
 
+    names = dict(db_session.query(Player.id, Player.name).filter(Player.id.in_(player_count.keys()))) \
+        if player_count else dict()
     return jsonify({
         "sEcho": 1,
         "iTotalRecords": len(player_count),
         "iTotalDisplayRecords": len(player_count),
         "aaData": [
-            (k.name,
+            (names[k],
              v) for k, v in player_count.iteritems()
         ]
     })
 
 
-@app.route('/statistics/<clan>')
-@require_login
-@require_clan_membership
-def clan_statistics(clan):
+def clan_statistics_data(clan):
     """
-        Display clan statistics such as number of battles played recently.
+        Compute the clan statistics displayed by clan_statistics.
     :param clan:
-    :return:
+    :return: Dictionary of template variables
     """
-    battles_query = Battle.query.filter_by(clan=clan)
-
-    battles = battles_query.all()
-    battles_won = battles_query.filter_by(victory=True).count()
-
-    battles_one_week_query = battles_query.filter(Battle.date >= datetime.datetime.now() - datetime.timedelta(days=7))
-    battles_one_week = battles_one_week_query.all()
-    battles_one_week_won = battles_one_week_query.filter_by(victory=True).count()
-
-    battles_thirty_days_query = battles_query.filter(
-        Battle.date >= datetime.datetime.now() - datetime.timedelta(days=30))
-    battles_thirty_days = battles_thirty_days_query.all()
-    battles_thirty_days_won = battles_thirty_days_query.filter_by(victory=True).count()
+    now = datetime.datetime.now()
+    battles = rows.battle_rows(Battle.clan == clan)
+    commander_names = dict(db_session.query(Player.id, Player.name).filter(
+        Player.id.in_(set(b.battle_commander_id for b in battles if b.battle_commander_id)))) if battles else {}
+    battles_one_week = [b for b in battles if b.date >= now - datetime.timedelta(days=7)]
+    battles_thirty_days = [b for b in battles if b.date >= now - datetime.timedelta(days=30)]
 
     # Battles played by map
     wins_by_commander = defaultdict(int)
@@ -1728,18 +1771,19 @@ def clan_statistics(clan):
     battles_by_enemy = defaultdict(int)
     wins_by_enemy = defaultdict(int)
     for battle in battles:
-        battles_by_commander[battle.battle_commander] += 1
+        commander = commander_names.get(battle.battle_commander_id)
+        battles_by_commander[commander] += 1
         battles_by_map[battle.map_name] += 1
         battles_by_enemy[battle.enemy_clan] += 1
         if battle.victory:
             wins_by_enemy[battle.enemy_clan] += 1
             victories_by_map[battle.map_name] += 1
-            wins_by_commander[battle.battle_commander] += 1
+            wins_by_commander[commander] += 1
     map_battles = sorted(list(battles_by_map.iteritems()), key=lambda m: m[1])
 
     win_ratio_by_commander = dict(
         (c, wins_by_commander[c] / float(battles_by_commander[c])) for c in battles_by_commander
-        if battles_by_commander[c] > 10)
+        if c is not None and battles_by_commander[c] > 10)
 
     # Win ratio by map
     win_ratio_by_map = dict()
@@ -1764,36 +1808,51 @@ def clan_statistics(clan):
             continue
         win_ratio_by_enemy_clan[enemy_clan] = float(wins_by_enemy[enemy_clan]) / battles_by_enemy[enemy_clan]
 
-    from datetime import timedelta
-    import calendar
-
     def weekrange(start, end):
         for n in range(int((end - start).days)):
             yield start + timedelta(days=n)
 
     battles_per_day = []
-    for start_date in weekrange(datetime.datetime.now() - datetime.timedelta(days=30), datetime.datetime.now()):
+    for start_date in weekrange(now - datetime.timedelta(days=30), now):
         end_date = start_date + datetime.timedelta(days=1)
-        day_battles = battles_query.filter(Battle.date >= start_date, Battle.date < end_date)
-        battles_per_day.append((calendar.timegm(start_date.timetuple()) * 1000, day_battles.count()))
+        day_battles = len([b for b in battles_thirty_days if start_date <= b.date < end_date])
+        battles_per_day.append((calendar.timegm(start_date.timetuple()) * 1000, day_battles))
+
+    players_joined = [{'name': p.name, 'member_since': p.member_since} for p in
+                      Player.query.filter_by(clan=clan).order_by('member_since desc').limit(10)]
+    players_left = [{'name': p.name, 'lock_date': p.lock_date} for p in
+                    Player.query.filter_by(clan=clan, locked=True).filter(Player.lock_date.isnot(None))
+                    .order_by('lock_date desc').limit(10)]
+
+    return dict(total_battles=len(battles), battles_won=len([b for b in battles if b.victory]),
+                battles_one_week=len(battles_one_week),
+                battles_one_week_won=len([b for b in battles_one_week if b.victory]),
+                battles_thirty_days=len(battles_thirty_days),
+                battles_thirty_days_won=len([b for b in battles_thirty_days if b.victory]),
+                map_battles=map_battles, players_joined=players_joined, players_left=players_left,
+                win_ratio_by_map=win_ratio_by_map, win_ratio_by_commander=win_ratio_by_commander,
+                wins_by_commander=dict(wins_by_commander), battles_by_commander=dict(battles_by_commander),
+                win_ratio_by_enemy_clan=win_ratio_by_enemy_clan, battles_by_enemy=dict(battles_by_enemy),
+                wins_by_enemy=dict(wins_by_enemy), battle_count_cutoff=battle_count_cutoff,
+                battles_per_day=battles_per_day)
 
-    players_joined = Player.query.filter_by(clan=clan).order_by('member_since desc').all()
-    players_left = Player.query.filter_by(clan=clan, locked=True) \
-        .filter(Player.lock_date.isnot(None)).order_by('lock_date desc').all()
 
-    return render_template('clan_stats.html', battles=battles, total_battles=len(battles),
-                           battles_one_week=battles_one_week, battles_one_week_won=battles_one_week_won,
-                           map_battles=map_battles, battles_won=battles_won, players_joined=players_joined,
-                           players_left=players_left, clan=clan,
-                           battles_thirty_days=battles_thirty_days, battles_thirty_days_won=battles_thirty_days_won,
-                           win_ratio_by_map=win_ratio_by_map, win_ratio_by_commander=win_ratio_by_commander,
-                           wins_by_commander=wins_by_commander, battles_by_commander=battles_by_commander,
-                           win_ratio_by_enemy_clan=win_ratio_by_enemy_clan, battles_by_enemy=battles_by_enemy,
-                           wins_by_enemy=wins_by_enemy, battle_count_cutoff=battle_count_cutoff,
-                           battles_per_day=battles_per_day)
+@app.route('/statistics/<clan>')
+@read_replica
+@require_login
+@require_clan_membership
+def clan_statistics(clan):
+    """
+        Display clan statistics such as number of battles played recently.
+    :param clan:
+    :return:
+    """
+    statistics = page_cache.get('clan_statistics', clan, current_hour(), lambda: clan_statistics_data(clan))
+    return render_template('clan_stats.html', clan=clan, **statistics)
 
 
 @app.route('/statistics/<clan>/players', methods=['GET', 'POST'])
+@read_replica
 @require_login
 @require_clan_membership
 @require_role(config.PLAYER_PERFORMANCE_ROLES)
@@ -1803,21 +1862,28 @@ def player_performance(clan):
     to_date = request.form.get('toDate', None)
 
     if from_date is None:
-        from_date = datetime.datetime.now() - datetime.timedelta(days=4*7)
+        from_date = datetime.datetime.combine(datetime.date.today(), datetime.time()) - datetime.timedelta(days=4*7)
     else:
         from_date = datetime.datetime.strptime(from_date, '%d.%m.%Y')
 
     if to_date is None:
+        # Battles added later bump the clan's generation, so the result may be cached for the whole day
         to_date = datetime.datetime.now()
     else:
         to_date = datetime.datetime.strptime(to_date, '%d.%m.%Y') + datetime.timedelta(days=1)
 
-    battles = Battle.query.options(joinedload('replay')).filter_by(clan=clan).filter(Battle.date>=from_date, Battle.date<=to_date).all()
-    players = Player.query.filter_by(clan=clan, locked=False).all()
+    def render_table():
+        from . import analysis
 
-    result = analysis.player_performance(battles, players)
+        battles = Battle.with_replay().filter_by(clan=clan).filter(Battle.date>=from_date, Battle.date<=to_date).all()
+        players = Player.query.filter_by(clan=clan, locked=False).all()
 
-    return render_template('players/performance.html', clan_players=players, result=result, clan=clan,
+        result = analysis.player_performance(battles, players)
+        return render_template('players/performance_table.html', clan_players=players, result=result)
+
+    table = page_cache.get('player_performance', clan,
+                           from_date.strftime('%Y%m%d') + '-' + to_date.strftime('%Y%m%d'), render_table)
+    return render_template('players/performance.html', performance_table=jinja2.Markup(table), clan=clan,
                            from_date=from_date, to_date=to_date)
 
 
@@ -1825,36 +1891,58 @@ def player_performance(clan):
 @require_login
 def profile():
     """ Player profile page """
-    clan_battles_query = Battle.query.filter_by(clan=g.player.clan)
-    played_battles = Battle.query.join(Battle.attendances).filter(BattleAttendance.player_id == g.player.id) \
-        .filter(BattleAttendance.reserve == False).distinct()
-
-    performance = analysis.player_performance(played_battles, [g.player])
-
-    def weekrange(start, end):
-        for n in range(int((end - start).days)):
-            yield start + timedelta(days=n)
-
-    player_battles_per_day = []
-    battles_per_day = []
-    for start_date in weekrange(datetime.datetime.now() - datetime.timedelta(days=30), datetime.datetime.now()):
-        end_date = start_date + datetime.timedelta(days=1)
-
-        # All clan battles
-        day_battles = clan_battles_query.filter(Battle.date >= start_date, Battle.date < end_date)
-        battles_per_day.append((calendar.timegm(start_date.timetuple()) * 1000, day_battles.count()))
-
-        # Player's battles
-        day_battles_played = played_battles.filter(Battle.date >= start_date, Battle.date < end_date)
-        player_battles_per_day.append((calendar.timegm(start_date.timetuple()) * 1000, day_battles_played.count()))
-
     if request.method == 'POST':
         g.player.email = request.form.get('email', '')
         g.player.phone = request.form.get('phone', '')
         db_session.add(g.player)
         db_session.commit()
+
+    played_battle_ids = select([BattleAttendance.battle_id], and_(BattleAttendance.player_id == g.player.id,
+                                                                   BattleAttendance.reserve == False))
+
+    def career_performance():
+        from . import analysis
+
+        played_battles = Battle.with_replay().filter(Battle.id.in_(played_battle_ids), Battle.replay_id != None)
+        performance = analysis.player_performance(played_battles, [g.player])
+        return analysis.PlayerPerformance(*[values[g.player] for values in performance])
+
+    performance = page_cache.get('profile_performance', g.player.clan, str(g.player.id), career_performance)
+
+    # battles of the clan and battles played by the player during the last 30 days (in one query)
+    today = datetime.date.today()
+    days = [today - datetime.timedelta(days=n) for n in range(29, -1, -1)]
+    day = func.date(Battle.date)
+    counts = db_session.query(day, func.sum(case([(Battle.clan == g.player.clan, 1)], else_=0)),
+                              func.sum(case([(Battle.id.in_(played_battle_ids), 1)], else_=0))) \
+        .filter(Battle.date >= days[0], or_(Battle.clan == g.player.clan, Battle.id.in_(played_battle_ids))) \
+        .group_by(day)
+    counts_per_day = dict((d if isinstance(d, datetime.date) else datetime.datetime.strptime(d, '%Y-%m-%d').date(),
+                           (int(clan_count), int(player_count))) for d, clan_count, player_count in counts)
+    battles_per_day = [(calendar.timegm(d.timetuple()) * 1000, counts_per_day.get(d, (0, 0))[0]) for d in days]
+    player_battles_per_day = [(calendar.timegm(d.timetuple()) * 1000, counts_per_day.get(d, (0, 0))[1]) for d in days]
+
+    # played battles, of a landing tournament only its final or (without final) its first battle
+    group_battle = alias(Battle.__table__)
+    same_group = group_battle.c.battle_group_id == Battle.battle_group_id
+    group_has_final = exists().where(and_(same_group, group_battle.c.battle_group_final == True))
+    first_of_group = select([func.min(group_battle.c.id)], same_group).as_scalar()
+    representative = or_(Battle.battle_group_id == None, Battle.battle_group_final == True,
+                         and_(~group_has_final, Battle.id == first_of_group))
+    player_count = select([func.count()], and_(BattleAttendance.battle_id == Battle.id,
+                                               BattleAttendance.reserve == False)).as_scalar()
+    reserve_count = select([func.count()], and_(BattleAttendance.battle_id == Battle.id,
+                                                BattleAttendance.reserve == True)).as_scalar()
+    played_battles = Battle.for_listing().filter(Battle.id.in_(played_battle_ids), representative)
+    battle_count = played_battles.count()
+    page = max(1, request.args.get('page', 1, type=int))
+    played_battles = played_battles.add_columns(player_count, reserve_count).order_by(Battle.date.desc()) \
+        .offset((page - 1) * config.PROFILE_BATTLES_PER_PAGE).limit(config.PROFILE_BATTLES_PER_PAGE).all()
+
     return render_template('players/profile.html', played_battles=played_battles, performance=performance,
-                           battles_per_day=battles_per_day, player_battles_per_day=player_battles_per_day)
+                           battles_per_day=battles_per_day, player_battles_per_day=player_battles_per_day,
+                           page=page, page_count=max(1, (battle_count - 1) // config.PROFILE_BATTLES_PER_PAGE + 1),
+                           battle_count=battle_count)
 
 
 @app.route('/admin/export-profiles/<clan>')
@@ -1879,17 +1967,59 @@ def export_profiles(clan):
 
 @app.route('/api/battle-checksums')
 def battle_checksums():
-    import hashlib
-
-    hashes = list()
-    for battle in Battle.query.all():
-        replay = battle.replay.unpickle()
-        if not replay:
-            continue
-        sha = hashlib.sha1()
-        sha.update(''.join(sorted(replays.player_team(replay))))
-        sha.update(replays.guess_enemy_clan(replay))
-        sha.update(replay['first']['mapName'])
-        hashes.append(sha.hexdigest())
-
-    return jsonify({'hashes': hashes})
+    """
+        Fingerprints of all battles (see replays.battle_fingerprint), e.g. to find
+        clan war replays that were not uploaded yet (scripts/find_cw_replays.py).
+
+        Supported query parameters:
+          since: only return the fingerprints added and removed after the change with this
+                 sequence number or, if given as date (dd.mm.yyyy), the fingerprints of the
+                 battles fought after that date
+          format: 'json' (default) or 'text' for one fingerprint per line, removed ones
+                  prefixed with '-'
+
+        The sequence number of the last change is returned as 'last_sequence' (JSON) or in the
+        X-Last-Sequence header and can be passed as 'since' in the next request. Fingerprints are
+        stored when the replay of a battle has been parsed, so this is not the order of the battles.
+        Responses carry an ETag so unchanged results are answered with 304.
+    """
+    since = request.args.get('since', '')
+    output_format = request.args.get('format', 'json')
+    if output_format not in ('json', 'text'):
+        abort(400)
+
+    last_sequence = FingerprintSequence.current()
+    etag = hashlib.sha1('%s:%s:%d' % (since, output_format, last_sequence)).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    if since.isdigit():
+        # the last change of each fingerprint counts
+        changes = OrderedDict()
+        for fingerprint, removed in db_session.query(FingerprintChange.fingerprint, FingerprintChange.removed) \
+                .filter(FingerprintChange.sequence > int(since), FingerprintChange.sequence <= last_sequence) \
+                .order_by(FingerprintChange.sequence):
+            changes.pop(fingerprint, None)
+            changes[fingerprint] = removed
+        hashes = [fingerprint for fingerprint, removed in changes.iteritems() if not removed]
+        removed_hashes = [fingerprint for fingerprint, removed in changes.iteritems() if removed]
+    else:
+        battles = db_session.query(Battle.fingerprint).filter(Battle.fingerprint != None)
+        if since:
+            try:
+                battles = battles.filter(Battle.date > datetime.datetime.strptime(since, '%d.%m.%Y'))
+            except ValueError:
+                abort(400)
+        hashes = [fingerprint for fingerprint, in battles.order_by(Battle.id)]
+        removed_hashes = []
+
+    if output_format == 'text':
+        response = Response('\n'.join(hashes + ['-' + fingerprint for fingerprint in removed_hashes]),
+                            mimetype='text/plain')
+    else:
+        response = jsonify({'hashes': hashes, 'removed': removed_hashes, 'last_sequence': last_sequence})
+    response.headers['X-Last-Sequence'] = str(last_sequence)
+    response.set_etag(etag)
+    return response